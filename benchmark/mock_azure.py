@@ -0,0 +1,122 @@
+"""
+Servidor local que imita el endpoint chat/completions de Azure OpenAI para el benchmark.
+
+Responde JSON fijo según el prompt de sistema (extracción de cajetín, análisis de riesgos o
+chat), con latencia, tasa de 429 y valores de "usage" configurables por variables de entorno
+o por línea de comandos. GET /stats informa lo recibido.
+
+Uso:
+    python benchmark/mock_azure.py --port 8765 --latency 2.0 --latency-per-mb 0.5 --rate-429 0.05
+    AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8765/ uvicorn function_app:app
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# --- CONFIGURACIÓN ---
+MOCK_LATENCY_SECONDS = float(os.getenv("MOCK_AZURE_LATENCY_SECONDS", "1.0"))
+MOCK_LATENCY_PER_MB = float(os.getenv("MOCK_AZURE_LATENCY_PER_MB", "0.0"))      # Segundos extra por MB del cuerpo
+MOCK_LATENCY_JITTER = float(os.getenv("MOCK_AZURE_LATENCY_JITTER", "0.1"))      # Variación relativa (+/-)
+MOCK_RATE_429 = float(os.getenv("MOCK_AZURE_RATE_429", "0.0"))                  # Fracción de solicitudes rechazadas
+MOCK_RETRY_AFTER_MS = int(os.getenv("MOCK_AZURE_RETRY_AFTER_MS", "1000"))
+MOCK_PROMPT_TOKENS = int(os.getenv("MOCK_AZURE_PROMPT_TOKENS", "0"))            # 0 = aproximado por el tamaño del cuerpo
+MOCK_COMPLETION_TOKENS = int(os.getenv("MOCK_AZURE_COMPLETION_TOKENS", "800"))
+MOCK_RISKS_PER_BATCH = int(os.getenv("MOCK_AZURE_RISKS_PER_BATCH", "5"))
+MOCK_SEED = os.getenv("MOCK_AZURE_SEED")
+
+RNG = random.Random(int(MOCK_SEED) if MOCK_SEED else None)
+STATS = {"requests": 0, "throttled_429": 0, "by_kind": {}, "body_bytes": 0, "started_at": time.time()}
+
+app = FastAPI()
+
+
+def request_kind(payload: dict) -> str:
+    system_prompt = str(payload.get("messages", [{}])[0].get("content", ""))
+    if "extractor OCR" in system_prompt:
+        return "extraction"
+    if "preguntas de seguimiento" in system_prompt:
+        return "chat"
+    return "analysis"
+
+
+def image_count(payload: dict) -> int:
+    content = payload.get("messages", [{}])[-1].get("content")
+    if not isinstance(content, list):
+        return 0
+    return sum(1 for part in content if isinstance(part, dict) and part.get("type") == "image_url")
+
+
+def canned_content(kind: str, payload: dict) -> str:
+    if kind == "extraction":
+        extracciones = [{"pagina": i + 1, "dwg_no": f"MOCK-{i + 1:03d}", "rev": "0"} for i in range(image_count(payload))]
+        return json.dumps({"extracciones": extracciones})
+    if kind == "chat":
+        return "Respuesta simulada: la P-101A queda sin respaldo si falla la PSV-201."
+    riesgos = [{
+        "id": i + 1,
+        "riesgo_titulo": f"Riesgo simulado {i + 1}",
+        "descripcion": "¿Qué pasa si la válvula FV-101 falla cerrada?",
+        "ubicacion": "DWG No: MOCK-001, REV: 0",
+        "causa_potencial": "Sobrepresión aguas arriba y parada de planta.",
+        "recomendacion": "Mitigaciones Existentes: PSV-201. Recomendación Principal: agregar alarma PAH. Alternativa Práctica: revisar la lógica del SIS.",
+    } for i in range(MOCK_RISKS_PER_BATCH)]
+    return json.dumps({"riesgos_identificados": riesgos}, ensure_ascii=False)
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.body()
+    STATS["requests"] += 1
+    STATS["body_bytes"] += len(body)
+    if MOCK_RATE_429 and RNG.random() < MOCK_RATE_429:
+        STATS["throttled_429"] += 1
+        return JSONResponse(status_code=429, content={"error": {"code": "429", "message": "Rate limit simulado."}},
+                            headers={"retry-after-ms": str(MOCK_RETRY_AFTER_MS)})
+
+    payload = json.loads(body)
+    kind = request_kind(payload)
+    STATS["by_kind"][kind] = STATS["by_kind"].get(kind, 0) + 1
+    delay = (MOCK_LATENCY_SECONDS + MOCK_LATENCY_PER_MB * len(body) / 1024 / 1024) * (1 + RNG.uniform(-MOCK_LATENCY_JITTER, MOCK_LATENCY_JITTER))
+    await asyncio.sleep(max(0.0, delay))
+
+    # Sin un valor fijo, ~4 bytes de JSON por token: grueso, pero crece con las imágenes enviadas
+    prompt_tokens = MOCK_PROMPT_TOKENS or len(body) // 4
+    return {
+        "id": f"mock-{STATS['requests']}",
+        "object": "chat.completion",
+        "model": deployment,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": canned_content(kind, payload)}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": MOCK_COMPLETION_TOKENS, "total_tokens": prompt_tokens + MOCK_COMPLETION_TOKENS},
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**STATS, "uptime_seconds": round(time.time() - STATS["started_at"], 3)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Servidor simulado de Azure OpenAI.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=MOCK_LATENCY_SECONDS, help="segundos por solicitud")
+    parser.add_argument("--latency-per-mb", type=float, default=MOCK_LATENCY_PER_MB, help="segundos extra por MB del cuerpo")
+    parser.add_argument("--jitter", type=float, default=MOCK_LATENCY_JITTER, help="variación relativa de la latencia")
+    parser.add_argument("--rate-429", type=float, default=MOCK_RATE_429, help="fracción de solicitudes con 429")
+    parser.add_argument("--retry-after-ms", type=int, default=MOCK_RETRY_AFTER_MS)
+    parser.add_argument("--prompt-tokens", type=int, default=MOCK_PROMPT_TOKENS, help="0 = aproximado por el tamaño del cuerpo")
+    parser.add_argument("--completion-tokens", type=int, default=MOCK_COMPLETION_TOKENS)
+    parser.add_argument("--risks-per-batch", type=int, default=MOCK_RISKS_PER_BATCH)
+    args = parser.parse_args()
+    MOCK_LATENCY_SECONDS, MOCK_LATENCY_PER_MB, MOCK_LATENCY_JITTER = args.latency, args.latency_per_mb, args.jitter
+    MOCK_RATE_429, MOCK_RETRY_AFTER_MS = args.rate_429, args.retry_after_ms
+    MOCK_PROMPT_TOKENS, MOCK_COMPLETION_TOKENS, MOCK_RISKS_PER_BATCH = args.prompt_tokens, args.completion_tokens, args.risks_per_batch
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,346 @@
+"""
+Benchmark de function_app.py sin consumir cuota de Azure.
+
+Genera un corpus de planos sintéticos (synthetic_pdfs.py), levanta el servidor simulado
+(mock_azure.py) en un subproceso y ejecuta /analyze, /chat y /download_report contra la
+app FastAPI, en este mismo proceso vía ASGI, a cada nivel de concurrencia. Informa p50/p95,
+solicitudes por segundo y RSS máximo (proceso + workers de renderizado).
+
+Uso:
+    python benchmark/run_benchmark.py --concurrency 1,4,8 --requests 8 --size A1 --pages 6
+    python benchmark/run_benchmark.py --output base.json
+    python benchmark/run_benchmark.py --baseline base.json --max-regression 0.2   # sale con 1 si empeora
+
+Las variables de entorno de function_app.py (AZURE_MAX_CONCURRENCY, BATCH_STRATEGY, ...)
+se respetan; la caché de renderizado se desactiva salvo con --render-cache.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from synthetic_pdfs import add_arguments, corpus_options, generate_corpus
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RSS_SAMPLE_SECONDS = 0.1
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+CHAT_QUESTION = "¿Qué pasa si falla la P-101A y la PSV-201 no abre?"
+
+
+# --- MEMORIA (RSS) ---
+def _child_pids(pid: int) -> List[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def tree_rss_bytes(exclude: Tuple[int, ...] = ()) -> Optional[int]:
+    """RSS actual de este proceso y sus descendientes (Linux); None si /proc no está disponible."""
+    if not os.path.isdir("/proc/self/task"):
+        return None
+    total, pending = 0, [os.getpid()]
+    while pending:
+        pid = pending.pop()
+        if pid in exclude:
+            continue
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(_child_pids(pid))
+    return total
+
+
+def max_rss_bytes() -> int:
+    """Pico de RSS de este proceso según getrusage (KB en Linux, bytes en macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """Muestrea periódicamente el RSS del árbol de procesos y guarda el máximo."""
+
+    def __init__(self, exclude: Tuple[int, ...]):
+        self.exclude = exclude
+        self.peak = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, tree_rss_bytes(self.exclude) or max_rss_bytes())
+            await asyncio.sleep(RSS_SAMPLE_SECONDS)
+
+    def start(self):
+        self.peak = 0
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> int:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return self.peak
+
+
+# --- SERVIDOR SIMULADO ---
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    command = [
+        sys.executable, os.path.join(BENCHMARK_DIR, "mock_azure.py"), "--port", str(port),
+        "--latency", str(args.mock_latency), "--latency-per-mb", str(args.mock_latency_per_mb),
+        "--rate-429", str(args.mock_rate_429), "--retry-after-ms", str(args.mock_retry_after_ms),
+        "--prompt-tokens", str(args.mock_prompt_tokens), "--completion-tokens", str(args.mock_completion_tokens),
+    ]
+    process = subprocess.Popen(command, env={**os.environ, "MOCK_AZURE_SEED": str(args.seed)})
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"El servidor simulado terminó con código {process.returncode}.")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1.0)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("El servidor simulado no respondió a tiempo.")
+
+
+# --- EJECUCIÓN ---
+def summarize(latencies: List[float], errors: int, wall_seconds: float) -> Dict[str, Any]:
+    values = sorted(latencies)
+    def percentile(p):
+        # Rango más cercano: el menor valor con al menos p de las muestras a su izquierda (p50 de dos muestras es la menor)
+        return round(values[max(0, math.ceil(p * len(values)) - 1)], 3) if values else None
+    return {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "p50_seconds": percentile(0.50),
+        "p95_seconds": percentile(0.95),
+        "max_seconds": round(values[-1], 3) if values else None,
+        "requests_per_second": round(len(values) / wall_seconds, 3) if wall_seconds else 0.0,
+    }
+
+
+async def run_phase(concurrency: int, count: int, call: Callable[[int], Awaitable[Any]]) -> Tuple[Dict[str, Any], List[Any]]:
+    """Ejecuta count llamadas con concurrency trabajadores; devuelve el resumen y los resultados correctos."""
+    indices = iter(range(count))
+    latencies, results = [], []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for i in indices:
+            started = time.perf_counter()
+            try:
+                result = await call(i)
+            except Exception as e:
+                errors += 1
+                logging.warning(f"Benchmark: solicitud {i} falló: {e}")
+                continue
+            latencies.append(time.perf_counter() - started)
+            results.append(result)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started), results
+
+
+def checked(response: httpx.Response) -> httpx.Response:
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return response
+
+
+async def run_level(client: httpx.AsyncClient, files: List[Tuple[str, bytes]], concurrency: int, args: argparse.Namespace,
+                    sampler: RssSampler) -> Dict[str, Any]:
+    async def analyze(i):
+        uploads = [("planos", (name, data, "application/pdf")) for name, data in files]
+        response = checked(await client.post("/analyze", files=uploads))
+        # Sin marcas de revisión /analyze responde sólo {"message"}: cuenta como análisis, pero no deja sesión
+        return response.json().get("session_id")
+
+    sampler.start()
+    endpoints = {}
+    endpoints["analyze"], sessions = await run_phase(concurrency, args.requests, analyze)
+    sessions = [session_id for session_id in sessions if session_id]
+    if not sessions:
+        logging.warning("Benchmark: ningún /analyze devolvió sesión; se omiten /chat y /download_report.")
+
+    async def chat(i):
+        body = {"session_id": sessions[i % len(sessions)], "messages": [{"role": "user", "content": CHAT_QUESTION}]}
+        return checked(await client.post("/chat", json=body)).json()
+
+    async def download(i):
+        body = {"session_id": sessions[i % len(sessions)], "format": args.report_format}
+        return len(checked(await client.post("/download_report", json=body)).content)
+
+    if sessions:
+        endpoints["chat"], _ = await run_phase(concurrency, args.requests, chat)
+        endpoints["download"], _ = await run_phase(concurrency, args.requests, download)
+    return {"concurrency": concurrency, "peak_rss_mb": round(await sampler.stop() / 1024 / 1024, 1), "endpoints": endpoints}
+
+
+async def run_benchmark(args: argparse.Namespace, files: List[Tuple[str, bytes]], mock_port: int, mock_pid: int) -> Dict[str, Any]:
+    import function_app
+
+    sampler = RssSampler(exclude=(mock_pid,))
+    levels = []
+    async with function_app.app.router.lifespan_context(function_app.app):
+        transport = httpx.ASGITransport(app=function_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for _ in range(args.warmup):
+                # Arranca el pool de renderizado y la conexión al servidor simulado fuera de la medición
+                uploads = [("planos", (name, data, "application/pdf")) for name, data in files]
+                checked(await client.post("/analyze", files=uploads))
+            for concurrency in args.concurrency:
+                level = await run_level(client, files, concurrency, args, sampler)
+                print_level(level)
+                levels.append(level)
+            app_stats = (await client.get("/stats")).json()
+    mock_stats = httpx.get(f"http://127.0.0.1:{mock_port}/stats").json()
+    return {
+        "corpus": {"documents": len(files), "bytes": sum(len(data) for _, data in files), **corpus_options(args)},
+        "render_cache": args.render_cache,
+        "levels": levels,
+        "process_max_rss_mb": round(max_rss_bytes() / 1024 / 1024, 1),
+        "azure_scheduler": app_stats["azure_scheduler"],
+        "mock_azure": mock_stats,
+    }
+
+
+# --- REPORTE Y COMPARACIÓN ---
+def print_level(level: Dict[str, Any]):
+    print(f"\nConcurrencia {level['concurrency']} (RSS máximo {level['peak_rss_mb']} MB)")
+    print(f"  {'endpoint':<10}{'n':>5}{'err':>5}{'p50 s':>10}{'p95 s':>10}{'máx s':>10}{'req/s':>10}")
+    for name, summary in level["endpoints"].items():
+        cells = [summary[key] if summary[key] is not None else "-" for key in ("p50_seconds", "p95_seconds", "max_seconds", "requests_per_second")]
+        print(f"  {name:<10}{summary['requests']:>5}{summary['errors']:>5}" + "".join(f"{cell:>10}" for cell in cells))
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regresiones frente a una corrida anterior: p95 mayor o req/s menor que la tolerancia."""
+    regressions = []
+    base_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in result["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        for name, summary in level["endpoints"].items():
+            base_summary = base["endpoints"].get(name)
+            if not base_summary:
+                continue
+            if summary["p95_seconds"] and base_summary["p95_seconds"] and summary["p95_seconds"] > base_summary["p95_seconds"] * (1 + tolerance):
+                regressions.append(f"{name} c={level['concurrency']}: p95 {base_summary['p95_seconds']} s -> {summary['p95_seconds']} s")
+            if base_summary["requests_per_second"] and summary["requests_per_second"] < base_summary["requests_per_second"] * (1 - tolerance):
+                regressions.append(f"{name} c={level['concurrency']}: req/s {base_summary['requests_per_second']} -> {summary['requests_per_second']}")
+            if summary["errors"] > base_summary["errors"]:
+                regressions.append(f"{name} c={level['concurrency']}: errores {base_summary['errors']} -> {summary['errors']}")
+        if level["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"c={level['concurrency']}: RSS máximo {base['peak_rss_mb']} MB -> {level['peak_rss_mb']} MB")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark de function_app.py con Azure OpenAI simulado.")
+    parser.add_argument("--concurrency", type=lambda value: [int(v) for v in value.split(",")], default=[1, 4],
+                        help="niveles de concurrencia separados por coma")
+    parser.add_argument("--requests", type=int, default=4, help="solicitudes por endpoint y nivel")
+    parser.add_argument("--warmup", type=int, default=1, help="análisis previos no medidos")
+    parser.add_argument("--pdf-dir", help="usar estos PDF en lugar de generar el corpus")
+    parser.add_argument("--render-cache", action="store_true", help="mantener la caché de renderizado activa")
+    parser.add_argument("--report-format", choices=["csv", "ndjson", "json"], default="csv")
+    parser.add_argument("--mock-latency", type=float, default=1.0, help="segundos por llamada simulada")
+    parser.add_argument("--mock-latency-per-mb", type=float, default=0.25)
+    parser.add_argument("--mock-rate-429", type=float, default=0.0)
+    parser.add_argument("--mock-retry-after-ms", type=int, default=500)
+    parser.add_argument("--mock-prompt-tokens", type=int, default=0, help="0 = aproximado por el tamaño del cuerpo")
+    parser.add_argument("--mock-completion-tokens", type=int, default=800)
+    parser.add_argument("--output", help="guardar el resultado en JSON")
+    parser.add_argument("--baseline", help="resultado JSON anterior con el que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="tolerancia relativa frente a --baseline")
+    parser.add_argument("--log-level", default="WARNING")
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Antes de importar function_app: su logging.basicConfig(INFO) ya no tiene efecto
+    logging.basicConfig(level=args.log_level)
+    for name in ("pdf_dir", "output", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    work_dir = tempfile.mkdtemp(prefix="pid_benchmark_")
+    mock_port = free_port()
+    # function_app.py lee su configuración al importarse: todo debe quedar fijado antes
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{mock_port}/"
+    os.environ["AZURE_OPENAI_KEY"] = "benchmark"
+    os.environ["RATINGS_BACKEND"] = "local"
+    os.environ["RATINGS_LOCAL_PATH"] = os.path.join(work_dir, "ratings_log.csv")
+    os.environ["RENDER_CACHE_DIR"] = os.path.join(work_dir, "render_cache")
+    os.environ["RENDER_CACHE_MAX_MB"] = os.environ.get("RENDER_CACHE_MAX_MB", "2048") if args.render_cache else "0"
+    os.environ["SESSION_SPILL_DIR"] = os.path.join(work_dir, "sessions")
+    os.environ["UPLOAD_SPOOL_DIR"] = os.path.join(work_dir, "uploads")
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR) # knowledge_base/ se busca relativo al directorio de trabajo
+
+    mock = None
+    try:
+        pdf_dir = args.pdf_dir or os.path.join(work_dir, "corpus")
+        if not args.pdf_dir:
+            generate_corpus(pdf_dir, **corpus_options(args))
+        files = []
+        for name in sorted(os.listdir(pdf_dir)):
+            if name.lower().endswith(".pdf"):
+                with open(os.path.join(pdf_dir, name), "rb") as f:
+                    files.append((name, f.read()))
+        if not files:
+            sys.exit(f"No hay PDF en {pdf_dir}.")
+        mock = start_mock(args, mock_port)
+        result = asyncio.run(run_benchmark(args, files, mock_port, mock.pid))
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\nAzure simulado: {result['mock_azure']['requests']} solicitud(es), {result['mock_azure']['throttled_429']} con 429.")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESIÓN: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
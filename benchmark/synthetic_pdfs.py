@@ -0,0 +1,174 @@
+"""
+Generador de planos P&ID sintéticos para el benchmark.
+
+Cada hoja lleva líneas de proceso, equipos con tags (P-101A, PSV-201...), un cajetín con
+DWG No y REV en la capa de texto (opcional) y, en las hojas marcadas, nubes de revisión
+rojas y sombreado gris como los que busca el detector local de function_app.py.
+
+Uso:
+    python benchmark/synthetic_pdfs.py salida/ --documents 4 --pages 6 --size A1 --marked-ratio 0.5
+"""
+import argparse
+import os
+import random
+from typing import Dict, List, Optional
+
+import fitz  # PyMuPDF
+
+# Tamaños de hoja en puntos, apaisados
+PAGE_SIZES = {
+    "tabloid": (1224, 792),
+    "A3": (1191, 842),
+    "A1": (2384, 1684),
+    "A0": (3370, 2384),
+}
+TAG_PREFIXES = ["P", "PSV", "FV", "LT", "PT", "TT", "XV", "E", "V", "FIC"]
+RED = (0.9, 0.05, 0.05)
+GREY = (0.6, 0.6, 0.6)
+BLACK = (0, 0, 0)
+
+
+def _tag(rng: random.Random) -> str:
+    return f"{rng.choice(TAG_PREFIXES)}-{rng.randint(100, 999)}{rng.choice(['', 'A', 'B'])}"
+
+
+def _draw_pipework(page: fitz.Page, rng: random.Random, lines: int):
+    """Líneas de proceso ortogonales, equipos (círculos) y tags de texto."""
+    width, height = page.rect.width, page.rect.height
+    shape = page.new_shape()
+    for _ in range(lines):
+        x, y = rng.uniform(0.05, 0.75) * width, rng.uniform(0.05, 0.75) * height
+        for _ in range(rng.randint(2, 4)):
+            if rng.random() < 0.5:
+                nx, ny = min(0.78 * width, x + rng.uniform(0.05, 0.2) * width), y
+            else:
+                nx, ny = x, min(0.78 * height, y + rng.uniform(0.05, 0.2) * height)
+            shape.draw_line((x, y), (nx, ny))
+            x, y = nx, ny
+    shape.finish(color=BLACK, width=1.5)
+    for _ in range(max(1, lines // 3)):
+        center = (rng.uniform(0.08, 0.75) * width, rng.uniform(0.08, 0.75) * height)
+        shape.draw_circle(center, rng.uniform(0.01, 0.025) * width)
+    shape.finish(color=BLACK, width=1.5)
+    shape.commit()
+    for _ in range(lines):
+        position = (rng.uniform(0.05, 0.75) * width, rng.uniform(0.05, 0.78) * height)
+        page.insert_text(position, _tag(rng), fontsize=max(6, width / 180))
+
+
+def _draw_cloud(page: fitz.Page, rect: fitz.Rect, arc_size: float):
+    """Nube de revisión: semicírculos rojos a lo largo del borde del rectángulo."""
+    shape = page.new_shape()
+    corners = [rect.tl, rect.tr, rect.br, rect.bl, rect.tl]
+    for start, end in zip(corners, corners[1:]):
+        length = abs(end - start)
+        arcs = max(1, int(length // arc_size))
+        for i in range(arcs):
+            a = start + (end - start) * (i / arcs)
+            b = start + (end - start) * ((i + 1) / arcs)
+            center = (a + b) / 2
+            shape.draw_sector(center, a, 180, fullSector=False)
+    shape.finish(color=RED, width=max(1.5, arc_size / 8))
+    shape.commit()
+
+
+def _draw_hatching(page: fitz.Page, rect: fitz.Rect, spacing: float):
+    """Sombreado gris a 45° recortado al rectángulo."""
+    shape = page.new_shape()
+    width, height = rect.width, rect.height
+    offset = -height
+    while offset < width:
+        # Puntos (x0 + offset + t, y1 - t) con t en [0, alto], recortados al ancho
+        t0, t1 = max(0.0, -offset), min(height, width - offset)
+        if t0 < t1:
+            shape.draw_line((rect.x0 + offset + t0, rect.y1 - t0), (rect.x0 + offset + t1, rect.y1 - t1))
+        offset += spacing
+    shape.finish(color=GREY, width=max(1.0, spacing / 5))
+    shape.commit()
+
+
+def _draw_title_block(page: fitz.Page, dwg_no: str, rev: str, with_text: bool):
+    """Cajetín en el rincón inferior derecho (la zona que el detector y la Etapa 1 usan)."""
+    width, height = page.rect.width, page.rect.height
+    box = fitz.Rect(0.81 * width, 0.81 * height, 0.99 * width, 0.99 * height)
+    page.draw_rect(box, color=BLACK, width=1.5)
+    page.draw_line((box.x0, box.y0 + box.height / 2), (box.x1, box.y0 + box.height / 2), color=BLACK, width=1)
+    if with_text:
+        fontsize = max(6, width / 150)
+        page.insert_text((box.x0 + 6, box.y0 + box.height * 0.3), f"DWG No: {dwg_no}", fontsize=fontsize)
+        page.insert_text((box.x0 + 6, box.y0 + box.height * 0.8), f"REV: {rev}", fontsize=fontsize)
+    else:
+        # Sin capa de texto: el cajetín se dibuja como trazos y la Etapa 1 tiene que usar el modelo
+        page.draw_rect(fitz.Rect(box.x0 + 6, box.y0 + 6, box.x1 - 6, box.y0 + box.height * 0.4), color=BLACK, width=0.5)
+
+
+def make_pid_pdf(path: str, pages: int = 4, size: str = "A1", title_block_text: bool = True,
+                 marked_ratio: float = 1.0, clouds: int = 1, hatching: int = 1, lines: int = 40,
+                 seed: Optional[int] = None) -> Dict[str, object]:
+    """
+    Escribe un PDF sintético en path. marked_ratio es la fracción de hojas con nubes y
+    sombreado (el resto no pasa a la Etapa 2). Devuelve un resumen de lo generado.
+    """
+    rng = random.Random(seed)
+    width, height = PAGE_SIZES[size]
+    marked_pages = set(rng.sample(range(pages), round(pages * marked_ratio)))
+    doc = fitz.open()
+    drawings = []
+    for number in range(pages):
+        page = doc.new_page(width=width, height=height)
+        _draw_pipework(page, rng, lines)
+        dwg_no = f"{rng.randint(100, 999)}-PID-{number + 1:03d}"
+        rev = str(rng.randint(0, 9))
+        _draw_title_block(page, dwg_no, rev, title_block_text)
+        if number in marked_pages:
+            for _ in range(clouds):
+                w, h = rng.uniform(0.08, 0.18) * width, rng.uniform(0.08, 0.18) * height
+                x0, y0 = rng.uniform(0.05, 0.75 - w / width) * width, rng.uniform(0.05, 0.75 - h / height) * height
+                _draw_cloud(page, fitz.Rect(x0, y0, x0 + w, y0 + h), arc_size=max(12.0, width / 120))
+            for _ in range(hatching):
+                w, h = rng.uniform(0.06, 0.12) * width, rng.uniform(0.06, 0.12) * height
+                x0, y0 = rng.uniform(0.05, 0.75 - w / width) * width, rng.uniform(0.05, 0.75 - h / height) * height
+                _draw_hatching(page, fitz.Rect(x0, y0, x0 + w, y0 + h), spacing=max(5.0, width / 240))
+        drawings.append({"page": number + 1, "dwg_no": dwg_no, "rev": rev, "marked": number in marked_pages})
+    doc.save(path, deflate=True)
+    doc.close()
+    return {"path": path, "bytes": os.path.getsize(path), "size": size, "pages": drawings}
+
+
+def generate_corpus(out_dir: str, documents: int = 2, pages: int = 4, size: str = "A1", title_block_text: bool = True,
+                    marked_ratio: float = 1.0, clouds: int = 1, hatching: int = 1, lines: int = 40, seed: int = 0) -> List[Dict[str, object]]:
+    """Genera documents PDF en out_dir (reproducibles para una misma semilla)."""
+    os.makedirs(out_dir, exist_ok=True)
+    return [
+        make_pid_pdf(os.path.join(out_dir, f"pid_{i + 1:02d}.pdf"), pages=pages, size=size, title_block_text=title_block_text,
+                     marked_ratio=marked_ratio, clouds=clouds, hatching=hatching, lines=lines, seed=seed + i)
+        for i in range(documents)
+    ]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Opciones del corpus, compartidas con run_benchmark.py."""
+    parser.add_argument("--documents", type=int, default=2, help="PDF por análisis")
+    parser.add_argument("--pages", type=int, default=4, help="hojas por PDF")
+    parser.add_argument("--size", choices=sorted(PAGE_SIZES), default="A1")
+    parser.add_argument("--no-title-block-text", dest="title_block_text", action="store_false",
+                        help="cajetín sin capa de texto (fuerza la Etapa 1 con el modelo)")
+    parser.add_argument("--marked-ratio", type=float, default=1.0, help="fracción de hojas con nubes/sombreado")
+    parser.add_argument("--clouds", type=int, default=1, help="nubes rojas por hoja marcada")
+    parser.add_argument("--hatching", type=int, default=1, help="zonas sombreadas por hoja marcada")
+    parser.add_argument("--lines", type=int, default=40, help="líneas de proceso por hoja")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def corpus_options(args: argparse.Namespace) -> Dict[str, object]:
+    return {name: getattr(args, name) for name in ("documents", "pages", "size", "title_block_text", "marked_ratio", "clouds", "hatching", "lines", "seed")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera planos P&ID sintéticos.")
+    parser.add_argument("out_dir")
+    add_arguments(parser)
+    args = parser.parse_args()
+    for document in generate_corpus(args.out_dir, **corpus_options(args)):
+        marked = sum(1 for page in document["pages"] if page["marked"])
+        print(f"{document['path']}: {len(document['pages'])} hoja(s) {document['size']}, {marked} marcada(s), {document['bytes'] / 1024:.0f} KB")
@@ -9,25 +9,133 @@ import uuid
 import csv 
 import io  
 import re 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Response
+import tempfile
+import math
+import heapq
+import itertools
+import random
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import time
+import shutil
+import hashlib
+import threading
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 # --- IMPORTACIÓN MODIFICADA ---
-from typing import List, Dict, Any, Optional 
+from typing import List, Dict, Any, Optional, Tuple, Callable 
 from io import BytesIO
 from pydantic import BaseModel
+from PIL import Image
+import numpy as np
 # --- NUEVAS IMPORTACIONES PARA AZURE IDENTITY ---
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 
 logging.basicConfig(level=logging.INFO)
 
 # --- CONFIGURACIÓN Y CONSTANTES ---
 AZURE_API_KEY = os.getenv("AZURE_OPENAI_KEY")
-AZURE_ENDPOINT = "https://pid-analisis-ai.openai.azure.com/"
+# Debe terminar en "/"; benchmark/ lo apunta a un servidor simulado local
+AZURE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://pid-analisis-ai.openai.azure.com/")
 DEPLOYMENT_NAME = "Analisis_de_riesgos_PID"
 API_VERSION = "2024-05-01-preview"
 SAFE_PAYLOAD_LIMIT_MB = 18.0
 
+# --- CONFIGURACIÓN DEL POOL DE RENDERIZADO ---
+RENDER_DPI = 300
+# Número de procesos para rasterizar páginas (0 = un proceso por núcleo)
+RENDER_POOL_WORKERS = int(os.getenv("RENDER_POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+# Caché de renderizado en disco (direccionada por contenido); 0 MB la desactiva
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pid_render_cache"))
+RENDER_CACHE_MAX_MB = float(os.getenv("RENDER_CACHE_MAX_MB", "2048"))
+# Pool HTTP compartido hacia Azure OpenAI
+AZURE_HTTP_MAX_CONNECTIONS = int(os.getenv("AZURE_HTTP_MAX_CONNECTIONS", "20"))
+AZURE_HTTP_MAX_KEEPALIVE = int(os.getenv("AZURE_HTTP_MAX_KEEPALIVE", "10"))
+AZURE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AZURE_HTTP_KEEPALIVE_EXPIRY", "120"))
+AZURE_HTTP2 = os.getenv("AZURE_HTTP2", "true").lower() == "true"
+# Planificador de solicitudes a Azure OpenAI (0 = sin límite)
+AZURE_RPM_LIMIT = int(os.getenv("AZURE_RPM_LIMIT", "0"))
+AZURE_TPM_LIMIT = int(os.getenv("AZURE_TPM_LIMIT", "0"))
+AZURE_MAX_CONCURRENCY = int(os.getenv("AZURE_MAX_CONCURRENCY", "8"))
+# Procesos que comparten la cuota (uvicorn y gunicorn toman su número de workers de WEB_CONCURRENCY):
+# cada worker planifica con AZURE_RPM_LIMIT / AZURE_TPM_LIMIT divididos entre todos
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+AZURE_MAX_RETRIES = int(os.getenv("AZURE_MAX_RETRIES", "4"))
+AZURE_BACKOFF_BASE_SECONDS = float(os.getenv("AZURE_BACKOFF_BASE_SECONDS", "2.0"))
+AZURE_BACKOFF_MAX_SECONDS = float(os.getenv("AZURE_BACKOFF_MAX_SECONDS", "60.0"))
+# Almacén de sesiones: TTL deslizante, presupuesto de memoria y derrame a disco
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "7200"))
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("SESSION_MEMORY_BUDGET_MB", "512"))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", os.path.join(tempfile.gettempdir(), "pid_sessions"))
+SESSION_DISK_BUDGET_MB = float(os.getenv("SESSION_DISK_BUDGET_MB", "4096"))
+# "memory" (sesiones en este proceso) o "sqlite" (archivo compartido: cualquier worker de uvicorn
+# --workers N atiende cualquier sesión, sin enrutamiento fijo). SQLite requiere un disco local; entre
+# réplicas hace falta un backend en red con la misma interfaz.
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "pid_sessions.sqlite3"))
+# Reportes exportados en caché por sesión y formato (se invalidan cuando cambia el análisis)
+REPORT_CACHE_MAX_MB = float(os.getenv("REPORT_CACHE_MAX_MB", "64"))
+# Subidas: se copian por fragmentos a disco; tamaño, páginas y dimensiones se validan antes de renderizar
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "pid_uploads"))
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "200"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "500"))
+PDF_MAX_PAGE_SIDE_INCHES = float(os.getenv("PDF_MAX_PAGE_SIDE_INCHES", "60"))   # A0 mide 46.8"
+# Confianza mínima para aceptar el DWG/REV leído de la capa de texto sin llamar al modelo
+CAJETIN_LOCAL_MIN_CONFIDENCE = float(os.getenv("CAJETIN_LOCAL_MIN_CONFIDENCE", "0.75"))
+# Presupuesto de bytes por imagen de página; la escalera de codificación baja hasta cumplirlo
+IMAGE_BYTE_BUDGET_MB = float(os.getenv("IMAGE_BYTE_BUDGET_MB", "4.0"))
+# Detector local de marcas de revisión: las páginas de planos sin nubes rojas ni sombreado gris no van a la Etapa 2
+REVISION_DETECTOR_ENABLED = os.getenv("REVISION_DETECTOR_ENABLED", "true").lower() == "true"
+REVISION_DETECT_DPI = int(os.getenv("REVISION_DETECT_DPI", "72"))
+# Estrategia de batching por defecto: "greedy" (despacho en streaming), "ffd" (mínimo de lotes) o "balanced" (lotes parejos)
+BATCH_STRATEGY = os.getenv("BATCH_STRATEGY", "greedy")
+BATCH_KEEP_TOGETHER = os.getenv("BATCH_KEEP_TOGETHER", "false").lower() == "true"   # Mantener juntas las hojas de un mismo PDF
+BATCH_TARGET_PARALLELISM = int(os.getenv("BATCH_TARGET_PARALLELISM", str(AZURE_MAX_CONCURRENCY)))
+# Tokens por lote (el contexto del modelo es de 128k) y presupuesto de tokens por análisis (0 = sin límite)
+BATCH_TOKEN_LIMIT = int(os.getenv("BATCH_TOKEN_LIMIT", "100000"))
+ANALYSIS_TOKEN_BUDGET = int(os.getenv("ANALYSIS_TOKEN_BUDGET", "0"))
+# Valores iniciales del modelo de latencia por lote (se ajusta con cada lote completado)
+BATCH_LATENCY_BASE_SECONDS = float(os.getenv("BATCH_LATENCY_BASE_SECONDS", "15.0"))
+BATCH_LATENCY_SECONDS_PER_MB = float(os.getenv("BATCH_LATENCY_SECONDS_PER_MB", "6.0"))
+# Recortes por región de interés: vista general de baja resolución + recortes de alta resolución alrededor de los cambios
+ROI_TILING_ENABLED = os.getenv("ROI_TILING_ENABLED", "false").lower() == "true"
+ROI_OVERVIEW_DPI = int(os.getenv("ROI_OVERVIEW_DPI", "72"))
+ROI_TILE_DPI = int(os.getenv("ROI_TILE_DPI", "300"))
+ROI_TILE_MARGIN = float(os.getenv("ROI_TILE_MARGIN", "0.03"))       # Margen alrededor de cada cambio (fracción de la hoja)
+ROI_MAX_EXPANSION = float(os.getenv("ROI_MAX_EXPANSION", "0.12"))   # Crecimiento máximo siguiendo líneas conectadas
+# Leyendas de la base de conocimiento: tope de bytes de recortes por solicitud y ancho de la vista general
+LEGEND_TILE_BUDGET_MB = float(os.getenv("LEGEND_TILE_BUDGET_MB", "0.2"))
+LEGEND_OVERVIEW_WIDTH = int(os.getenv("LEGEND_OVERVIEW_WIDTH", "640"))
+# Páginas repetidas dentro de una solicitud (la misma hoja en el alcance y en los planos): se renderizan, envían y guardan una vez
+PAGE_DEDUP_ENABLED = os.getenv("PAGE_DEDUP_ENABLED", "true").lower() == "true"
+# Distancia de Hamming máxima del hash perceptual (256 bits) entre hojas con el mismo texto y marcas; negativa = sólo idénticas
+PAGE_DEDUP_MAX_DISTANCE = int(os.getenv("PAGE_DEDUP_MAX_DISTANCE", "6"))
+
+# --- ESCALERA DE CODIFICACIÓN (nombre, dpi, formato, calidad) ---
+# Se prueba en orden hasta que la página cabe en el presupuesto. La paleta PNG y el
+# JPEG sin submuestreo de croma conservan las nubes rojas y el sombreado gris.
+ENCODING_LADDER = [
+    ("png8-300", 300, "png8", None),
+    ("png8-200", 200, "png8", None),
+    ("png8-150", 150, "png8", None),
+    ("jpeg90-200", 200, "jpeg", 90),
+    ("jpeg80-150", 150, "jpeg", 80),
+    ("webp80-150", 150, "webp", 80),
+    ("jpeg70-120", 120, "jpeg", 70),
+    ("webp60-100", 100, "webp", 60),
+]
+
 # --- GLOSARIO Y PROMPT ---
 GLOSARIO_DE_TERMINOS = {
    "CSO": "CAR SEAL OPEN", "CSC": "CAR SEAL CLOSE", "NO": "NORMALLY OPENED",
@@ -233,19 +341,748 @@ app = FastAPI()
 origins = ["*"] 
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+# --- INICIO: MÉTRICAS (FORMATO PROMETHEUS) ---
+# Registro en proceso de contadores e histogramas; /metrics los expone en formato de texto
+# de Prometheus junto con indicadores (gauges) que se leen al momento de la consulta.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS = tuple(64 * 1024 * 4 ** k for k in range(7)) # 64 KB ... 256 MB
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 0.5
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None):
+        self._metrics[name] = {"kind": kind, "help": help_text, "buckets": buckets, "series": {}}
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metrics[name]["series"]
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        metric = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = metric["series"].setdefault(key, {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self, gauges: List[Tuple[str, str, Dict[str, Any], float]]) -> str:
+        """Texto de exposición; gauges es una lista de (nombre, ayuda, etiquetas, valor)."""
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                for key, value in metric["series"].items():
+                    if metric["kind"] == "counter":
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+                        continue
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append(f"{name}_bucket{self._labels(key + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value['sum']:g}")
+                    lines.append(f"{name}_count{self._labels(key)} {value['count']}")
+        described = set()
+        for name, help_text, labels, value in gauges:
+            if name not in described:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} gauge")
+                described.add(name)
+            lines.append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe("pid_stage_seconds", "histogram", "Duración por etapa: render_page, stage1, stage2_batch, analysis, chat.", SECONDS_BUCKETS)
+METRICS.describe("pid_render_step_seconds", "histogram", "Duración de cada paso del renderizado de una página (text, detect, fingerprint, pixmap, encode, title_block).", SECONDS_BUCKETS)
+METRICS.describe("pid_pages_total", "counter", "Páginas procesadas por origen (render, cache, duplicate, failed).")
+METRICS.describe("pid_batch_bytes", "histogram", "Bytes de imágenes y leyendas por lote de la Etapa 2.", BYTES_BUCKETS)
+METRICS.describe("pid_azure_request_seconds", "histogram", "Duración de cada intento de llamada a Azure OpenAI por tipo.", SECONDS_BUCKETS)
+METRICS.describe("pid_azure_request_body_bytes", "histogram", "Bytes del cuerpo JSON enviado a Azure OpenAI por tipo.", BYTES_BUCKETS)
+METRICS.describe("pid_azure_responses_total", "counter", "Respuestas de Azure OpenAI por tipo y código de estado (error = fallo de red).")
+METRICS.describe("pid_tokens_total", "counter", "Tokens por tipo de llamada: prompt y completion informados por Azure, estimated_prompt estimado localmente.")
+METRICS.describe("pid_event_loop_lag_seconds", "histogram", "Retraso del bucle de eventos respecto de un temporizador periódico.", SECONDS_BUCKETS)
+METRICS.describe("pid_azure_throttled_total", "counter", "Respuestas 429 de Azure OpenAI desde el arranque.")
+METRICS.describe("pid_azure_server_errors_total", "counter", "Respuestas 5xx de Azure OpenAI desde el arranque.")
+# Series en cero desde el arranque para que rate()/increase() tengan una muestra base
+METRICS.inc("pid_azure_throttled_total", 0)
+METRICS.inc("pid_azure_server_errors_total", 0)
+EVENT_LOOP_LAG = {"last_seconds": 0.0, "max_seconds": 0.0}
+EVENT_LOOP_MONITOR_TASK: Optional[asyncio.Task] = None
+
+async def monitor_event_loop_lag():
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(0.0, time.monotonic() - started - EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        EVENT_LOOP_LAG["last_seconds"] = lag
+        EVENT_LOOP_LAG["max_seconds"] = max(EVENT_LOOP_LAG["max_seconds"], lag)
+        METRICS.observe("pid_event_loop_lag_seconds", lag)
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    # Se guarda la referencia: el bucle solo mantiene referencias débiles a las tareas
+    global EVENT_LOOP_MONITOR_TASK
+    EVENT_LOOP_MONITOR_TASK = asyncio.get_running_loop().create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_event_loop_monitor():
+    global EVENT_LOOP_MONITOR_TASK
+    if EVENT_LOOP_MONITOR_TASK is not None:
+        EVENT_LOOP_MONITOR_TASK.cancel()
+        try:
+            await EVENT_LOOP_MONITOR_TASK
+        except asyncio.CancelledError:
+            pass
+        EVENT_LOOP_MONITOR_TASK = None
+# --- FIN: MÉTRICAS ---
+
 # --- CACHE DE SESIÓN Y BASE DE CONOCIMIENTO ---
-SESSION_CACHE = {}
+class SessionStore:
+    """
+    Almacén de sesiones acotado. Cada sesión guarda sus imágenes como bytes crudos
+    ({"data", "mime_type"}; bytes o memoryview sobre la caché de renderizado, los mismos
+    buffers que referencian los payloads), su índice de páginas y el análisis. Las sesiones expiran tras SESSION_TTL_SECONDS
+    sin uso; si se supera el presupuesto de memoria, las menos usadas (LRU) se derraman
+    a disco y se recargan de forma transparente al volver a pedirlas.
+    Los métodos hacen E/S de disco: desde los endpoints se llaman con asyncio.to_thread.
+    """
+
+    def __init__(self, ttl_seconds: int, memory_budget_bytes: int, spill_dir: str, disk_budget_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.spill_dir = spill_dir
+        self.disk_budget_bytes = disk_budget_bytes
+        self.hot: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.cold: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.spills = 0
+        self.reloads = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _images_size(images: List[Dict[str, Any]]) -> int:
+        return sum(image_bytes(image) for image in images)
+
+    def create(self, session_id: str, images: List[Dict[str, Any]], index: Optional[Dict[str, Any]] = None):
+        images = [image for image in images if image] # Omitir placeholders de páginas fallidas
+        entry = {"images": images, "index": index, "analysis": None, "analysis_version": None, "bytes": self._images_size(images), "last_access": time.monotonic(),
+                 "timings": {"analysis": None, "chat": []}}
+        with self._lock:
+            self._discard(session_id)
+            self.hot[session_id] = entry
+            self.memory_bytes += entry["bytes"]
+            self._enforce_budgets()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Índice, análisis y número de páginas; las imágenes se piden aparte con get_images()."""
+        with self._lock:
+            entry = self._get_hot(session_id)
+            if entry is None:
+                return None
+            return {"page_count": len(entry["images"]), "index": entry["index"], "analysis": entry["analysis"], "analysis_version": entry["analysis_version"]}
+
+    def get_images(self, session_id: str, positions: List[int]) -> Optional[List[Dict[str, Any]]]:
+        """Imágenes de las posiciones pedidas, en ese orden."""
+        with self._lock:
+            entry = self._get_hot(session_id)
+            if entry is None:
+                return None
+            return [entry["images"][i] for i in positions]
+
+    def get_analysis(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Como get(), pero sin recargar las imágenes de una sesión derramada."""
+        with self._lock:
+            self._purge_expired()
+            entry = self.hot.get(session_id) or self.cold.get(session_id)
+            if entry is None:
+                return None
+            entry["last_access"] = time.monotonic()
+            if session_id in self.cold:
+                meta = self._read_meta(session_id)
+                return {"analysis": meta["analysis"], "analysis_version": meta.get("analysis_version")}
+            return {"analysis": entry["analysis"], "analysis_version": entry["analysis_version"]}
+
+    def set_analysis(self, session_id: str, analysis: Dict[str, Any], index: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            if session_id in self.cold:
+                self._reload(session_id)
+            entry = self.hot.get(session_id)
+            if entry is None:
+                logging.warning(f"Sesión {session_id} desalojada antes de guardar su análisis.")
+                return
+            entry["analysis"] = analysis
+            entry["analysis_version"] = uuid.uuid4().hex # Invalida los reportes exportados en caché
+            if index is not None:
+                entry["index"] = index
+
+    # Los tiempos son pequeños: viajan en la entrada fría sin tocar el disco
+    def set_timings(self, session_id: str, timings: Dict[str, Any]):
+        with self._lock:
+            entry = self.hot.get(session_id) or self.cold.get(session_id)
+            if entry is not None:
+                entry["timings"]["analysis"] = timings
+
+    def append_timing(self, session_id: str, timing: Dict[str, Any]):
+        with self._lock:
+            entry = self.hot.get(session_id) or self.cold.get(session_id)
+            if entry is not None:
+                entry["timings"]["chat"].append(timing)
+
+    def get_timings(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._purge_expired()
+            entry = self.hot.get(session_id) or self.cold.get(session_id)
+            if entry is None:
+                return None
+            return {"analysis": entry["timings"]["analysis"], "chat": list(entry["timings"]["chat"])}
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge_expired()
+
+    # Trabajos (/jobs): con un solo proceso, JOBS ya tiene todos; nada que compartir
+    def save_job(self, job_id: str, record: str, status: str, finished_at: Optional[float]):
+        pass
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def request_job_cancel(self, job_id: str) -> bool:
+        return False
+
+    def cancel_requested_jobs(self, job_ids: List[str]) -> List[str]:
+        return []
+
+    def purge_jobs(self, finished_before: float):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "hot_sessions": len(self.hot),
+                "cold_sessions": len(self.cold),
+                "memory_bytes": self.memory_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "disk_bytes": self.disk_bytes,
+                "disk_budget_bytes": self.disk_budget_bytes,
+                "spills": self.spills,
+                "reloads": self.reloads,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+    # --- Internos (requieren self._lock) ---
+    def _session_dir(self, session_id: str) -> str:
+        return os.path.join(process_scratch_dir(self.spill_dir), session_id)
+
+    def _read_meta(self, session_id: str) -> Dict[str, Any]:
+        with open(os.path.join(self._session_dir(session_id), "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _get_hot(self, session_id: str) -> Optional[Dict[str, Any]]:
+        self._purge_expired()
+        if session_id in self.cold:
+            self._reload(session_id)
+        entry = self.hot.get(session_id)
+        if entry is None:
+            return None
+        entry["last_access"] = time.monotonic()
+        self.hot.move_to_end(session_id)
+        self._enforce_budgets(keep=session_id)
+        return entry
+
+    def _discard(self, session_id: str):
+        entry = self.hot.pop(session_id, None)
+        if entry is not None:
+            self.memory_bytes -= entry["bytes"]
+        entry = self.cold.pop(session_id, None)
+        if entry is not None:
+            self.disk_bytes -= entry["bytes"]
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def _purge_expired(self):
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = [sid for sid, entry in (*self.hot.items(), *self.cold.items()) if entry["last_access"] < deadline]
+        for session_id in expired:
+            self._discard(session_id)
+            self.expirations += 1
+
+    def _spill(self, session_id: str) -> bool:
+        entry = self.hot[session_id]
+        session_dir = self._session_dir(session_id)
+        try:
+            os.makedirs(session_dir, exist_ok=True)
+            images_meta = []
+            for i, image in enumerate(entry["images"]):
+                with open(os.path.join(session_dir, f"{i}.bin"), "wb") as f:
+                    f.write(image["data"])
+                # Todas las claves salvo los bytes (sources, plano_page, encoding...), como SqliteSessionStore
+                image_meta = {key: value for key, value in image.items() if key not in ("data", "tiles")}
+                image_meta["blob"] = f"{i}.bin"
+                image_meta["tiles"] = []
+                for k, tile in enumerate(image.get("tiles", [])):
+                    with open(os.path.join(session_dir, f"{i}_{k}.bin"), "wb") as f:
+                        f.write(tile["data"])
+                    image_meta["tiles"].append({**{key: value for key, value in tile.items() if key != "data"}, "blob": f"{i}_{k}.bin"})
+                images_meta.append(image_meta)
+            with open(os.path.join(session_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"analysis": entry["analysis"], "analysis_version": entry["analysis_version"], "index": entry["index"], "images": images_meta}, f)
+        except OSError as e:
+            logging.error(f"No se pudo derramar la sesión {session_id} a disco: {e}")
+            shutil.rmtree(session_dir, ignore_errors=True)
+            return False
+        del self.hot[session_id]
+        self.memory_bytes -= entry["bytes"]
+        self.cold[session_id] = {"bytes": entry["bytes"], "last_access": entry["last_access"], "timings": entry["timings"]}
+        self.disk_bytes += entry["bytes"]
+        self.spills += 1
+        return True
+
+    def _reload(self, session_id: str):
+        cold_entry = self.cold.pop(session_id)
+        self.disk_bytes -= cold_entry["bytes"]
+        session_dir = self._session_dir(session_id)
+        try:
+            meta = self._read_meta(session_id)
+            images = []
+            for image_meta in meta["images"]:
+                image = {key: value for key, value in image_meta.items() if key not in ("blob", "tiles")}
+                with open(os.path.join(session_dir, image_meta["blob"]), "rb") as f:
+                    image["data"] = f.read()
+                tiles = []
+                for tile_meta in image_meta.get("tiles", []):
+                    tile = {key: value for key, value in tile_meta.items() if key != "blob"}
+                    with open(os.path.join(session_dir, tile_meta["blob"]), "rb") as f:
+                        tile["data"] = f.read()
+                    tiles.append(tile)
+                if tiles:
+                    image["tiles"] = tiles
+                images.append(image)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"No se pudo recargar la sesión {session_id} desde disco: {e}")
+            return
+        finally:
+            shutil.rmtree(session_dir, ignore_errors=True)
+        self.hot[session_id] = {"images": images, "index": meta.get("index"), "analysis": meta["analysis"], "analysis_version": meta.get("analysis_version"),
+                                "bytes": cold_entry["bytes"], "last_access": cold_entry["last_access"], "timings": cold_entry["timings"]}
+        self.memory_bytes += cold_entry["bytes"]
+        self.reloads += 1
+
+    def _enforce_budgets(self, keep: Optional[str] = None):
+        # 1. Memoria: derramar a disco las sesiones menos usadas
+        for session_id in list(self.hot):
+            if self.memory_bytes <= self.memory_budget_bytes:
+                break
+            if session_id == keep:
+                continue
+            if not self._spill(session_id):
+                self._discard(session_id)
+                self.evictions += 1
+        # 2. Disco: desalojar definitivamente las sesiones frías más antiguas
+        while self.disk_bytes > self.disk_budget_bytes and self.cold:
+            self._discard(next(iter(self.cold)))
+            self.evictions += 1
+
+
+class SqliteSessionStore:
+    """
+    Almacén de sesiones en un archivo SQLite que comparten todos los procesos que lo abren,
+    con la misma interfaz que SessionStore. El análisis, el índice y los tiempos se guardan
+    como JSON; las imágenes, como blobs direccionados por contenido (SHA-256) que se comparten
+    entre sesiones con las mismas páginas. Las sesiones expiran tras ttl_seconds sin uso (reloj
+    de pared: lo leen varios procesos) y, sobre disk_budget_bytes, se desalojan las menos usadas.
+    También guarda el estado de los trabajos de /jobs, para que cualquier worker los atienda.
+    Cada hilo usa su propia conexión; desde los endpoints se llama con asyncio.to_thread.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, images TEXT NOT NULL, page_index TEXT, analysis TEXT, "
+        "analysis_version TEXT, timings TEXT NOT NULL, bytes INTEGER NOT NULL, last_access REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)",
+        "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS session_blobs (session_id TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (session_id, digest))",
+        "CREATE INDEX IF NOT EXISTS session_blobs_digest ON session_blobs (digest)",
+        # Total de bytes en blobs, mantenido en cada alta y baja: el presupuesto no recorre la tabla
+        "CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), blob_bytes INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO usage (id, blob_bytes) SELECT 0, COALESCE(SUM(size), 0) FROM blobs",
+        "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, record TEXT NOT NULL, status TEXT NOT NULL, finished_at REAL, "
+        "cancel_requested INTEGER NOT NULL DEFAULT 0)",
+    )
+    QUERY_CHUNK = 500 # Parámetros por consulta IN (...): SQLite antiguos admiten 999
+    TOUCH_INTERVAL_SECONDS = 60.0 # last_access se reescribe como mucho una vez por intervalo
+
+    def __init__(self, path: str, ttl_seconds: int, disk_budget_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.disk_budget_bytes = disk_budget_bytes
+        self.touch_interval_seconds = min(self.TOUCH_INTERVAL_SECONDS, ttl_seconds / 10)
+        self.expirations = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # La conexión se asocia al PID: un proceso hijo (fork) abre la suya
+        cached = getattr(self._local, "connection", None)
+        if cached is not None and cached[0] == os.getpid():
+            return cached[1]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA auto_vacuum=INCREMENTAL") # Sólo tiene efecto al crear el archivo
+        connection.execute("PRAGMA journal_mode=WAL") # Lectores y un escritor a la vez, entre procesos
+        connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        self._local.connection = (os.getpid(), connection)
+        return connection
+
+    @contextmanager
+    def _transaction(self, write: bool = True):
+        """BEGIN IMMEDIATE para escribir (toma el bloqueo de escritura al empezar); BEGIN para leer una instantánea consistente."""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _store_blob(blobs: Dict[str, Any], data) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        blobs[digest] = data
+        return digest
+
+    def _chunks(self, values: List[Any]):
+        for start in range(0, len(values), self.QUERY_CHUNK):
+            chunk = values[start:start + self.QUERY_CHUNK]
+            yield chunk, ",".join("?" * len(chunk))
+
+    def _cutoff(self) -> float:
+        return time.time() - self.ttl_seconds
+
+    def _touch(self, session_id: str, last_access: float):
+        # Cada lectura no abre una escritura: basta con refrescar el TTL de vez en cuando
+        now = time.time()
+        if now - last_access < self.touch_interval_seconds:
+            return
+        self._connect().execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+
+    def _read_session(self, session_id: str, columns: str) -> Optional[Tuple]:
+        """Fila vigente de la sesión con last_access como última columna, y refresca su TTL."""
+        row = self._connect().execute(f"SELECT {columns}, last_access FROM sessions WHERE session_id = ? AND last_access >= ?",
+                                      (session_id, self._cutoff())).fetchone()
+        if row is not None:
+            self._touch(session_id, row[-1])
+        return row
+
+    def create(self, session_id: str, images: List[Dict[str, Any]], index: Optional[Dict[str, Any]] = None):
+        images = [image for image in images if image] # Omitir placeholders de páginas fallidas
+        images_meta, blobs = [], {}
+        for image in images:
+            image_meta = {key: value for key, value in image.items() if key not in ("data", "tiles")}
+            image_meta["digest"] = self._store_blob(blobs, image["data"])
+            if image.get("tiles"):
+                image_meta["tiles"] = [{**{key: value for key, value in tile.items() if key != "data"}, "digest": self._store_blob(blobs, tile["data"])}
+                                       for tile in image["tiles"]]
+            images_meta.append(image_meta)
+        timings = {"analysis": None, "chat": []}
+        with self._transaction() as connection:
+            self._delete_session(connection, session_id) # Un session_id repetido reemplaza al anterior
+            existing = set()
+            for chunk, placeholders in self._chunks(list(blobs)):
+                existing.update(row[0] for row in connection.execute(f"SELECT digest FROM blobs WHERE digest IN ({placeholders})", chunk))
+            new_blobs = [(digest, data, len(data)) for digest, data in blobs.items() if digest not in existing]
+            connection.executemany("INSERT INTO blobs (digest, data, size) VALUES (?, ?, ?)", new_blobs)
+            self._add_blob_bytes(connection, sum(size for _, _, size in new_blobs))
+            connection.executemany("INSERT INTO session_blobs (session_id, digest) VALUES (?, ?)", [(session_id, digest) for digest in blobs])
+            connection.execute("INSERT INTO sessions (session_id, images, page_index, analysis, analysis_version, timings, bytes, last_access) "
+                               "VALUES (?, ?, ?, NULL, NULL, ?, ?, ?)",
+                               (session_id, json.dumps(images_meta), json.dumps(index), json.dumps(timings), SessionStore._images_size(images), time.time()))
+            self._enforce_budget(connection, keep=session_id)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Índice, análisis y número de páginas, sin leer ningún blob: get_images() trae sólo las páginas que se usan."""
+        row = self._read_session(session_id, "images, page_index, analysis, analysis_version")
+        if row is None:
+            return None
+        return {"page_count": len(json.loads(row[0])), "index": json.loads(row[1]), "analysis": json.loads(row[2]) if row[2] else None, "analysis_version": row[3]}
+
+    def get_images(self, session_id: str, positions: List[int]) -> Optional[List[Dict[str, Any]]]:
+        """Imágenes de las posiciones pedidas, en ese orden; sólo se leen sus blobs."""
+        with self._transaction(write=False) as connection:
+            row = connection.execute("SELECT images, last_access FROM sessions WHERE session_id = ? AND last_access >= ?",
+                                     (session_id, self._cutoff())).fetchone()
+            if row is None:
+                return None
+            all_meta = json.loads(row[0])
+            images_meta = [all_meta[i] for i in positions]
+            digests = list({meta["digest"] for meta in images_meta} | {tile["digest"] for meta in images_meta for tile in meta.get("tiles", [])})
+            data = {}
+            for chunk, placeholders in self._chunks(digests):
+                data.update(connection.execute(f"SELECT digest, data FROM blobs WHERE digest IN ({placeholders})", chunk))
+        self._touch(session_id, row[1])
+        images = []
+        for meta in images_meta:
+            image = {key: value for key, value in meta.items() if key not in ("digest", "tiles")}
+            image["data"] = data[meta["digest"]]
+            if meta.get("tiles"):
+                image["tiles"] = [{**{key: value for key, value in tile.items() if key != "digest"}, "data": data[tile["digest"]]} for tile in meta["tiles"]]
+            images.append(image)
+        return images
+
+    def get_analysis(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Como get(), pero sin el índice ni la lista de imágenes."""
+        row = self._read_session(session_id, "analysis, analysis_version")
+        if row is None:
+            return None
+        return {"analysis": json.loads(row[0]) if row[0] else None, "analysis_version": row[1]}
+
+    def set_analysis(self, session_id: str, analysis: Dict[str, Any], index: Optional[Dict[str, Any]] = None):
+        with self._transaction() as connection:
+            # analysis_version nueva: invalida los reportes exportados en caché en todos los procesos
+            updated = connection.execute("UPDATE sessions SET analysis = ?, analysis_version = ?, page_index = COALESCE(?, page_index) WHERE session_id = ?",
+                                         (json.dumps(analysis), uuid.uuid4().hex, json.dumps(index) if index is not None else None, session_id)).rowcount
+        if not updated:
+            logging.warning(f"Sesión {session_id} desalojada antes de guardar su análisis.")
+
+    def _update_timings(self, session_id: str, update):
+        with self._transaction() as connection:
+            row = connection.execute("SELECT timings FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return
+            timings = json.loads(row[0])
+            update(timings)
+            connection.execute("UPDATE sessions SET timings = ? WHERE session_id = ?", (json.dumps(timings), session_id))
+
+    def set_timings(self, session_id: str, timings: Dict[str, Any]):
+        self._update_timings(session_id, lambda stored: stored.update(analysis=timings))
+
+    def append_timing(self, session_id: str, timing: Dict[str, Any]):
+        self._update_timings(session_id, lambda stored: stored["chat"].append(timing))
+
+    def get_timings(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT timings FROM sessions WHERE session_id = ? AND last_access >= ?",
+                                      (session_id, self._cutoff())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def purge_expired(self):
+        with self._transaction() as connection:
+            expired = connection.execute("DELETE FROM sessions WHERE last_access < ?", (self._cutoff(),)).rowcount
+            if expired:
+                self._delete_orphans(connection)
+        if expired:
+            with self._lock:
+                self.expirations += expired
+            self._connect().execute("PRAGMA incremental_vacuum")
+
+    # --- Trabajos (/jobs): el worker que lo ejecuta publica cada cambio; cualquiera lo lee ---
+    def save_job(self, job_id: str, record: str, status: str, finished_at: Optional[float]):
+        # cancel_requested no se pisa: lo escribe otro worker con request_job_cancel()
+        self._connect().execute("INSERT INTO jobs (job_id, record, status, finished_at) VALUES (?, ?, ?, ?) "
+                                "ON CONFLICT (job_id) DO UPDATE SET record = excluded.record, status = excluded.status, finished_at = excluded.finished_at",
+                                (job_id, record, status, finished_at))
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT record, cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        job["cancel_requested"] = bool(row[1])
+        return job
+
+    def request_job_cancel(self, job_id: str) -> bool:
+        """Marca el trabajo para que el worker que lo ejecuta lo cancele; False si ya terminó o no existe."""
+        placeholders = ",".join("?" * len(JOB_FINAL_STATES))
+        return self._connect().execute(f"UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status NOT IN ({placeholders})",
+                                       (job_id, *JOB_FINAL_STATES)).rowcount > 0
+
+    def cancel_requested_jobs(self, job_ids: List[str]) -> List[str]:
+        cancelled = []
+        for chunk, placeholders in self._chunks(job_ids):
+            cancelled.extend(row[0] for row in self._connect().execute(
+                f"SELECT job_id FROM jobs WHERE cancel_requested = 1 AND job_id IN ({placeholders})", chunk))
+        return cancelled
+
+    def purge_jobs(self, finished_before: float):
+        self._connect().execute("DELETE FROM jobs WHERE finished_at < ?", (finished_before,))
+
+    def stats(self) -> Dict[str, Any]:
+        connection = self._connect()
+        sessions, session_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        blobs = connection.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        blob_bytes = self._blob_bytes(connection)
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "hot_sessions": 0, # Ninguna sesión se retiene en la memoria del proceso
+            "cold_sessions": sessions,
+            "memory_bytes": 0,
+            "disk_bytes": blob_bytes,
+            "disk_budget_bytes": self.disk_budget_bytes,
+            "blobs": blobs,
+            "deduplicated_bytes": max(0, session_bytes - blob_bytes),
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+        }
+
+    # --- Internos (dentro de una transacción de escritura) ---
+    @staticmethod
+    def _blob_bytes(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT blob_bytes FROM usage WHERE id = 0").fetchone()[0]
+
+    @staticmethod
+    def _add_blob_bytes(connection: sqlite3.Connection, delta: int):
+        if delta:
+            connection.execute("UPDATE usage SET blob_bytes = blob_bytes + ? WHERE id = 0", (delta,))
+
+    def _delete_orphans(self, connection: sqlite3.Connection):
+        connection.execute("DELETE FROM session_blobs WHERE session_id NOT IN (SELECT session_id FROM sessions)")
+        orphan = "NOT EXISTS (SELECT 1 FROM session_blobs WHERE session_blobs.digest = blobs.digest)"
+        freed = connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM blobs WHERE {orphan}").fetchone()[0]
+        connection.execute(f"DELETE FROM blobs WHERE {orphan}")
+        self._add_blob_bytes(connection, -freed)
+
+    def _delete_session(self, connection: sqlite3.Connection, session_id: str) -> int:
+        """Borra la sesión y los blobs que sólo ella usaba; devuelve los bytes liberados."""
+        digests = [row[0] for row in connection.execute("SELECT digest FROM session_blobs WHERE session_id = ?", (session_id,))]
+        connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        connection.execute("DELETE FROM session_blobs WHERE session_id = ?", (session_id,))
+        freed = 0
+        for chunk, placeholders in self._chunks(digests):
+            orphan = f"digest IN ({placeholders}) AND NOT EXISTS (SELECT 1 FROM session_blobs WHERE session_blobs.digest = blobs.digest)"
+            freed += connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM blobs WHERE {orphan}", chunk).fetchone()[0]
+            connection.execute(f"DELETE FROM blobs WHERE {orphan}", chunk)
+        self._add_blob_bytes(connection, -freed)
+        return freed
+
+    def _enforce_budget(self, connection: sqlite3.Connection, keep: str):
+        """Desaloja las sesiones menos usadas hasta que los blobs caben en disk_budget_bytes."""
+        blob_bytes = self._blob_bytes(connection)
+        while blob_bytes > self.disk_budget_bytes:
+            oldest = connection.execute("SELECT session_id FROM sessions WHERE session_id != ? ORDER BY last_access LIMIT 1", (keep,)).fetchone()
+            if oldest is None:
+                break
+            blob_bytes -= self._delete_session(connection, oldest[0])
+            with self._lock:
+                self.evictions += 1
+
+
+def process_scratch_dir(base: str) -> str:
+    """Subdirectorio de base propio de este proceso: con varios workers, cada uno limpia sólo lo suyo."""
+    return os.path.join(base, str(os.getpid()))
+
+
+def remove_stale_scratch_dirs(base: str):
+    """Borra lo que dejaron ejecuciones anteriores y workers que ya no existen; respeta el de otros workers vivos."""
+    try:
+        entries = os.listdir(base)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.isdigit() and int(entry) != os.getpid():
+            try:
+                os.kill(int(entry), 0)
+                continue # El proceso sigue vivo
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+        path = os.path.join(base, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def make_session_store(kind: str):
+    if kind == "sqlite":
+        return SqliteSessionStore(SESSION_SQLITE_PATH, ttl_seconds=SESSION_TTL_SECONDS, disk_budget_bytes=int(SESSION_DISK_BUDGET_MB * 1024 * 1024))
+    if kind != "memory":
+        logging.warning(f"SESSION_BACKEND desconocido: '{kind}'; se usa 'memory'.")
+    return SessionStore(
+        ttl_seconds=SESSION_TTL_SECONDS,
+        memory_budget_bytes=int(SESSION_MEMORY_BUDGET_MB * 1024 * 1024),
+        spill_dir=SESSION_SPILL_DIR,
+        disk_budget_bytes=int(SESSION_DISK_BUDGET_MB * 1024 * 1024),
+    )
+
+
+SESSION_STORE = make_session_store(SESSION_BACKEND)
 
 # --- INICIO: CONFIGURACIÓN DE BLOB STORAGE (MODIFICADO) ---
 STORAGE_ACCOUNT_URL = os.getenv("STORAGE_ACCOUNT_URL") 
 CONTAINER_NAME = "pid-ratings"  
 BLOB_NAME = "ratings_log.csv"   
+# Calificaciones: "blob" (append blob en STORAGE_ACCOUNT_URL) o "local" (archivo de sólo-anexado, para pruebas y uso sin conexión)
+RATINGS_BACKEND = os.getenv("RATINGS_BACKEND", "blob")
+RATINGS_LOCAL_PATH = os.getenv("RATINGS_LOCAL_PATH", os.path.join(tempfile.gettempdir(), BLOB_NAME))
+# Las calificaciones se encolan y un proceso de fondo las escribe agrupadas en un solo append
+RATINGS_QUEUE_MAX = int(os.getenv("RATINGS_QUEUE_MAX", "1000"))
+RATINGS_FLUSH_INTERVAL_SECONDS = float(os.getenv("RATINGS_FLUSH_INTERVAL_SECONDS", "2.0"))
+RATINGS_FLUSH_MAX_ROWS = int(os.getenv("RATINGS_FLUSH_MAX_ROWS", "500"))
+RATINGS_SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv("RATINGS_SHUTDOWN_TIMEOUT_SECONDS", "10.0"))
+# Lectura incremental: intervalo mínimo entre consultas al almacenamiento y tamaño máximo de página de /get_ratings
+RATINGS_REFRESH_MIN_SECONDS = float(os.getenv("RATINGS_REFRESH_MIN_SECONDS", "2.0"))
+RATINGS_PAGE_MAX = int(os.getenv("RATINGS_PAGE_MAX", "1000"))
 
 credential = DefaultAzureCredential()
 # --- FIN: CONFIGURACIÓN DE BLOB STORAGE ---
 
-KNOWLEDGE_BASE_URLS = []
-KNOWLEDGE_BASE_SIZE_BYTES = 0
+SESSION_PURGER_TASK: Optional[asyncio.Task] = None
+
+async def purge_sessions_periodically():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await asyncio.to_thread(SESSION_STORE.purge_expired)
+        except Exception as e:
+            # Un fallo puntual (disco, SQLite bloqueado) no debe detener las purgas siguientes
+            logging.error(f"Error al purgar sesiones expiradas: {e}", exc_info=True)
+
+@app.on_event("startup")
+async def start_session_purger():
+    global SESSION_PURGER_TASK
+    # Las sesiones derramadas de una ejecución anterior no tienen índice: se eliminan
+    remove_stale_scratch_dirs(SESSION_SPILL_DIR)
+    # Igual con las subidas que quedaron a medio procesar (las de otros workers vivos se conservan)
+    remove_stale_scratch_dirs(UPLOAD_SPOOL_DIR)
+    # Se guarda la referencia: el bucle solo mantiene referencias débiles a las tareas
+    SESSION_PURGER_TASK = asyncio.get_running_loop().create_task(purge_sessions_periodically())
+
+@app.on_event("shutdown")
+async def stop_session_purger():
+    global SESSION_PURGER_TASK
+    if SESSION_PURGER_TASK is not None:
+        SESSION_PURGER_TASK.cancel()
+        try:
+            await SESSION_PURGER_TASK
+        except asyncio.CancelledError:
+            pass
+        SESSION_PURGER_TASK = None
 
 # --- MODELO DE RATING MODIFICADO ---
 class RatingRequest(BaseModel):
@@ -254,539 +1091,3655 @@ class RatingRequest(BaseModel):
     comment: Optional[str] = None
     tiempo_ahorrado: Optional[str] = None # <--- AÑADIDO
 
-def get_base64_size_bytes(data_url: str) -> int:
-    base64_string = data_url.split(",")[1]
-    return (len(base64_string) * 3) / 4
+# --- INICIO: ÍNDICE DE LEYENDAS (BASE DE CONOCIMIENTO) ---
+# Secciones de cada lámina de leyenda: caja normalizada (x0, y0, x1, y1), términos del
+# GLOSARIO_DE_TERMINOS que cubre y palabras clave/prefijos de tag que la hacen relevante.
+# Una lámina sin disposición conocida se indexa como un único recorte sin palabras clave.
+LEGEND_LAYOUTS = {
+    "simbolos.jpg": [
+        {"name": "EQUIPMENT SYMBOLS", "box": (0.03, 0.06, 0.352, 0.881),
+         "terms": ["Diaphragm Pump", "Basket Strainer", "Cone Roof Tank", "Concrete Pit", "Air Cooler", "Hairpin/U-Tube Exchanger",
+                   "Gas/Diesel Engine", "Horizontal Vessel", "Vertical Vessel", "Flare", "Bulk Drum"],
+         "keywords": ["PUMP", "BOMBA", "COMPRESSOR", "EXCHANGER", "VESSEL", "TANK", "HEATER", "MIXER", "FILTER", "MOTOR", "SCRAPPER", "DRUM"]},
+        {"name": "PIPING LINE IDENTIFICATION", "box": (0.352, 0.06, 0.567, 0.137),
+         "terms": ["Package Unit / Skid"],
+         "keywords": ["PROCESS LINE", "INSULATED", "SKID"]},
+        {"name": "PIPING FITTINGS / SPECIALTY ITEMS", "box": (0.352, 0.137, 0.567, 0.444),
+         "terms": ["Spectacle Blind (Normally Open)", "Spectacle Blind (Normally Closed)", "Connecting Reducer", "Eccentric Reducer",
+                   "Silencer (Vent to Atmosphere)", "Screwed Cap", "Weld Cap", "Thief Hatch", "Blind Flange", "Ejector/Eductor"],
+         "keywords": ["BLIND", "REDUCER", "STRAINER", "FLANGE", "EXPANSION JOINT", "RUPTURE", "ARRESTOR", "PSE", "RO"]},
+        {"name": "FLOW ELEMENT SYMBOLS", "box": (0.352, 0.444, 0.567, 0.729),
+         "terms": ["Vortex Flowmeter", "Ultrasonic Flowmeter", "In-line Flowmeter", "Positive Displacement Flowmeter", "Turbine/Propeller Meter",
+                   "Orifice Plate", "Flow Glass / Sight Glass", "Rotameter", "Flow Switch", "Magnetic (Flow)", "Ultrasonic (Flow)",
+                   "Averaging Pitot Tube", "Flow Nozzle", "Venturi", "Wedge Meter", "Flume", "Orifice in Quick Change Fitting", "Target (Flow)"],
+         "keywords": ["FE", "FT", "FI", "FG", "FS", "FQ", "FIT", "FQI", "FLOWMETER", "ORIFICE"]},
+        {"name": "OTHER SYMBOLS", "box": (0.352, 0.729, 0.567, 0.881),
+         "terms": ["Utility Station", "Tie-in", "Line Number Change", "AG", "UG"],
+         "keywords": ["TIE-IN", "SAFETY SHOWER", "DRAIN", "US", "SS"]},
+        {"name": "INSTRUMENT IDENTIFICATION", "box": (0.567, 0.06, 0.745, 0.673),
+         "terms": ["CONFIGURED ALARMS", "Integral Interlock", "Radar Tank Gauge", "HH", "LL", "DCS"],
+         "keywords": ["INTERLOCK", "ALARM", "PT", "PI", "PIT", "LT", "LI", "LIT", "TT", "TI", "TIT", "PDT", "PDI", "AT", "AIT", "LG"]},
+        {"name": "VESSEL INTERNALS", "box": (0.567, 0.673, 0.745, 0.881),
+         "terms": ["Demister", "Packing"],
+         "keywords": ["TRAY"]},
+        {"name": "VALVE SYMBOLS", "box": (0.745, 0.06, 0.997, 0.676),
+         "terms": ["Spring Diaphragm Actuator", "On/Off Actuator", "Adjustable Choke (Angle Body)", "Adjustable Choke (In-line)",
+                   "Fixed Bean Choke", "Fixed Choke (Angle Body)", "Block and Bleed Valve", "Check Valve", "Stop Check Valve",
+                   "Solenoid Valve (Manual/Electric Reset)", "CSO", "CSC", "MOV", "FP"],
+         "keywords": ["VALVE", "PSV", "PCV", "LCV", "FCV", "TCV", "PRV", "PVSV", "HV", "XV", "SDV", "BDV", "CHOKE"]},
+        {"name": "TEST OVERRIDE FACILITY / VALVE IDENTIFICATION", "box": (0.745, 0.676, 0.997, 0.881),
+         "terms": ["ZSC", "ZSO", "XOXV"],
+         "keywords": ["BA", "BF", "BV", "CK", "GA", "GL", "XXV", "OVERRIDE"]},
+    ],
+    "terminos.jpg": [
+        {"name": "REFERENCE MATRIX FOR INSTRUMENT IDENTIFICATION", "box": (0.03, 0.06, 0.531, 0.534),
+         "terms": ["HH", "LL"],
+         "keywords": ["PT", "PI", "PIT", "PIC", "LT", "LI", "LIT", "LIC", "TT", "TI", "TIT", "TIC", "FIC", "AT", "AI", "PSH", "PSL", "LSH", "LSL", "TSH", "TSL"]},
+        {"name": "ISA DESCRIPTORS / ADDITIONAL DESCRIPTORS", "box": (0.03, 0.534, 0.369, 0.881),
+         "terms": ["S/S", "BOV", "DHSV", "MOV", "SOV", "ZSC", "ZSO", "XOXV"],
+         "keywords": ["XV", "XXV", "HSS", "XIS", "XA", "XAC", "XSA", "XP", "DSM", "OE", "WV", "MV", "SOY", "BOY", "DCG", "DFL"]},
+        {"name": "SPECIAL IDENTIFICATION LETTERS", "box": (0.369, 0.534, 0.531, 0.881),
+         "terms": ["ASC", "CCP", "DCS", "D/P", "ESD", "LSC", "PLC", "PSD", "SCADA", "USO", "BMS", "CCS", "CEMS", "MMS", "SIS", "VMS", "MDC"],
+         "keywords": ["EAS", "LOR", "PFC", "SCF", "TSO", "DCF"]},
+        {"name": "SPECIALITY PIPING ITEM CODES", "box": (0.531, 0.06, 0.729, 0.486),
+         "terms": [],
+         "keywords": ["SP", "SPECIALITY", "SPECIALTY", "INJECTION QUILL", "CORROSION"]},
+        {"name": "FIRE PROTECTION SYMBOLS", "box": (0.729, 0.06, 0.997, 0.486),
+         "terms": [],
+         "keywords": ["FIRE", "HYDRANT", "DELUGE", "SPRINKLER", "FOAM", "NOZZLE", "MONITOR"]},
+    ],
+}
+
+LEGEND_TOKEN_PATTERN = re.compile(r"[A-Z0-9/]+")
+
+
+def legend_tokens(text: str) -> Tuple[set, str]:
+    """Tokens en mayúsculas y texto normalizado (espacios simples) para buscar términos de leyenda."""
+    upper = " ".join(text.upper().split())
+    return set(LEGEND_TOKEN_PATTERN.findall(upper)), upper
+
+
+class LegendIndex:
+    """
+    Índice de leyendas construido al arrancar: cada lámina de knowledge_base se divide en
+    recortes por sección, enlazados a sus términos del glosario. Cada solicitud recibe sólo
+    los recortes cuyos términos o tags aparecen en la capa de texto de los planos, más una
+    vista general reducida de todas las láminas como respaldo.
+    """
+
+    def __init__(self, tile_budget_bytes: int, overview_width: int):
+        self.tile_budget_bytes = tile_budget_bytes
+        self.overview_width = overview_width
+        self.tiles: List[Dict[str, Any]] = []
+        self.overview: List[Dict[str, Any]] = []
+        self.source_bytes = 0
+        self.selections = 0
+        self.tiles_sent = 0
+
+    @staticmethod
+    def _encode(image: Image.Image, quality: int) -> bytes:
+        buffer = BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    def load(self, kb_folder: str):
+        for filename in sorted(os.listdir(kb_folder)):
+            if not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                continue
+            try:
+                filepath = os.path.join(kb_folder, filename)
+                self.source_bytes += os.path.getsize(filepath)
+                with Image.open(filepath) as legend:
+                    legend.load()
+                    width, height = legend.size
+                    layout = LEGEND_LAYOUTS.get(filename.lower()) or [{"name": filename, "box": (0.0, 0.0, 1.0, 1.0), "terms": [], "keywords": []}]
+                    for section in layout:
+                        x0, y0, x1, y1 = section["box"]
+                        tile = legend.crop((int(x0 * width), int(y0 * height), int(x1 * width), int(y1 * height)))
+                        terms = [term for term in section["terms"] if term in GLOSARIO_DE_TERMINOS]
+                        # Las abreviaturas de una o dos letras (H, L, NO...) aparecen en cualquier texto: no activan recortes
+                        keywords = {keyword.upper() for keyword in section["keywords"]} | {term.upper() for term in terms if len(term) > 2}
+                        self.tiles.append({
+                            "name": section["name"],
+                            "source": filename,
+                            "terms": terms,
+                            "tokens": {keyword for keyword in keywords if LEGEND_TOKEN_PATTERN.fullmatch(keyword)},
+                            "phrases": {keyword for keyword in keywords if not LEGEND_TOKEN_PATTERN.fullmatch(keyword)},
+                            "data": self._encode(tile, 80),
+                            "mime_type": "image/jpeg",
+                        })
+                    scale = min(1.0, self.overview_width / width)
+                    overview = legend.resize((int(width * scale), int(height * scale)), Image.LANCZOS)
+                    self.overview.append({"source": filename, "data": self._encode(overview, 60), "mime_type": "image/jpeg"})
+                logging.info(f"Procesado archivo de conocimiento: {filename} ({len(layout)} recorte(s))")
+            except Exception as e:
+                logging.error(f"Error al cargar el archivo de conocimiento {filename}: {e}")
+
+    @property
+    def overview_bytes(self) -> int:
+        return sum(len(image["data"]) for image in self.overview)
+
+    def reserved_bytes(self) -> int:
+        """Bytes que se reservan en cada lote: vista general más el tope de recortes."""
+        return self.overview_bytes + min(self.tile_budget_bytes, sum(len(tile["data"]) for tile in self.tiles))
+
+    def reserved_tokens(self) -> int:
+        """Tokens que se reservan en cada lote: vista general más los recortes más caros que caben en el tope de bytes."""
+        tokens = sum(image_tokens_of(image) for image in self.overview)
+        used_bytes = 0
+        for tile in sorted(self.tiles, key=lambda tile: -image_tokens_of(tile)):
+            if used_bytes + len(tile["data"]) <= self.tile_budget_bytes:
+                used_bytes += len(tile["data"])
+                tokens += image_tokens_of(tile) + 100 # Etiqueta con los términos del glosario
+        return tokens
+
+    def select(self, text: str) -> List[Dict[str, Any]]:
+        """Recortes relevantes para el texto dado, por número de coincidencias, sin superar el tope de bytes."""
+        tokens, normalized = legend_tokens(text)
+        scored = []
+        for i, tile in enumerate(self.tiles):
+            score = len(tile["tokens"] & tokens) + sum(1 for phrase in tile["phrases"] if phrase in normalized)
+            if score:
+                scored.append((-score, i, tile))
+        selected, used_bytes = [], 0
+        for _, _, tile in sorted(scored):
+            if used_bytes + len(tile["data"]) > self.tile_budget_bytes:
+                continue
+            selected.append(tile)
+            used_bytes += len(tile["data"])
+        self.selections += 1
+        self.tiles_sent += len(selected)
+        return selected
+
+    def content(self, text: str) -> List[Dict[str, Any]]:
+        """Bloques de mensaje con la vista general y los recortes relevantes, cada uno con sus términos del glosario."""
+        if not self.overview:
+            return []
+        content = [{"type": "text", "text": "--- INICIO: BASE DE CONOCIMIENTO ---"}]
+        content.append({"type": "text", "text": "Vista general de las láminas de leyenda (resolución reducida):"})
+        content.extend([image_content(image) for image in self.overview])
+        for tile in self.select(text):
+            terms = "; ".join(f"{term}: {GLOSARIO_DE_TERMINOS[term]}" for term in tile["terms"])
+            label = f"Leyenda '{tile['name']}' ({tile['source']})" + (f". Términos: {terms}" if terms else "")
+            content.append({"type": "text", "text": label})
+            content.append(image_content(tile))
+        content.append({"type": "text", "text": "--- FIN: BASE DE CONOCIMIENTO ---"})
+        return content
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tiles": len(self.tiles),
+            "tile_bytes": sum(len(tile["data"]) for tile in self.tiles),
+            "overview_bytes": self.overview_bytes,
+            "source_bytes": self.source_bytes,
+            "reserved_bytes": self.reserved_bytes(),
+            "selections": self.selections,
+            "avg_tiles_per_selection": round(self.tiles_sent / self.selections, 2) if self.selections else 0.0,
+        }
+
+
+LEGEND_INDEX = LegendIndex(tile_budget_bytes=int(LEGEND_TILE_BUDGET_MB * 1024 * 1024), overview_width=LEGEND_OVERVIEW_WIDTH)
 
 @app.on_event("startup")
 async def load_knowledge_base():
-    # ... (Tu código de load_knowledge_base no cambia) ...
-    global KNOWLEDGE_BASE_SIZE_BYTES
     logging.info("Iniciando carga de la base de conocimiento (archivos de imagen)...")
     kb_folder = "knowledge_base"
     if not os.path.isdir(kb_folder):
         logging.warning(f"La carpeta de la base de conocimiento '{kb_folder}' no existe.")
         return
-    for filename in os.listdir(kb_folder):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            try:
-                filepath = os.path.join(kb_folder, filename)
-                with open(filepath, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                    mime_type = "image/jpeg" if filename.lower().endswith(('.jpg', '.jpeg')) else "image/png"
-                    data_url = f"data:{mime_type};base64,{encoded_string}"
-                    KNOWLEDGE_BASE_URLS.append(data_url)
-                    KNOWLEDGE_BASE_SIZE_BYTES += get_base64_size_bytes(data_url)
-                logging.info(f"Procesado archivo de conocimiento: {filename}")
-            except Exception as e:
-                logging.error(f"Error al cargar el archivo de conocimiento {filename}: {e}")
-    if KNOWLEDGE_BASE_URLS:
-        logging.info(f"Base de conocimiento cargada con {len(KNOWLEDGE_BASE_URLS)} imágenes. Tamaño total: {KNOWLEDGE_BASE_SIZE_BYTES / 1024 / 1024:.2f} MB")
+    await asyncio.to_thread(LEGEND_INDEX.load, kb_folder)
+    if LEGEND_INDEX.tiles:
+        stats = LEGEND_INDEX.stats()
+        logging.info(f"Base de conocimiento cargada: {stats['tiles']} recortes de leyenda. Reserva por lote: {stats['reserved_bytes'] / 1024 / 1024:.2f} MB (láminas originales: {stats['source_bytes'] / 1024 / 1024:.2f} MB)")
     else:
         logging.warning("La base de conocimiento está vacía o no contiene imágenes.")
+# --- FIN: ÍNDICE DE LEYENDAS ---
 
 
-async def process_file_to_data_urls(file: UploadFile) -> List[str]:
-    # ... (Tu código de process_file_to_data_urls no cambia) ...
-    content = await file.read()
-    if file.content_type == "application/pdf":
-        try:
-            pdf_document = fitz.open(stream=BytesIO(content), filetype="pdf")
-            return [f"data:image/png;base64,{base64.b64encode(page.get_pixmap(dpi=300).tobytes('png')).decode('utf-8')}" for page in pdf_document]
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error al procesar el PDF del usuario '{file.filename}': {e}")
-    else:
-        raise HTTPException(status_code=400, detail=f"Tipo de archivo no soportado: '{file.content_type}'. Solo se aceptan archivos PDF.")
+# --- INICIO: POOL DE RENDERIZADO (MULTI-NÚCLEO) ---
+# La rasterización (get_pixmap), la codificación PNG y el base64 son trabajo de CPU
+# puro. Se ejecutan en un pool de procesos para no bloquear el event loop de uvicorn.
+RENDER_POOL: Optional[ProcessPoolExecutor] = None
 
+def get_render_pool() -> ProcessPoolExecutor:
+    global RENDER_POOL
+    if RENDER_POOL is None:
+        logging.info(f"Iniciando pool de renderizado con {RENDER_POOL_WORKERS} proceso(s).")
+        RENDER_POOL = ProcessPoolExecutor(max_workers=RENDER_POOL_WORKERS)
+    return RENDER_POOL
 
-async def process_pdf_pages_with_crops(file: UploadFile) -> (List[str], List[str]):
-    """
-    Procesa un archivo PDF y devuelve dos listas de imágenes base64:
-    1. full_pages: Imágenes de la página completa (para análisis de riesgos).
-    2. title_blocks: Imágenes recortadas del cajetín (para extracción de DWG/REV).
-    """
-    content = await file.read()
-    if file.content_type != "application/pdf":
-        logging.warning(f"Se intentó procesar con recorte un archivo no PDF: {file.filename}")
-        return [], []
+@app.on_event("startup")
+async def start_render_pool():
+    get_render_pool()
 
-    full_pages = []
-    title_blocks = []
-    try:
-        pdf_document = fitz.open(stream=BytesIO(content), filetype="pdf")
-        for page_num, page in enumerate(pdf_document):
-            
-            # 1. Obtener la página completa
-            try:
-                full_pix = page.get_pixmap(dpi=300)
-                full_b64 = base64.b64encode(full_pix.tobytes('png')).decode('utf-8')
-                full_pages.append(f"data:image/png;base64,{full_b64}")
-            except Exception as e:
-                logging.error(f"Error al renderizar página completa {page_num} de {file.filename}: {e}")
-                full_pages.append("") # Añadir placeholder si falla
-            
-            # 2. Definir el área de recorte (cajetín)
-            rect = page.rect
-            
-            # --- LÍNEA MODIFICADA (basada en tu feedback) ---
-            # Captura el 20% derecho y el 20% inferior de la página.
-            crop_box = fitz.Rect(rect.width * 0.80, rect.height * 0.80, rect.width, rect.height)
-            
-            # 3. Obtener la imagen recortada del cajetín
-            try:
-                # Aplicamos el crop_box a la página
-                page.set_cropbox(crop_box)
-                crop_pix = page.get_pixmap(dpi=300) # Renderiza solo el área del crop_box
-                crop_b64 = base64.b64encode(crop_pix.tobytes('png')).decode('utf-8')
-                title_blocks.append(f"data:image/png;base64,{crop_b64}")
-            except Exception as e:
-                logging.error(f"Error al renderizar cajetín recortado {page_num} de {file.filename}: {e}")
-                title_blocks.append("") # Añadir placeholder si falla
-            
-            # 4. Restaurar el mediabox para la siguiente iteración (buena práctica)
-            page.set_cropbox(page.mediabox)
+@app.on_event("shutdown")
+async def stop_render_pool():
+    global RENDER_POOL
+    if RENDER_POOL is not None:
+        RENDER_POOL.shutdown(wait=True, cancel_futures=True)
+        RENDER_POOL = None
 
-        return full_pages, title_blocks
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error al procesar el PDF '{file.filename}' para recorte: {e}")
 
+# Área del cajetín como fracción de la página: el 20% derecho y el 20% inferior.
+TITLE_BLOCK_BOX = (0.80, 0.80, 1.0, 1.0)
 
-async def send_analysis_request(client, payload):
-    # ... (Tu código de send_analysis_request no cambia) ...
-    full_endpoint = f"{AZURE_ENDPOINT}openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={API_VERSION}"
-    headers = {"Content-Type": "application/json", "api-key": AZURE_API_KEY}
-    response = await client.post(full_endpoint, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+def title_block_rect(rect: fitz.Rect) -> fitz.Rect:
+    x0, y0, x1, y1 = TITLE_BLOCK_BOX
+    return fitz.Rect(rect.width * x0, rect.height * y0, rect.width * x1, rect.height * y1)
 
 
-# --- (MODIFICADO) ENDPOINT /analyze ---
-@app.post("/analyze")
-async def analyze_documents(scope_files: List[UploadFile] = File(None), planos: List[UploadFile] = File(None)):
-    
-    session_id = str(uuid.uuid4())
-    logging.info(f"Iniciando nueva sesión de análisis: {session_id}")
+def to_data_url(data, mime_type: str) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
 
-    if not scope_files and not planos:
-        raise HTTPException(status_code=400, detail="Debe proporcionar al menos un archivo (plano o alcance).")
 
-    # --- INICIO: LÓGICA DE PROCESAMIENTO MODIFICADA ---
-    processed_scope_images = []
-    processed_plano_images = []
-    processed_title_blocks = []
-    
-    if scope_files:
-        for file in scope_files:
-            try:
-                urls = await process_file_to_data_urls(file) # Usa la función original
-                processed_scope_images.extend(urls)
-            except Exception as e:
-                logging.warning(f"Omitiendo archivo de alcance {file.filename} debido a error: {e}")
+class DataURL:
+    """
+    URL data: de una imagen que sólo referencia sus bytes (bytes o memoryview de la
+    sesión). El base64 se genera por fragmentos al escribir el cuerpo de la solicitud
+    (ver iter_json_body); str() devuelve la URL completa cuando hace falta como texto.
+    """
+    __slots__ = ("data", "mime_type")
 
-    # --- LÓGICA DE DECISIÓN: PLANOS vs SÓLO ALCANCE ---
-    
-    if not planos:
-        # --- CASO 1: SÓLO ALCANCE ---
-        logging.info(f"Sesión {session_id}: Iniciando análisis de SÓLO ALCANCE.")
-        
-        SESSION_CACHE[session_id] = {
-            "images": processed_scope_images, # Guardar solo imágenes de alcance
-            "analysis": None
-        }
-        
-        # (Aquí usamos la lógica de lotes (batching) para las imágenes de alcance)
-        batches = create_batches(processed_scope_images, KNOWLEDGE_BASE_URLS)
-        if not batches:
-             raise HTTPException(status_code=400, detail="No se pudieron procesar los archivos de alcance.")
+    def __init__(self, data, mime_type: str):
+        self.data = data
+        self.mime_type = mime_type
 
-        logging.info(f"Análisis (Sólo Alcance): se ha dividido la solicitud en {len(batches)} lote(s).")
-        
-        payloads = []
-        for i, image_batch in enumerate(batches):
-            user_content = [{"type": "text", "text": "Analiza los siguientes documentos de alcance y devuelve tu análisis exclusivamente en formato JSON."}]
-            # (Opcional: puedes incluir la base de conocimiento si es relevante para el alcance)
-            # if KNOWLEDGE_BASE_URLS: ...
-            user_content.append({"type": "text", "text": f"--- INICIO: DOCUMENTOS DE ALCANCE (LOTE {i+1}/{len(batches)}) ---"})
-            user_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in image_batch])
-            
-            payload = {
-                "messages": [
-                    {"role": "system", "content": PROMPT_ANALISTA_ALCANCE}, # <-- USAR NUEVO PROMPT
-                    {"role": "user", "content": user_content}
-                ],
-                "max_tokens": 4096, "temperature": 0.1, "top_p": 0.8, 
-                "response_format": {"type": "json_object"}
-            }
-            payloads.append(payload)
+    @property
+    def prefix(self) -> bytes:
+        return f"data:{self.mime_type};base64,".encode("ascii")
 
-    else:
-        # --- CASO 2: HAY PLANOS (y posiblemente alcance) ---
-        logging.info(f"Sesión {session_id}: Iniciando análisis de PLANOS (con/sin alcance).")
-        
-        if planos:
-            for file in planos:
-                try:
-                    full_pages, title_blocks = await process_pdf_pages_with_crops(file) 
-                    processed_plano_images.extend(full_pages)
-                    processed_title_blocks.extend(title_blocks)
-                except Exception as e:
-                    logging.warning(f"Omitiendo plano {file.filename} debido a error: {e}")
+    def __len__(self) -> int:
+        return len(self.prefix) + 4 * math.ceil(len(self.data) / 3)
 
-        if not processed_plano_images:
-            raise HTTPException(status_code=400, detail="No se proporcionaron archivos de planos válidos para analizar.")
+    def __str__(self) -> str:
+        return to_data_url(self.data, self.mime_type)
 
-        all_images_for_session = processed_scope_images + processed_plano_images
-        SESSION_CACHE[session_id] = {
-            "images": all_images_for_session,
-            "analysis": None
-        }
-        logging.info(f"Sesión {session_id}: {len(all_images_for_session)} imágenes totales guardadas en cache.")
+    def iter_chunks(self, chunk_size: int):
+        chunk_size -= chunk_size % 3 # Múltiplo de 3: los fragmentos en base64 se concatenan sin relleno intermedio
+        yield self.prefix
+        data = memoryview(self.data)
+        for offset in range(0, len(data), chunk_size):
+            yield base64.b64encode(data[offset:offset + chunk_size])
 
-        info_extraida_texto = "--- INFORMACIÓN DE CAJETÍN (Fuente de Verdad) ---\nNo se pudo extraer información del cajetín."
-        
-        # --- ETAPA 1: EXTRACCIÓN DE DATOS DEL CAJETÍN ---
-        if processed_title_blocks:
-            logging.info(f"Sesión {session_id}: Iniciando Etapa 1 - Extracción de {len(processed_title_blocks)} cajetines.")
-            try:
-                extraction_content = [{"type": "text", "text": "Extrae el DWG No y REV de las siguientes imágenes de cajetín."}]
-                extraction_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in processed_title_blocks if url])
-                
-                payload_extraccion = {
-                    "messages": [
-                        {"role": "system", "content": PROMPT_EXTRACCION_CAJETIN},
-                        {"role": "user", "content": extraction_content}
-                    ],
-                    "max_tokens": 1024, "temperature": 0.0,
-                    "response_format": {"type": "json_object"}
-                }
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    extraction_result = await send_analysis_request(client, payload_extraccion)
-                    
-                content_str = extraction_result.get("choices", [{}])[0].get("message", {}).get("content")
-                if content_str:
-                    extracted_data = json.loads(content_str).get("extracciones", [])
-                    texto_items = []
-                    for i, item in enumerate(extracted_data):
-                        dwg = item.get('dwg_no', 'No encontrado')
-                        rev = item.get('rev', 'No encontrado')
-                        texto_items.append(f"Plano (Página {i+1}): DWG No: {dwg}, REV: {rev}")
-                    
-                    if texto_items:
-                        info_extraida_texto = "--- INFORMACIÓN DE CAJETÍN (Fuente de Verdad) ---\n" + "\n".join(texto_items) + "\n--- FIN INFORMACIÓN DE CAJETÍN ---"
-                    logging.info(f"Sesión {session_id}: Extracción de cajetín exitosa.")
-                
-            except Exception as e:
-                logging.error(f"Sesión {session_id}: Error en Etapa 1 (Extracción de cajetín): {e}")
-        
-        # --- ETAPA 2: ANÁLISIS DE RIESGOS ---
-        logging.info(f"Sesión {session_id}: Iniciando Etapa 2 - Análisis de Riesgos.")
-        
-        all_user_images_for_analysis = processed_scope_images + processed_plano_images
-        batches = create_batches(all_user_images_for_analysis, KNOWLEDGE_BASE_URLS)
-        
-        logging.info(f"Análisis (Etapa 2): se ha dividido la solicitud en {len(batches)} lote(s).")
-        
-        payloads = []
-        for i, image_batch in enumerate(batches):
-            user_content = [{"type": "text", "text": "Analiza los siguientes documentos y devuelve tu análisis exclusivamente en formato JSON."}]
-            if KNOWLEDGE_BASE_URLS:
-                user_content.append({"type": "text", "text": "--- INICIO: BASE DE CONOCIMIENTO ---"})
-                user_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in KNOWLEDGE_BASE_URLS])
-                user_content.append({"type": "text", "text": "--- FIN: BASE DE CONOCIMIENTO ---"})
-            
-            user_content.append({"type": "text", "text": info_extraida_texto}) # Inyectar datos de Etapa 1
 
-            user_content.append({"type": "text", "text": f"--- INICIO: DOCUMENTOS DEL LOTE {i+1}/{len(batches)} ---"})
-            user_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in image_batch])
-            
-            payload = {
-                "messages": [
-                    {"role": "system", "content": PROMPT_ANALISTA_RIESGOS}, # <-- USAR PROMPT DE RIESGOS
-                    {"role": "user", "content": user_content}
-                ],
-                "max_tokens": 4096, "temperature": 0.1, "top_p": 0.8,
-                "response_format": {"type": "json_object"}
-            }
-            payloads.append(payload)
+def image_content(image: Dict[str, Any]) -> Dict[str, Any]:
+    """Bloque image_url del mensaje de chat para una imagen {"data", "mime_type"}; no copia los bytes."""
+    return {"type": "image_url", "image_url": {"url": DataURL(image["data"], image["mime_type"])}}
 
-    # --- EJECUCIÓN DE LLAMADAS A LA API (Común para ambos casos) ---
-    final_risks = []
-    risk_id_counter = 1
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        try:
-            tasks = [send_analysis_request(client, p) for p in payloads]
-            results = await asyncio.gather(*tasks)
 
-            for result in results:
-                analysis_content_str = result.get("choices", [{}])[0].get("message", {}).get("content")
-                if analysis_content_str:
-                    try:
-                        analysis_json = json.loads(analysis_content_str)
-                        if "riesgos_identificados" in analysis_json:
-                            for risk in analysis_json["riesgos_identificados"]:
-                                risk["id"] = risk_id_counter
-                                final_risks.append(risk)
-                                risk_id_counter += 1
-                        elif "error" in analysis_json:
-                            # Esta es la única salida de error esperada
-                            if "No se encontraron marcas de revisión" in analysis_json.get("error", ""):
-                                logging.info("Se detectó un lote sin marcas de revisión, se devolverá el error.")
-                                if len(results) == 1: # Si es el único lote, devolver error
-                                    return {"message": analysis_json["error"]}
-                                else: # Si otros lotes sí tienen, solo log
-                                    logging.warning(f"Un lote devolvió una nota: {analysis_json['error']}")
-                            else:
-                                logging.warning(f"Un lote devolvió un error genérico: {analysis_json['error']}")
-                    except json.JSONDecodeError as json_err:
-                        logging.error(f"Error al decodificar JSON de la API: {json_err}. Respuesta: {analysis_content_str[:200]}...")
-        
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=f"Error de la API de Azure: {e.response.text}")
-        except Exception as e:
-            logging.error(f"Error inesperado en análisis: {e}", exc_info=True)
-            raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+def image_bytes(image: Dict[str, Any]) -> int:
+    """Bytes codificados de una página, incluidos sus recortes ROI."""
+    return len(image["data"]) + sum(len(tile["data"]) for tile in image.get("tiles", []))
 
-    final_response = {"riesgos_identificados": final_risks}
-    SESSION_CACHE[session_id]["analysis"] = final_response
-    
-    return {"raw_analysis": json.dumps(final_response), "session_id": session_id}
 
+def image_source(image: Dict[str, Any]) -> Dict[str, Any]:
+    """Ubicación de una página: {"file", "page"} y, si es un plano, su "plano_page" (la pagina del cajetín)."""
+    source = {"file": image.get("file"), "page": image.get("page")}
+    if image.get("plano_page"):
+        source["plano_page"] = image["plano_page"]
+    return source
 
-# --- (NUEVA) FUNCIÓN DE BATCHING (Reutilizada) ---
-def create_batches(image_urls: List[str], knowledge_base_urls: List[str]) -> List[List[str]]:
-    """Función auxiliar para crear lotes de imágenes sin exceder el límite."""
-    
-    global KNOWLEDGE_BASE_SIZE_BYTES
-    batches = []
-    current_batch_size = KNOWLEDGE_BASE_SIZE_BYTES
-    current_batch_images = []
-    SAFE_LIMIT_BYTES = SAFE_PAYLOAD_LIMIT_MB * 1024 * 1024
-    
-    for image_url in image_urls:
-        if not image_url: continue # Omitir imágenes fallidas
-        image_size = get_base64_size_bytes(image_url)
-        
-        if image_size + KNOWLEDGE_BASE_SIZE_BYTES > SAFE_LIMIT_BYTES:
-            logging.warning(f"Una imagen ({image_size/1024/1024:.2f}MB) es demasiado grande, se omite.")
-            continue
-        
-        if current_batch_size + image_size > SAFE_LIMIT_BYTES and current_batch_images:
-            batches.append(current_batch_images)
-            current_batch_images = []
-            current_batch_size = KNOWLEDGE_BASE_SIZE_BYTES
-        
-        current_batch_images.append(image_url)
-        current_batch_size += image_size
-    
-    if current_batch_images:
-        batches.append(current_batch_images)
-    
-    return batches
 
+def image_plano_pages(image: Dict[str, Any]) -> List[int]:
+    """Páginas de plano (pagina del cajetín) que muestra una imagen, incluidas las de sus duplicados."""
+    paginas = [image.get("plano_page")] + [source.get("plano_page") for source in image.get("sources", [])]
+    return list(dict.fromkeys(pagina for pagina in paginas if pagina))
 
-class ChatMessage(BaseModel):
-    role: str
-    content: Any
 
-class ChatRequest(BaseModel):
-    messages: List[ChatMessage]
-    session_id: str
+def sources_text(sources: List[Dict[str, Any]]) -> str:
+    return "; ".join(f"{source['file']}, página {source['page']}" + (f" = Plano (Página {source['plano_page']})" if source.get("plano_page") else "")
+                     for source in sources)
 
-@app.post("/chat")
-async def handle_chat(chat_request: ChatRequest):
-    if not AZURE_API_KEY:
-        raise HTTPException(status_code=500, detail="La clave de API de Azure no está configurada.")
 
-    session_id = chat_request.session_id
-    session_data = SESSION_CACHE.get(session_id)
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Sesión no encontrada o expirada. Por favor, inicie un nuevo análisis.")
-    
-    cached_images = session_data.get("images", [])
+def page_content(image: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Bloques de mensaje para una página. Con recortes ROI: la vista general y cada recorte
+    con su archivo, página y zona de la hoja, para que la ubicación pueda citar el plano.
+    Una hoja que aparece en varios archivos lleva antes la lista de todas sus ubicaciones.
+    """
+    content = []
+    if len(image.get("sources", [])) > 1:
+        content.append({"type": "text", "text": f"La siguiente hoja aparece {len(image['sources'])} veces en los archivos: {sources_text(image['sources'])}."})
+    if not image.get("tiles"):
+        return content + [image_content(image)]
+    where = f"{image.get('file')}, página {image.get('page')}"
+    content += [{"type": "text", "text": f"Plano {where}: vista general (baja resolución)."}, image_content(image)]
+    for k, tile in enumerate(image["tiles"], start=1):
+        x0, y0, x1, y1 = tile["bbox"]
+        content.append({"type": "text", "text": f"Plano {where}: detalle {k} (alta resolución), zona x {x0:.0%}-{x1:.0%}, y {y0:.0%}-{y1:.0%} de la hoja."})
+        content.append(image_content(tile))
+    return content
 
-    chat_history_from_client = [msg.dict() for msg in chat_request.messages]
-    
-    user_multimodal_content = []
-    last_user_question = chat_history_from_client[-1]['content']
-    user_multimodal_content.append({"type": "text", "text": last_user_question})
-    
-    if KNOWLEDGE_BASE_URLS:
-        user_multimodal_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in KNOWLEDGE_BASE_URLS])
-    user_multimodal_content.extend([{"type": "image_url", "image_url": {"url": url}} for url in cached_images])
-    
-    # Decidimos qué prompt de sistema usar en el chat.
-    system_prompt = PROMPT_CHAT_RIESGOS
-    
-    messages_for_api = [
-        {"role": "system", "content": system_prompt},
-        *chat_history_from_client[:-1], 
-        {"role": "user", "content": user_multimodal_content}
-    ]
-    
-    payload = { "messages": messages_for_api, "max_tokens": 2048, "temperature": 0.5, "top_p": 0.9 }
-    
-    headers = {"Content-Type": "application/json", "api-key": AZURE_API_KEY}
-    full_endpoint = f"{AZURE_ENDPOINT}openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={API_VERSION}"
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        try:
-            response = await client.post(full_endpoint, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            ai_response = data.get("choices", [{}])[0].get("message", {}).get("content")
-            if not ai_response:
-                raise HTTPException(status_code=500, detail="Respuesta vacía de la API de Azure.")
-            
-            return {"response": ai_response}
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=f"Error de la API de Azure: {e.response.text}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
+def _encode_pixmap(pix: fitz.Pixmap, fmt: str, quality: Optional[int]) -> Tuple[bytes, str]:
+    """Codifica un pixmap RGB en el formato del escalón. Devuelve (bytes, mime_type)."""
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    output = BytesIO()
+    if fmt == "png8":
+        # PNG indexado (paleta de 256 colores): planos con pocos colores casi sin pérdida
+        img.quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(output, format="PNG")
+        return output.getvalue(), "image/png"
+    if fmt == "jpeg":
+        # subsampling=0 (4:4:4) evita que el croma difumine los trazos rojos finos
+        img.save(output, format="JPEG", quality=quality, subsampling=0)
+        return output.getvalue(), "image/jpeg"
+    if fmt == "webp":
+        img.save(output, format="WEBP", quality=quality, method=4)
+        return output.getvalue(), "image/webp"
+    return pix.tobytes("png"), "image/png"
 
 
-# --- ENDPOINT DE DESCARGA ---
-class DownloadRequest(BaseModel):
-    session_id: str
+def _add_seconds(steps: Optional[Dict[str, float]], step: str, started: float):
+    """Suma a steps[step] los segundos transcurridos desde started (time.perf_counter)."""
+    if steps is not None:
+        steps[step] = steps.get(step, 0.0) + time.perf_counter() - started
 
-@app.post("/download_report")
-async def download_report(request: DownloadRequest):
-    # ... (Tu código de download_report no cambia) ...
-    session_id = request.session_id
-    session_data = SESSION_CACHE.get(session_id)
 
+def _render_with_ladder(page: fitz.Page, budget_bytes: int, steps: Optional[Dict[str, float]] = None) -> Tuple[bytes, str, Dict[str, Any]]:
+    """
+    Recorre ENCODING_LADDER hasta que la página cabe en budget_bytes.
+    Si ningún escalón cabe se usa el último y se marca como over_budget.
+    steps, si se indica, acumula los segundos de rasterizado ("pixmap") y codificación ("encode").
+    """
+    pix, pix_dpi = None, None
+    for name, dpi, fmt, quality in ENCODING_LADDER:
+        if dpi != pix_dpi:
+            started = time.perf_counter()
+            pix, pix_dpi = page.get_pixmap(dpi=dpi), dpi
+            _add_seconds(steps, "pixmap", started)
+        started = time.perf_counter()
+        data, mime_type = _encode_pixmap(pix, fmt, quality)
+        _add_seconds(steps, "encode", started)
+        if len(data) <= budget_bytes:
+            break
+    encoding = {"rung": name, "dpi": dpi, "format": fmt, "bytes": len(data), "over_budget": len(data) > budget_bytes,
+                "width": pix.width, "height": pix.height, "page_points": [page.rect.width, page.rect.height]}
+    return data, mime_type, encoding
+
+
+# --- EXTRACCIÓN LOCAL DEL CAJETÍN (CAPA DE TEXTO DEL PDF) ---
+# Mismas variantes de etiqueta que PROMPT_EXTRACCION_CAJETIN. "°" no es carácter de palabra:
+# tras "N°" no hay \b antes de un espacio o ":", por eso se usa (?!\w).
+DWG_LABEL_PATTERN = re.compile(r"\b(?:DWG|PLANO|DRAWING|DOCUMENT|DOCUMENTO)\.?\s*(?:No|N°|Nº|NUMBER|NUM)(?!\w)\.?\s*[:#]?", re.IGNORECASE)
+REV_LABEL_PATTERN = re.compile(r"\bREV(?:ISION|ISIÓN)?\b\.?\s*[:#]?", re.IGNORECASE)
+DWG_VALUE_PATTERN = re.compile(r"^(?=.*\d)[A-Z0-9][A-Z0-9\-_./]*$", re.IGNORECASE)
+# Revisiones típicas: 0, 51, A, B, C1, P01 (evita confundir encabezados como "DATE")
+REV_VALUE_PATTERN = re.compile(r"^(?:\d{1,3}|[A-Z]{1,2}\d{0,2})$", re.IGNORECASE)
+
+
+def _text_lines(words: List[Tuple]) -> List[Dict[str, Any]]:
+    """Agrupa las palabras de page.get_text("words") en líneas con su rectángulo."""
+    lines = {}
+    for x0, y0, x1, y1, text, block_no, line_no, _ in words:
+        line = lines.setdefault((block_no, line_no), {"words": [], "rect": [x0, y0, x1, y1]})
+        line["words"].append((x0, text))
+        rect = line["rect"]
+        line["rect"] = [min(rect[0], x0), min(rect[1], y0), max(rect[2], x1), max(rect[3], y1)]
+    result = []
+    for line in lines.values():
+        line["text"] = " ".join(text for _, text in sorted(line["words"]))
+        result.append(line)
+    return sorted(result, key=lambda line: (line["rect"][1], line["rect"][0]))
+
+
+def _first_token(text: str) -> str:
+    tokens = text.strip(" :.#").split()
+    return tokens[0].strip(" :,;") if tokens else ""
+
+
+def _find_label_values(lines: List[Dict[str, Any]], label_pattern, value_pattern) -> List[Tuple[str, float]]:
+    """
+    Busca el valor de una etiqueta: en la misma línea tras la etiqueta (0.95), en la
+    celda inmediatamente debajo (0.8) o a la derecha (0.7).
+    """
+    candidates = []
+    for line in lines:
+        match = label_pattern.search(line["text"])
+        if not match:
+            continue
+        value = _first_token(line["text"][match.end():])
+        if value_pattern.match(value):
+            candidates.append((value, 0.95))
+            continue
+        lx0, ly0, lx1, ly1 = line["rect"]
+        height = max(ly1 - ly0, 1.0)
+        below = [
+            other for other in lines
+            if other is not line and 0 <= other["rect"][1] - ly1 + height * 0.3 <= height * 3
+            and other["rect"][0] < lx1 + height and other["rect"][2] > lx0 - height
+        ]
+        right = [
+            other for other in lines
+            if other is not line and other["rect"][0] >= lx1 - 1 and other["rect"][0] - lx1 <= height * 8
+            and other["rect"][1] < ly1 and other["rect"][3] > ly0
+        ]
+        for neighbours, confidence in ((below, 0.8), (right, 0.7)):
+            neighbours.sort(key=lambda other: (other["rect"][1], other["rect"][0]))
+            value = _first_token(neighbours[0]["text"]) if neighbours else ""
+            if value_pattern.match(value):
+                candidates.append((value, confidence))
+                break
+    return candidates
+
+
+def _best_candidate(candidates: List[Tuple[str, float]]) -> Tuple[Optional[str], float]:
+    if not candidates:
+        return None, 0.0
+    value, confidence = max(candidates, key=lambda candidate: candidate[1])
+    # Valores distintos con la misma etiqueta (p. ej. tabla de revisiones): baja la confianza
+    if len({candidate[0].upper() for candidate in candidates}) > 1:
+        confidence -= 0.3
+    return value, round(confidence, 2)
+
+
+def extract_title_block_fields(words: List[Tuple]) -> Dict[str, Any]:
+    """Lee DWG No y REV de las palabras del cajetín. confidence es la del campo menos seguro."""
+    lines = _text_lines(words)
+    dwg_no, dwg_confidence = _best_candidate(_find_label_values(lines, DWG_LABEL_PATTERN, DWG_VALUE_PATTERN))
+    rev, rev_confidence = _best_candidate(_find_label_values(lines, REV_LABEL_PATTERN, REV_VALUE_PATTERN))
+    return {"dwg_no": dwg_no, "rev": rev, "confidence": min(dwg_confidence, rev_confidence)}
+
+
+# --- DETECTOR LOCAL DE MARCAS DE REVISIÓN (NUBES ROJAS / SOMBREADO GRIS) ---
+# Trabaja sobre las muestras RGB de un pixmap de baja resolución, por celdas de
+# REVISION_CELL_PX píxeles. Las celdas marcadas se agrupan en regiones conexas.
+REVISION_DETECTOR_VERSION = 1
+REVISION_CELL_PX = 16
+RED_CELL_MIN_FRACTION = 0.02     # Fracción de píxeles rojos para marcar una celda
+HATCH_CELL_MIN_FRACTION = 0.08   # Fracción de gris: ni trazo aislado...
+HATCH_CELL_MAX_FRACTION = 0.6    # ...ni relleno sólido
+HATCH_MIN_TRANSITIONS = 2.0      # Cortes gris/blanco por fila de celda: las líneas del rayado
+RED_MIN_CELLS = 2
+HATCH_MIN_CELLS = 3
+
+def _cell_regions(cells: np.ndarray, min_cells: int) -> List[Tuple[int, int, int, int, int]]:
+    """Regiones conexas (8-vecindad) de celdas marcadas: (fila0, col0, fila1, col1, n_celdas)."""
+    remaining = {(int(r), int(c)) for r, c in zip(*np.nonzero(cells))}
+    regions = []
+    while remaining:
+        stack = [remaining.pop()]
+        rows, cols = [], []
+        while stack:
+            r, c = stack.pop()
+            rows.append(r)
+            cols.append(c)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    neighbour = (r + dr, c + dc)
+                    if neighbour in remaining:
+                        remaining.remove(neighbour)
+                        stack.append(neighbour)
+        if len(rows) >= min_cells:
+            regions.append((min(rows), min(cols), max(rows) + 1, max(cols) + 1, len(rows)))
+    return regions
+
+
+def detect_revision_marks(samples: np.ndarray) -> Dict[str, Any]:
+    """
+    Busca nubes de revisión rojas y sombreado gris en una imagen RGB (alto x ancho x canales).
+    Devuelve {"has_marks", "confidence", "boxes": [{"kind": "red"|"hatch", "bbox" normalizada, "score"}]}.
+    El cajetín se excluye: su logotipo y la tabla de revisiones no son cambios del plano.
+    """
+    rgb = samples[..., :3].astype(np.int16)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    height, width = r.shape
+    red = (r > 140) & (r - g > 70) & (r - b > 70)
+    grey = (np.abs(r - g) < 12) & (np.abs(g - b) < 12) & (r > 80) & (r < 215)
+
+    x0, y0, _, _ = TITLE_BLOCK_BOX
+    red[int(y0 * height):, int(x0 * width):] = False
+    grey[int(y0 * height):, int(x0 * width):] = False
+
+    cs = REVISION_CELL_PX
+    rows, cols = height // cs, width // cs
+    if not rows or not cols:
+        return {"has_marks": False, "confidence": 0.0, "boxes": []}
+    red_cells = red[:rows * cs, :cols * cs].reshape(rows, cs, cols, cs)
+    grey_cells = grey[:rows * cs, :cols * cs].reshape(rows, cs, cols, cs)
+    red_fraction = red_cells.mean(axis=(1, 3))
+    grey_fraction = grey_cells.mean(axis=(1, 3))
+    transitions = (np.diff(grey_cells.astype(np.int8), axis=3) != 0).sum(axis=3).mean(axis=1)
+
+    marked = {
+        "red": (red_fraction >= RED_CELL_MIN_FRACTION, RED_MIN_CELLS),
+        "hatch": ((grey_fraction >= HATCH_CELL_MIN_FRACTION) & (grey_fraction <= HATCH_CELL_MAX_FRACTION) & (transitions >= HATCH_MIN_TRANSITIONS), HATCH_MIN_CELLS),
+    }
+    boxes = []
+    for kind, (cells, min_cells) in marked.items():
+        for row0, col0, row1, col1, count in _cell_regions(cells, min_cells):
+            boxes.append({
+                "kind": kind,
+                "bbox": [round(col0 / cols, 4), round(row0 / rows, 4), round(col1 / cols, 4), round(row1 / rows, 4)],
+                "score": round(min(1.0, count / (3 * min_cells)), 3),
+            })
+    confidence = max((box["score"] for box in boxes), default=0.0)
+    return {"has_marks": bool(boxes), "confidence": confidence, "boxes": boxes}
+
+
+def _page_thumbnail(page: fitz.Page) -> np.ndarray:
+    """
+    Miniatura RGB de la página a REVISION_DETECT_DPI, sin antialiasing (los bordes grises
+    falsearían el rayado). La usan el detector de marcas y la huella de la página.
+    """
+    aa_level = fitz.TOOLS.show_aa_level()
+    fitz.TOOLS.set_aa_level(0)
+    try:
+        pix = page.get_pixmap(dpi=REVISION_DETECT_DPI, alpha=False, colorspace=fitz.csRGB)
+    finally:
+        fitz.TOOLS.set_aa_level(aa_level["graphics"])
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+# --- HUELLA DE PÁGINA (DUPLICADOS DENTRO DE UNA SOLICITUD) ---
+PAGE_HASH_SIZE = 16 # Hash perceptual de 16x16 bits
+
+def page_fingerprint(samples: np.ndarray, text: str) -> Dict[str, str]:
+    """
+    Huella de una página a partir de su miniatura (H x W x 3, uint8) y su capa de texto:
+    "pixels" (SHA-256 de los píxeles y sus dimensiones: misma hoja rasterizada igual),
+    "dhash" (hash de diferencias en hex: la miniatura se reduce a 16x17 bloques y cada bit
+    dice si el brillo sube hacia la derecha; tolera cambios de compresión o escaneo) y
+    "text" (SHA-256 de la capa de texto sin espacios redundantes; None si no tiene).
+    """
+    normalized = " ".join(text.split())
+    height, width = samples.shape[:2]
+    pixels = hashlib.sha256(f"{width}x{height}:".encode("ascii"))
+    pixels.update(np.ascontiguousarray(samples).data)
+
+    gray = samples[..., :3].mean(axis=2)
+    rows = np.linspace(0, height, PAGE_HASH_SIZE + 1).astype(int)
+    cols = np.linspace(0, width, PAGE_HASH_SIZE + 2).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    means = sums / np.maximum(np.outer(np.diff(rows), np.diff(cols)), 1)
+    bits = means[:, 1:] > means[:, :-1]
+
+    return {
+        "pixels": pixels.hexdigest(),
+        "dhash": np.packbits(bits).tobytes().hex(),
+        "text": hashlib.sha256(normalized.encode("utf-8")).hexdigest() if normalized else None,
+    }
+
+
+def dhash_distance(a: str, b: str) -> int:
+    """Bits distintos entre dos hashes perceptuales en hex."""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+# --- RECORTES DE ALTA RESOLUCIÓN ALREDEDOR DE LOS CAMBIOS (ROI) ---
+# Cada región (detectada o indicada por el usuario) se amplía con un margen y con las líneas
+# rectas que la cruzan (succión/descarga conectadas), hasta ROI_MAX_EXPANSION de la hoja.
+ROI_TILE_DPI_LADDER = [ROI_TILE_DPI, 200, 150]
+
+def _line_segments(page: fitz.Page) -> List[Tuple[float, float, float, float]]:
+    """Cajas (x0, y0, x1, y1) de los segmentos rectos del dibujo vectorial."""
+    segments = []
+    for path in page.get_drawings():
+        for item in path["items"]:
+            if item[0] == "l":
+                p1, p2 = item[1], item[2]
+                segments.append((min(p1.x, p2.x), min(p1.y, p2.y), max(p1.x, p2.x), max(p1.y, p2.y)))
+    return segments
+
+
+def _overlaps(a, b) -> bool:
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+
+def _roi_rects(page: fitz.Page, regions: List[List[float]]) -> List[fitz.Rect]:
+    """Regiones normalizadas -> rectángulos de página ampliados y fusionados."""
+    rect = page.rect
+    margin_x, margin_y = ROI_TILE_MARGIN * rect.width, ROI_TILE_MARGIN * rect.height
+    limit_x, limit_y = ROI_MAX_EXPANSION * rect.width, ROI_MAX_EXPANSION * rect.height
+    segments = _line_segments(page)
+    boxes = []
+    for x0, y0, x1, y1 in regions:
+        box = (rect.x0 + x0 * rect.width - margin_x, rect.y0 + y0 * rect.height - margin_y,
+               rect.x0 + x1 * rect.width + margin_x, rect.y0 + y1 * rect.height + margin_y)
+        grown = list(box)
+        for segment in segments:
+            if _overlaps(segment, box):
+                grown = [min(grown[0], segment[0]), min(grown[1], segment[1]), max(grown[2], segment[2]), max(grown[3], segment[3])]
+        boxes.append([
+            max(grown[0], box[0] - limit_x, rect.x0), max(grown[1], box[1] - limit_y, rect.y0),
+            min(grown[2], box[2] + limit_x, rect.x1), min(grown[3], box[3] + limit_y, rect.y1),
+        ])
+    # Fusionar los recortes que se solapan
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if _overlaps(boxes[i], boxes[j]):
+                    a, b = boxes[i], boxes.pop(j)
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [fitz.Rect(box) for box in boxes]
+
+
+def _render_roi(page: fitz.Page, regions: List[List[float]], budget_bytes: int,
+                steps: Optional[Dict[str, float]] = None) -> Tuple[bytes, str, List[Dict[str, Any]], Dict[str, Any]]:
+    """Vista general a ROI_OVERVIEW_DPI más recortes PNG de paleta; baja el DPI de los recortes hasta cumplir el presupuesto."""
+    def render(dpi, clip=None):
+        started = time.perf_counter()
+        pix = page.get_pixmap(dpi=dpi, clip=clip)
+        _add_seconds(steps, "pixmap", started)
+        started = time.perf_counter()
+        encoded = _encode_pixmap(pix, "png8", None)
+        _add_seconds(steps, "encode", started)
+        return encoded
+
+    overview, overview_mime = render(ROI_OVERVIEW_DPI)
+    rect = page.rect
+    clips = _roi_rects(page, regions)
+    tiles = []
+    for dpi in ROI_TILE_DPI_LADDER:
+        tiles = []
+        for clip in clips:
+            data, mime_type = render(dpi, clip)
+            bbox = [round((clip.x0 - rect.x0) / rect.width, 4), round((clip.y0 - rect.y0) / rect.height, 4),
+                    round((clip.x1 - rect.x0) / rect.width, 4), round((clip.y1 - rect.y0) / rect.height, 4)]
+            tiles.append({"data": data, "mime_type": mime_type, "bbox": bbox, "dpi": dpi})
+        total = len(overview) + sum(len(tile["data"]) for tile in tiles)
+        if total <= budget_bytes:
+            break
+    encoding = {"rung": f"roi-{ROI_OVERVIEW_DPI}+{dpi}", "dpi": ROI_OVERVIEW_DPI, "format": "png8", "bytes": total,
+                "over_budget": total > budget_bytes, "tiles": len(tiles), "tile_dpi": dpi, "page_points": [rect.width, rect.height]}
+    return overview, overview_mime, tiles, encoding
+
+
+def _prepare_page(page: fitz.Page, page_num: int, roi_regions: Optional[List[List[float]]], steps: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Lo que se sabe de una página sin renderizarla completa: su capa de texto (para elegir las
+    secciones de leyenda relevantes), sus marcas de revisión (más las regiones del usuario) y
+    su huella (ver page_fingerprint). Devuelve {"text", "revision_marks", "fingerprint"}.
+    """
+    prepared = {"text": "", "revision_marks": None, "fingerprint": None}
+    started = time.perf_counter()
+    try:
+        prepared["text"] = page.get_text("text")
+    except Exception as e:
+        logging.error(f"Error al leer el texto de la página {page_num}: {e}")
+    _add_seconds(steps, "text", started)
+
+    thumbnail = None
+    if REVISION_DETECTOR_ENABLED or PAGE_DEDUP_ENABLED:
+        started = time.perf_counter()
+        try:
+            thumbnail = _page_thumbnail(page)
+            if REVISION_DETECTOR_ENABLED:
+                prepared["revision_marks"] = detect_revision_marks(thumbnail)
+        except Exception as e:
+            logging.error(f"Error al detectar marcas de revisión en la página {page_num}: {e}")
+        _add_seconds(steps, "detect", started)
+    if PAGE_DEDUP_ENABLED and thumbnail is not None:
+        started = time.perf_counter()
+        prepared["fingerprint"] = page_fingerprint(thumbnail, prepared["text"])
+        _add_seconds(steps, "fingerprint", started)
+
+    if roi_regions:
+        # Las regiones indicadas por el usuario cuentan como marcas de revisión
+        marks = prepared["revision_marks"] or {"has_marks": False, "confidence": 0.0, "boxes": []}
+        user_boxes = [{"kind": "user", "bbox": list(bbox), "score": 1.0} for bbox in roi_regions]
+        prepared["revision_marks"] = {"has_marks": True, "confidence": 1.0, "boxes": marks["boxes"] + user_boxes}
+    return prepared
+
+
+def _fingerprint_page_worker(pdf_path: str, page_num: int, roi_regions: Optional[List[List[float]]] = None) -> Dict[str, Any]:
+    """
+    Se ejecuta dentro del pool de procesos. Primera fase cuando se eliminan duplicados:
+    _prepare_page sin renderizar la página; el resultado se pasa luego a _render_page_worker.
+    """
+    steps = {}
+    with fitz.open(pdf_path) as pdf_document:
+        prepared = _prepare_page(pdf_document[page_num], page_num, roi_regions, steps)
+    return {**prepared, "steps": steps}
+
+
+def _render_page_worker(pdf_path: str, page_num: int, render_full: bool, render_title_block: bool, budget_bytes: int,
+                        roi_regions: Optional[List[List[float]]] = None, prepared: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Se ejecuta dentro del pool de procesos. Renderiza una página con la escalera de
+    codificación y/o su cajetín, y devuelve los bytes codificados (None si algo falla).
+    Con roi_regions (lista, aunque esté vacía) la página se envía como vista general más
+    recortes alrededor de esas regiones y de las marcas detectadas; sin regiones, completa.
+    prepared es el resultado de _fingerprint_page_worker, si la página ya pasó por él.
+    """
+    steps = {} # Segundos por paso, para las métricas de renderizado
+    result = {"full": None, "full_mime": None, "encoding": None, "tiles": [], "text": "", "revision_marks": None, "fingerprint": None,
+              "title_block": None, "cajetin": None, "steps": steps}
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document[page_num]
+
+        # 1. Obtener la página completa
+        if render_full:
+            if prepared is None:
+                prepared = _prepare_page(page, page_num, roi_regions, steps)
+            result.update(text=prepared["text"], revision_marks=prepared["revision_marks"], fingerprint=prepared["fingerprint"])
+
+            regions = [box["bbox"] for box in (result["revision_marks"] or {}).get("boxes", [])]
+            try:
+                if roi_regions is not None and regions:
+                    result["full"], result["full_mime"], result["tiles"], result["encoding"] = _render_roi(page, regions, budget_bytes, steps)
+                else:
+                    result["full"], result["full_mime"], result["encoding"] = _render_with_ladder(page, budget_bytes, steps)
+            except Exception as e:
+                logging.error(f"Error al renderizar página completa {page_num}: {e}")
+
+        # 2. Obtener la imagen recortada del cajetín (clip no modifica la página)
+        if render_title_block:
+            crop_box = title_block_rect(page.rect)
+            started = time.perf_counter()
+            try:
+                crop_pix = page.get_pixmap(dpi=RENDER_DPI, clip=crop_box)
+                result["title_block"] = crop_pix.tobytes("png")
+            except Exception as e:
+                logging.error(f"Error al renderizar cajetín recortado {page_num}: {e}")
+
+            # 3. Intentar leer DWG/REV de la capa de texto (planos vectoriales)
+            try:
+                result["cajetin"] = extract_title_block_fields(page.get_text("words", clip=crop_box))
+            except Exception as e:
+                logging.error(f"Error al leer el texto del cajetín {page_num}: {e}")
+            _add_seconds(steps, "title_block", started)
+
+    return result
+
+
+def image_byte_budget() -> int:
+    """Presupuesto por imagen: el configurado, sin superar lo que cabe junto a la base de conocimiento."""
+    safe_limit_bytes = SAFE_PAYLOAD_LIMIT_MB * 1024 * 1024 - LEGEND_INDEX.reserved_bytes()
+    return int(min(IMAGE_BYTE_BUDGET_MB * 1024 * 1024, safe_limit_bytes))
+
+
+# --- INICIO: CACHÉ DE RENDERIZADO ---
+class RenderCache:
+    """
+    Caché en disco de imágenes renderizadas, direccionada por contenido (SHA-256 del
+    PDF + página + parámetros de renderizado), acotada en tamaño con desalojo LRU.
+    Los aciertos se leen completos a memoria: la sesión puede retenerlos horas y un mapeo
+    (mmap) abierto por página agotaría los descriptores de archivo del proceso.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(pdf_hash: str, page_num: int, kind: str, **settings) -> str:
+        key_source = json.dumps({"pdf": pdf_hash, "page": page_num, "kind": kind, **settings}, sort_keys=True)
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + ".bin", base + ".json"
+
+    def load(self):
+        """Reconstruye el índice desde disco (el orden LRU sigue el mtime de los archivos)."""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            key = filename[:-5]
+            data_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                found.append((os.path.getmtime(data_path), key, meta))
+            except (OSError, ValueError):
+                continue
+        with self._lock:
+            for _, key, meta in sorted(found):
+                self.entries[key] = meta
+                self.total_bytes += meta["size"]
+            self._evict()
+        logging.info(f"Caché de renderizado: {len(self.entries)} entradas ({self.total_bytes / 1024 / 1024:.2f} MB) en {self.directory}")
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        with self._lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                self.misses += 1
+                return None
+            data_path, _ = self._paths(key)
+            try:
+                with open(data_path, "rb") as f:
+                    buffer = f.read()
+                os.utime(data_path)
+            except (OSError, ValueError):
+                # Otro proceso lo desalojó o el archivo está corrupto: se trata como fallo
+                self._drop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return buffer, meta
+
+    def put(self, key: str, data: bytes, meta: Dict[str, Any]):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        meta = {**meta, "size": len(data)}
+        data_path, meta_path = self._paths(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Escritura atómica: primero a un temporal y luego os.replace
+            for path, content in ((data_path, data), (meta_path, json.dumps(meta).encode("utf-8"))):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"No se pudo escribir en la caché de renderizado: {e}")
+            return
+        with self._lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]["size"]
+            self.entries[key] = meta
+            self.entries.move_to_end(key)
+            self.total_bytes += meta["size"]
+            self._evict()
+
+    def _drop(self, key: str):
+        meta = self.entries.pop(key, None)
+        if meta is not None:
+            self.total_bytes -= meta["size"]
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            oldest_key = next(iter(self.entries))
+            self._drop(oldest_key)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_DIR, int(RENDER_CACHE_MAX_MB * 1024 * 1024))
+
+@app.on_event("startup")
+async def load_render_cache():
+    await asyncio.to_thread(RENDER_CACHE.load)
+# --- FIN: CACHÉ DE RENDERIZADO ---
+
+
+def _split_tiles(buffer, meta: Dict[str, Any]) -> Tuple[Any, List[Dict[str, Any]]]:
+    """
+    Separa la vista general y los recortes ROI guardados juntos en una entrada de caché.
+    Devuelve vistas (memoryview) sobre buffer: la sesión comparte los bytes sin copiarlos.
+    """
+    buffer = memoryview(buffer)
+    tiles_meta = meta.get("tiles") or []
+    if not tiles_meta:
+        return buffer, []
+    tiles = [{"data": buffer[t["offset"]:t["offset"] + t["length"]], "mime_type": t["mime_type"], "bbox": t["bbox"], "dpi": t["dpi"]} for t in tiles_meta]
+    return buffer[:meta["overview_length"]], tiles
+
+
+def _join_tiles(overview: bytes, tiles: List[Dict[str, Any]]) -> Tuple[bytes, Dict[str, Any]]:
+    """Inverso de _split_tiles: un único blob con la vista general seguida de los recortes."""
+    offset = len(overview)
+    tiles_meta = []
+    for tile in tiles:
+        tiles_meta.append({"offset": offset, "length": len(tile["data"]), "mime_type": tile["mime_type"], "bbox": tile["bbox"], "dpi": tile["dpi"]})
+        offset += len(tile["data"])
+    return b"".join([overview] + [tile["data"] for tile in tiles]), {"overview_length": len(overview), "tiles": tiles_meta}
+
+
+class PageDeduplicator:
+    """
+    Páginas ya vistas en una solicitud, por huella (ver page_fingerprint). Una página duplica
+    a otra si tiene los mismos píxeles o, si no, la misma capa de texto (no vacía: en hojas
+    escaneadas dos revisiones casi iguales no se distinguirían) y un hash perceptual a
+    max_distance bits o menos; siempre con las mismas marcas de revisión y el mismo modo de
+    envío (completa o con recortes ROI), para que la imagen del original valga por ambas.
+    Cuenta además lo ahorrado, que se informa en la respuesta.
+    """
+
+    def __init__(self, max_distance: int = PAGE_DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._by_pixels: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._by_text: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self.duplicates: List[Dict[str, Any]] = []
+        self.renders_saved = 0
+        self.bytes_saved = 0
+        self.payload_bytes_saved = 0
+
+    @staticmethod
+    def _variant(marks: Optional[Dict[str, Any]], tiled: bool) -> str:
+        boxes = [[box["kind"], box["bbox"]] for box in (marks or {}).get("boxes", [])]
+        return json.dumps([tiled, marks is not None, boxes])
+
+    def find(self, fingerprint: Dict[str, str], marks: Optional[Dict[str, Any]], tiled: bool) -> Optional[Tuple[Dict[str, Any], str, int]]:
+        """(entrada del original, "exact" o "perceptual", distancia) o None si la página es nueva."""
+        variant = self._variant(marks, tiled)
+        entry = self._by_pixels.get((fingerprint["pixels"], variant))
+        if entry is not None:
+            return entry, "exact", 0
+        if self.max_distance < 0 or fingerprint["text"] is None:
+            return None
+        best = None
+        for entry in self._by_text.get((fingerprint["text"], variant), []):
+            distance = dhash_distance(entry["dhash"], fingerprint["dhash"])
+            if distance <= self.max_distance and (best is None or distance < best[2]):
+                best = (entry, "perceptual", distance)
+        return best
+
+    def register(self, source: Dict[str, Any], fingerprint: Dict[str, str], marks: Optional[Dict[str, Any]], tiled: bool) -> Dict[str, Any]:
+        """
+        Registra una página nueva. iter_pdf_pages completa en la entrada "page" (los datos
+        renderizados), "title_block" e "image" (la imagen entregada) al llegar a ella.
+        """
+        variant = self._variant(marks, tiled)
+        entry = {"source": source, "dhash": fingerprint["dhash"], "page": None, "title_block": None, "image": None}
+        self._by_pixels.setdefault((fingerprint["pixels"], variant), entry)
+        if fingerprint["text"] is not None:
+            self._by_text.setdefault((fingerprint["text"], variant), []).append(entry)
+        return entry
+
+    def record(self, duplicate: Dict[str, Any], original: Dict[str, Any], match: Dict[str, Any], saved_bytes: int, sent: bool):
+        """Una página fusionada con su original: saved_bytes dejaron de guardarse (y de enviarse, si sent)."""
+        self.duplicates.append({**duplicate, "duplicate_of": original, **match})
+        self.bytes_saved += saved_bytes
+        if sent:
+            self.payload_bytes_saved += saved_bytes
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "pages_saved": len(self.duplicates),
+            "renders_saved": self.renders_saved,
+            "bytes_saved": self.bytes_saved,
+            "payload_bytes_saved": self.payload_bytes_saved,
+            "duplicates": self.duplicates,
+        }
+
+
+async def iter_pdf_pages(document: Dict[str, Any], with_title_block: bool, roi: Optional[Dict[int, List[List[float]]]] = None,
+                         dedup: Optional[PageDeduplicator] = None):
+    """
+    Generador asíncrono de (página_completa, cajetín, escalón) por página, en el orden original,
+    para un documento ya validado por read_upload (los workers abren su archivo en disco).
+    Cada imagen es {"data", "mime_type", "text" (capa de texto), "file", "page", "revision_marks"}; None si su renderizado falló.
+    Con roi (página -> regiones normalizadas; {} = sólo las detectadas) la imagen es una vista
+    general y trae además "tiles": recortes de alta resolución con su "bbox" en la hoja.
+    El cajetín incluye además "cajetin": DWG/REV leídos de la capa de texto, si los hay.
+    Las imágenes se buscan primero en RENDER_CACHE; las páginas que faltan se reparten de
+    inmediato en el pool de procesos (una tarea por página) y cada página se entrega en
+    cuanto está lista, sin esperar al resto del documento.
+    Con dedup (uno por solicitud, compartido entre documentos) las páginas que faltan pasan
+    antes por _fingerprint_page_worker; las que duplican una página ya vista no se renderizan:
+    su imagen reutiliza los datos del original y trae "duplicate_of" (la imagen del original,
+    entregada antes) y "duplicate_match" ({"match", "distance"}).
+    """
+    global RENDER_POOL
+    filename, pdf_path, pdf_hash, page_count = document["filename"], document["path"], document["sha256"], document["page_count"]
+    budget_bytes = image_byte_budget()
+    roi_regions = [None if roi is None else roi.get(n + 1, []) for n in range(page_count)]
+    roi_settings = None if roi is None else (ROI_OVERVIEW_DPI, ROI_TILE_DPI_LADDER, ROI_TILE_MARGIN, ROI_MAX_EXPANSION)
+
+    full_keys = [
+        RenderCache.make_key(pdf_hash, n, "full", ladder=ENCODING_LADDER, budget=budget_bytes, text_layer=True,
+                             detector=REVISION_DETECTOR_VERSION if REVISION_DETECTOR_ENABLED else None,
+                             roi=roi_settings, roi_regions=roi_regions[n])
+        for n in range(page_count)
+    ]
+    crop_keys = [RenderCache.make_key(pdf_hash, n, "title_block", dpi=RENDER_DPI, box=TITLE_BLOCK_BOX, format="png", text_layer=True) for n in range(page_count)]
+
+    full_pages: List[Optional[Dict[str, Any]]] = [None] * page_count
+    title_blocks: List[Optional[Any]] = [None] * page_count
+    missing = []
+    # Abrir y leer los archivos de la caché bloquea: las consultas salen del event loop, una vez por documento
+    lookups = await asyncio.to_thread(
+        lambda: [(RENDER_CACHE.get(full_keys[n]), RENDER_CACHE.get(crop_keys[n]) if with_title_block else None) for n in range(page_count)]
+    )
+    for page_num, (cached_full, cached_crop) in enumerate(lookups):
+        if cached_full:
+            buffer, meta = cached_full
+            data, tiles = _split_tiles(buffer, meta)
+            full_pages[page_num] = {"data": data, "mime_type": meta["mime_type"], "encoding": meta["encoding"], "tiles": tiles,
+                                    "text": meta.get("text", ""), "revision_marks": meta.get("revision_marks"), "fingerprint": meta.get("fingerprint")}
+        if cached_crop:
+            buffer, meta = cached_crop
+            title_blocks[page_num] = (buffer, meta.get("cajetin"))
+        if full_pages[page_num] is None or (with_title_block and title_blocks[page_num] is None):
+            missing.append(page_num)
+
+    loop = asyncio.get_running_loop()
+    def submit(worker, *args):
+        return loop.run_in_executor(get_render_pool(), worker, *args)
+
+    def observe_steps(steps: Dict[str, float]):
+        for step, seconds in steps.items():
+            METRICS.observe("pid_render_step_seconds", seconds, step=step)
+        if steps:
+            METRICS.observe("pid_stage_seconds", sum(steps.values()), stage="render_page")
+
+    tasks = {}
+    planned, planner = None, None
+    originals: Dict[int, Dict[str, Any]] = {}      # página -> su entrada en dedup
+    phase1_steps: Dict[int, Dict[str, float]] = {} # página -> segundos de la primera fase
+    duplicates: Dict[int, Tuple[Dict[str, Any], str, int, Optional[Dict[str, Any]]]] = {} # página -> (entrada del original, coincidencia, distancia, primera fase)
+
+    async def plan_pages():
+        """
+        Recorre las páginas en orden: las que faltan pasan por la primera fase (con una
+        ventana de anticipación, para que el renderizado de las primeras no espere al resto)
+        y sólo las que no duplican una página ya vista se envían a renderizar.
+        """
+        global RENDER_POOL
+        window = max(2, 2 * RENDER_POOL_WORKERS)
+        pending = iter([n for n in missing if full_pages[n] is None])
+        upcoming = next(pending, None)
+        prepare_tasks = {}
+        try:
+            for page_num in range(page_count):
+                while upcoming is not None and upcoming < page_num + window:
+                    try:
+                        prepare_tasks[upcoming] = submit(_fingerprint_page_worker, pdf_path, upcoming, roi_regions[upcoming])
+                    except Exception as e:
+                        # Sin primera fase, esa página se renderiza sin pasar por dedup
+                        logging.error(f"Error al preparar la página {upcoming} de {filename}: {e}")
+                        if isinstance(e, BrokenProcessPool):
+                            RENDER_POOL = None
+                    upcoming = next(pending, None)
+                try:
+                    prepared = None
+                    if page_num in prepare_tasks:
+                        try:
+                            prepared = await prepare_tasks.pop(page_num)
+                            phase1_steps[page_num] = prepared["steps"]
+                        except Exception as e:
+                            logging.error(f"Error al preparar la página {page_num} de {filename}: {e}")
+                            if isinstance(e, BrokenProcessPool):
+                                RENDER_POOL = None
+                    info = prepared or full_pages[page_num]
+                    tiled = roi_regions[page_num] is not None
+                    match = None
+                    if info and info.get("fingerprint"):
+                        match = dedup.find(info["fingerprint"], info["revision_marks"], tiled)
+                        if match is None:
+                            originals[page_num] = dedup.register({"file": filename, "page": page_num + 1}, info["fingerprint"], info["revision_marks"], tiled)
+                    if match is not None:
+                        duplicates[page_num] = (*match, prepared)
+                    elif page_num in missing:
+                        tasks[page_num] = submit(_render_page_worker, pdf_path, page_num, full_pages[page_num] is None,
+                                                 with_title_block and title_blocks[page_num] is None, budget_bytes, roi_regions[page_num], prepared)
+                except Exception as e:
+                    # Sólo falla esta página (se entrega como fallida, salvo lo que haya en la caché); el resto sigue
+                    logging.error(f"Error al planificar la página {page_num} de {filename}: {e}")
+                    duplicates.pop(page_num, None)
+                    if isinstance(e, BrokenProcessPool):
+                        RENDER_POOL = None
+                planned[page_num].set_result(None)
+        finally:
+            for task in prepare_tasks.values():
+                task.cancel()
+
+    if dedup is None:
+        tasks = {
+            page_num: submit(_render_page_worker, pdf_path, page_num, full_pages[page_num] is None,
+                             with_title_block and title_blocks[page_num] is None, budget_bytes, roi_regions[page_num])
+            for page_num in missing
+        }
+    else:
+        planned = [loop.create_future() for _ in range(page_count)]
+        planner = asyncio.ensure_future(plan_pages())
+
+    try:
+        for page_num in range(page_count):
+            if planned is not None:
+                await planned[page_num]
+            cached = full_pages[page_num] is not None
+            reused = False
+            if page_num in duplicates:
+                entry, _, _, prepared = duplicates[page_num]
+                own = prepared or full_pages[page_num] # Texto y marcas propios de esta página
+                if entry["page"] is not None:
+                    full_pages[page_num] = {**entry["page"], "text": own["text"], "revision_marks": own["revision_marks"], "steps": None}
+                    reused = not cached
+                    if reused:
+                        dedup.renders_saved += 1
+                    observe_steps(phase1_steps.pop(page_num, {}))
+                    if with_title_block and title_blocks[page_num] is None:
+                        if entry["title_block"] is not None:
+                            title_blocks[page_num] = entry["title_block"]
+                        else:
+                            tasks[page_num] = submit(_render_page_worker, pdf_path, page_num, False, True, budget_bytes)
+                else:
+                    # El original no llegó a renderizarse: esta página se renderiza por su cuenta
+                    del duplicates[page_num]
+                    if page_num in missing:
+                        tasks[page_num] = submit(_render_page_worker, pdf_path, page_num, full_pages[page_num] is None,
+                                                 with_title_block and title_blocks[page_num] is None, budget_bytes, roi_regions[page_num], prepared)
+            if page_num in tasks:
+                try:
+                    result = await tasks[page_num]
+                except Exception as e:
+                    logging.error(f"Error al renderizar página {page_num} de {filename}: {e}")
+                    if isinstance(e, BrokenProcessPool):
+                        RENDER_POOL = None # Se recrea en la siguiente solicitud
+                    result = {"full": None, "title_block": None}
+                steps = {**phase1_steps.pop(page_num, {}), **(result.get("steps") or {})}
+                observe_steps(steps)
+                if result["full"] is not None:
+                    blob, tiles_meta = _join_tiles(result["full"], result["tiles"])
+                    meta = {"mime_type": result["full_mime"], "encoding": result["encoding"], "text": result["text"], "revision_marks": result["revision_marks"],
+                            "fingerprint": result["fingerprint"], **tiles_meta}
+                    # La sesión y el payload usan vistas sobre el mismo blob que se escribe en la caché
+                    data, tiles = _split_tiles(blob, meta)
+                    full_pages[page_num] = {"data": data, "mime_type": result["full_mime"], "encoding": result["encoding"], "tiles": tiles,
+                                            "text": result["text"], "revision_marks": result["revision_marks"], "fingerprint": result["fingerprint"], "steps": steps}
+                    await asyncio.to_thread(RENDER_CACHE.put, full_keys[page_num], blob, meta)
+                if result["title_block"] is not None:
+                    title_blocks[page_num] = (result["title_block"], result["cajetin"])
+                    meta = {"mime_type": "image/png", "cajetin": result["cajetin"]}
+                    await asyncio.to_thread(RENDER_CACHE.put, crop_keys[page_num], result["title_block"], meta)
+            METRICS.inc("pid_pages_total", source="cache" if cached else ("duplicate" if reused else ("render" if full_pages[page_num] is not None else "failed")))
+
+            full_image, crop_image, encoding = None, None, None # Placeholders si falla
+            if full_pages[page_num] is not None:
+                page = full_pages[page_num]
+                full_image = {"data": page["data"], "mime_type": page["mime_type"], "text": page["text"], "file": filename, "page": page_num + 1, "revision_marks": page["revision_marks"]}
+                if page["tiles"]:
+                    full_image["tiles"] = page["tiles"]
+                encoding = {"file": filename, "page": page_num + 1, **page["encoding"]}
+                encoding.update(page_token_report(encoding, full_image))
+                if page.get("steps"):
+                    # Sólo las páginas renderizadas en esta solicitud (no las servidas desde la caché)
+                    encoding["render_seconds"] = {step: round(seconds, 4) for step, seconds in page["steps"].items()}
+                if encoding["over_budget"]:
+                    logging.warning(f"Página {page_num + 1} de {filename} supera el presupuesto incluso en el último escalón ({encoding['bytes']/1024/1024:.2f}MB).")
+            if title_blocks[page_num] is not None:
+                data, cajetin = title_blocks[page_num]
+                crop_image = {"data": data, "mime_type": "image/png", "cajetin": cajetin}
+            if page_num in originals:
+                entry = originals[page_num]
+                entry.update(page=full_pages[page_num], title_block=title_blocks[page_num], image=full_image)
+            elif page_num in duplicates and full_image is not None:
+                entry, match, distance, _ = duplicates[page_num]
+                full_image["duplicate_of"] = entry["image"]
+                full_image["duplicate_match"] = {"match": match, "distance": distance}
+                encoding["duplicate_of"] = entry["source"]
+            yield full_image, crop_image, encoding
+    finally:
+        # Si el consumidor abandona el documento, las páginas pendientes no llegan a renderizarse
+        if planner is not None:
+            planner.cancel()
+        for task in tasks.values():
+            task.cancel()
+
+# --- FIN: POOL DE RENDERIZADO ---
+
+
+def validate_pdf(path: str, filename: str) -> int:
+    """Abre el PDF desde disco y valida páginas y dimensiones antes de renderizar. Devuelve el número de páginas."""
+    try:
+        pdf_document = fitz.open(path, filetype="pdf")
+    except Exception as e:
+        # El mensaje de PyMuPDF incluye la ruta del archivo temporal: no se devuelve al cliente
+        logging.warning(f"No se pudo abrir el PDF '{filename}': {e}")
+        raise HTTPException(status_code=400, detail=f"Error al procesar el PDF '{filename}': el archivo está dañado o no es un PDF.")
+    with pdf_document:
+        if pdf_document.needs_pass:
+            raise HTTPException(status_code=400, detail=f"El PDF '{filename}' está protegido con contraseña.")
+        if pdf_document.page_count == 0:
+            raise HTTPException(status_code=400, detail=f"El PDF '{filename}' no tiene páginas.")
+        if pdf_document.page_count > PDF_MAX_PAGES:
+            raise HTTPException(status_code=413, detail=f"El PDF '{filename}' tiene {pdf_document.page_count} páginas; el máximo es {PDF_MAX_PAGES}.")
+        for page in pdf_document:
+            rect = page.rect
+            if rect.is_empty or max(rect.width, rect.height) / 72 > PDF_MAX_PAGE_SIDE_INCHES:
+                raise HTTPException(status_code=400, detail=f"La página {page.number + 1} de '{filename}' tiene dimensiones no soportadas "
+                                                            f"({rect.width / 72:.1f}x{rect.height / 72:.1f} pulgadas; máximo {PDF_MAX_PAGE_SIDE_INCHES:g}).")
+        return pdf_document.page_count
+
+
+def _spool_chunk(spool, digest, chunk: bytes):
+    digest.update(chunk)
+    spool.write(chunk)
+
+
+async def read_upload(file: UploadFile) -> Dict[str, Any]:
+    """
+    Copia un archivo subido a UPLOAD_SPOOL_DIR por fragmentos y devuelve el documento
+    {"filename", "content_type", "path", "size", "sha256", "page_count"}.
+    El UploadFile sólo es válido durante la solicitud; el documento puede procesarse después
+    (respuestas en streaming, trabajos en segundo plano) y su archivo se borra con discard_documents.
+    Se rechaza en cuanto se sabe que no es un PDF o que supera UPLOAD_MAX_MB.
+    """
+    if file.content_type != "application/pdf":
+        raise HTTPException(status_code=400, detail=f"Tipo de archivo no soportado: '{file.content_type}'. Solo se aceptan archivos PDF.")
+    max_bytes = int(UPLOAD_MAX_MB * 1024 * 1024)
+    spool_dir = process_scratch_dir(UPLOAD_SPOOL_DIR)
+    await asyncio.to_thread(os.makedirs, spool_dir, exist_ok=True)
+    spool = await asyncio.to_thread(tempfile.NamedTemporaryFile, dir=spool_dir, suffix=".pdf", delete=False)
+    document = {"filename": file.filename, "content_type": file.content_type, "path": spool.name, "size": 0}
+    digest = hashlib.sha256()
+    try:
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                # La cabecera %PDF- puede ir precedida de basura, pero siempre dentro del primer KB
+                if document["size"] == 0 and b"%PDF-" not in chunk[:1024]:
+                    raise HTTPException(status_code=400, detail=f"El archivo '{file.filename}' no es un PDF válido.")
+                document["size"] += len(chunk)
+                if document["size"] > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"El archivo '{file.filename}' supera el tamaño máximo de {UPLOAD_MAX_MB:g} MB.")
+                await asyncio.to_thread(_spool_chunk, spool, digest, chunk)
+        finally:
+            spool.close()
+        if document["size"] == 0:
+            raise HTTPException(status_code=400, detail=f"El archivo '{file.filename}' está vacío.")
+        document["sha256"] = digest.hexdigest()
+        document["page_count"] = await asyncio.to_thread(validate_pdf, document["path"], file.filename)
+    except BaseException:
+        discard_documents([document])
+        raise
+    logging.info(f"Archivo '{file.filename}' recibido: {document['size'] / 1024 / 1024:.2f} MB, {document['page_count']} página(s).")
+    return document
+
+
+async def read_uploads(*groups: Optional[List[UploadFile]]) -> List[List[Dict[str, Any]]]:
+    """read_upload para cada grupo de archivos; si uno falla, se borran los ya copiados."""
+    documents = [[] for _ in groups]
+    try:
+        for group, files in zip(documents, groups):
+            for file in files or []:
+                group.append(await read_upload(file))
+    except BaseException:
+        discard_documents([document for group in documents for document in group])
+        raise
+    return documents
+
+
+def discard_documents(documents: List[Dict[str, Any]]):
+    """Borra los archivos en disco de los documentos; se puede llamar más de una vez."""
+    for document in documents:
+        try:
+            os.remove(document["path"])
+        except OSError:
+            pass
+
+
+async def process_pdf_pages_with_crops(document: Dict[str, Any], with_title_block: bool = True, roi: Optional[Dict[int, List[List[float]]]] = None,
+                                       dedup: Optional[PageDeduplicator] = None):
+    """
+    Procesa un archivo PDF página a página. Genera, en orden, tuplas con:
+    1. full_page: Imagen de la página completa (para análisis de riesgos); con roi, vista
+       general de baja resolución más recortes de alta resolución alrededor de los cambios.
+    2. title_block: Imagen recortada del cajetín (para extracción de DWG/REV), si se pide.
+    3. encoding: Escalón de codificación usado en la página.
+    El renderizado se ejecuta en el pool de procesos, una tarea por página; con dedup, las
+    páginas repetidas dentro de la solicitud no se renderizan (ver iter_pdf_pages).
+    """
+    try:
+        pages = iter_pdf_pages(document, with_title_block, roi, dedup)
+        async for page in pages:
+            yield page
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error al procesar el PDF '{document['filename']}': {e}")
+
+
+# --- INICIO: CLIENTE HTTP COMPARTIDO (AZURE OPENAI) ---
+# Un único cliente por proceso reutiliza las conexiones TCP/TLS entre llamadas.
+# HTTP/2 (multiplexación) sólo se activa si el paquete 'h2' está instalado.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+HTTP_TRANSPORT: Optional[httpx.AsyncHTTPTransport] = None
+HTTP_STATS = {"requests": 0, "errors": 0, "in_flight": 0, "peak_in_flight": 0}
+
+def get_http_client() -> httpx.AsyncClient:
+    global HTTP_CLIENT, HTTP_TRANSPORT
+    if HTTP_CLIENT is None:
+        limits = httpx.Limits(
+            max_connections=AZURE_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AZURE_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AZURE_HTTP_KEEPALIVE_EXPIRY,
+        )
+        HTTP_TRANSPORT = httpx.AsyncHTTPTransport(http2=AZURE_HTTP2 and HTTP2_AVAILABLE, limits=limits)
+        HTTP_CLIENT = httpx.AsyncClient(transport=HTTP_TRANSPORT, timeout=120.0)
+        logging.info(f"Cliente HTTP compartido iniciado (max_connections={AZURE_HTTP_MAX_CONNECTIONS}, http2={AZURE_HTTP2 and HTTP2_AVAILABLE}).")
+    return HTTP_CLIENT
+
+# Cuerpo JSON de las solicitudes a Azure escrito por fragmentos: las imágenes (DataURL) se
+# codifican en base64 a medida que se envían, sin armar el JSON completo en memoria.
+REQUEST_BODY_CHUNK_BYTES = 192 * 1024
+
+def _json_parts(value):
+    """Fragmentos del JSON de value: bytes ya serializados o DataURL pendientes de codificar."""
+    if isinstance(value, DataURL):
+        yield b'"'
+        yield value
+        yield b'"'
+    elif isinstance(value, dict):
+        yield b"{"
+        for i, (key, item) in enumerate(value.items()):
+            yield (b"," if i else b"") + json.dumps(str(key)).encode("utf-8") + b":"
+            yield from _json_parts(item)
+        yield b"}"
+    elif isinstance(value, (list, tuple)):
+        yield b"["
+        for i, item in enumerate(value):
+            if i:
+                yield b","
+            yield from _json_parts(item)
+        yield b"]"
+    else:
+        yield json.dumps(value).encode("utf-8")
+
+
+def json_body_length(payload: Dict[str, Any]) -> int:
+    """Bytes exactos del cuerpo que escribe iter_json_body, sin codificar las imágenes."""
+    return sum(len(part) for part in _json_parts(payload))
+
+
+async def iter_json_body(payload: Dict[str, Any], chunk_size: int = REQUEST_BODY_CHUNK_BYTES):
+    """Cuerpo JSON de payload en fragmentos de hasta ~chunk_size bytes."""
+    pending, pending_size = [], 0
+    for part in _json_parts(payload):
+        if isinstance(part, DataURL):
+            if pending:
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+            for chunk in part.iter_chunks(chunk_size):
+                yield chunk
+            continue
+        pending.append(part)
+        pending_size += len(part)
+        if pending_size >= chunk_size:
+            yield b"".join(pending)
+            pending, pending_size = [], 0
+    if pending:
+        yield b"".join(pending)
+
+
+@app.on_event("startup")
+async def open_http_client():
+    get_http_client()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    global HTTP_CLIENT, HTTP_TRANSPORT
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT, HTTP_TRANSPORT = None, None
+
+def http_pool_stats() -> Dict[str, Any]:
+    # httpx no expone el pool de conexiones; se lee del pool de httpcore si está disponible
+    connections = getattr(getattr(HTTP_TRANSPORT, "_pool", None), "connections", [])
+    return {
+        **HTTP_STATS,
+        "http2": AZURE_HTTP2 and HTTP2_AVAILABLE,
+        "max_connections": AZURE_HTTP_MAX_CONNECTIONS,
+        "max_keepalive_connections": AZURE_HTTP_MAX_KEEPALIVE,
+        "open_connections": len(connections),
+        "idle_connections": sum(1 for conn in connections if conn.is_idle()),
+    }
+
+
+# --- PLANIFICADOR GLOBAL DE SOLICITUDES ---
+# Prioridades (menor = antes): el chat es interactivo y no debe esperar detrás de análisis grandes.
+PRIORITY_CHAT = 0
+PRIORITY_EXTRACTION = 1
+PRIORITY_ANALYSIS = 2
+REQUEST_KINDS = {PRIORITY_CHAT: "chat", PRIORITY_EXTRACTION: "extraction", PRIORITY_ANALYSIS: "analysis"} # Etiqueta de las métricas
+
+# Estimación conservadora por imagen en detalle alto; sirve para medir la cuota TPM
+ESTIMATED_TOKENS_PER_IMAGE = 1105 # Respaldo cuando no se pueden leer las dimensiones de una imagen
+
+# --- MODELO DE COSTO EN TOKENS DE IMÁGENES ---
+# Azure OpenAI cobra y limita las imágenes por teselas de 512 px, no por bytes: con detail
+# "low" cuestan 85 tokens fijos; con "high" (y "auto", que se estima como "high") la imagen
+# se ajusta a 2048x2048, luego su lado corto a 768, y cuesta 85 + 170 por tesela.
+IMAGE_TOKENS_BASE = 85
+IMAGE_TOKENS_PER_TILE = 170
+IMAGE_DETAIL_LEVELS = ("low", "high")
+
+def image_tokens(width: float, height: float, detail: str = "high") -> int:
+    if detail == "low" or not width or not height:
+        return IMAGE_TOKENS_BASE
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return IMAGE_TOKENS_BASE + IMAGE_TOKENS_PER_TILE * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def header_dimensions(head) -> Optional[Tuple[int, int]]:
+    """(ancho, alto) leídos de la cabecera PNG/JPEG/WebP; basta con los primeros KB del archivo."""
+    try:
+        with Image.open(BytesIO(bytes(head))) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def image_size(image: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """Dimensiones en píxeles de una imagen {"data", ...}; se guardan en la propia imagen."""
+    if "size" not in image:
+        image["size"] = header_dimensions(image["data"][:8192])
+    return image["size"]
+
+
+def image_tokens_of(image: Dict[str, Any], detail: str = "high") -> int:
+    """Tokens de una página (o imagen de leyenda) incluidos sus recortes ROI."""
+    total = 0
+    for part in [image] + image.get("tiles", []):
+        size = image_size(part)
+        total += image_tokens(*size, detail) if size else ESTIMATED_TOKENS_PER_IMAGE
+    return total
+
+
+def page_token_report(encoding: Dict[str, Any], image: Dict[str, Any]) -> Dict[str, Any]:
+    """Tokens de la página enviada en cada nivel de detalle y, en "high", en cada escalón de la escalera."""
+    report = {"tokens": {detail: image_tokens_of(image, detail) for detail in IMAGE_DETAIL_LEVELS}}
+    page_points = encoding.get("page_points")
+    if page_points:
+        width, height = page_points
+        report["tokens_by_rung"] = {name: image_tokens(width / 72 * dpi, height / 72 * dpi) for name, dpi, _, _ in ENCODING_LADDER}
+    return report
+
+
+def _data_url_dimensions(url) -> Optional[Tuple[int, int]]:
+    if isinstance(url, DataURL):
+        return header_dimensions(url.data[:8192])
+    head = url.split(",", 1)[1][:10920] # Múltiplo de 4: ~8 KB decodificados
+    try:
+        return header_dimensions(base64.b64decode(head))
+    except ValueError:
+        return None
+
+
+def estimate_payload_tokens(payload: Dict[str, Any], include_completion: bool = True) -> int:
+    """Tokens aproximados de una solicitud: texto (~4 caracteres/token) + imágenes por teselas + max_tokens."""
+    text_chars, image_total = 0, 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content or []:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                size = _data_url_dimensions(part["image_url"]["url"])
+                image_total += image_tokens(*size, part["image_url"].get("detail", "high")) if size else ESTIMATED_TOKENS_PER_IMAGE
+            elif isinstance(part, dict):
+                text_chars += len(part.get("text", ""))
+    return text_chars // 4 + image_total + (payload.get("max_tokens", 0) if include_completion else 0)
+
+
+class AzureRequestScheduler:
+    """
+    Planificador de proceso para las llamadas a Azure OpenAI. Mide solicitudes y tokens
+    estimados en una ventana deslizante de 60 s contra AZURE_RPM_LIMIT / AZURE_TPM_LIMIT,
+    limita la concurrencia y despacha por prioridad. Un 429 pausa todo el despacho
+    durante el Retry-After indicado por Azure.
+    """
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, rpm_limit: int, tpm_limit: int, max_concurrency: int):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.max_concurrency = max_concurrency
+        self._queue: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._window: "deque[Tuple[float, int]]" = deque()
+        self._window_tokens = 0
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wait_times: "deque[float]" = deque(maxlen=1000)
+        self.dispatched = 0
+        self.throttled = 0
+        self.retries = 0
+        self.server_errors = 0
+
+    def start(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def acquire(self, priority: int, tokens: int):
+        """Espera turno. Cada acquire() debe ir seguido de release()."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, future))
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # El turno ya se había concedido
+            raise
+        self._wait_times.append(time.monotonic() - enqueued_at)
+
+    def release(self):
+        self._in_flight -= 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pause(self, seconds: float):
+        """Detiene el despacho (p. ej. tras un 429 con Retry-After)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _delay_for(self, tokens: int, now: float) -> Optional[float]:
+        """Segundos a esperar antes de despachar; None si hay que esperar a un release()."""
+        while self._window and self._window[0][0] <= now - self.WINDOW_SECONDS:
+            self._window_tokens -= self._window.popleft()[1]
+        if self._in_flight >= self.max_concurrency:
+            return None
+        delay = self._blocked_until - now
+        if self._window:
+            window_free_at = self._window[0][0] + self.WINDOW_SECONDS - now
+            if self.rpm_limit and len(self._window) >= self.rpm_limit:
+                delay = max(delay, window_free_at)
+            # Una solicitud mayor que la cuota entera sólo espera a que la ventana se vacíe
+            if self.tpm_limit and self._window_tokens + tokens > self.tpm_limit:
+                delay = max(delay, window_free_at)
+        return max(delay, 0.0)
+
+    async def _run(self):
+        while True:
+            while self._queue and self._queue[0][3].cancelled():
+                heapq.heappop(self._queue)
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, _, tokens, future = self._queue[0]
+            now = time.monotonic()
+            delay = self._delay_for(tokens, now)
+            if delay is None or delay > 0:
+                # Despertar ante un release() o una solicitud de mayor prioridad
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._queue)
+            self._window.append((now, tokens))
+            self._window_tokens += tokens
+            self._in_flight += 1
+            self.dispatched += 1
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._wait_times)
+        def percentile(p):
+            return round(waits[max(0, math.ceil(p * len(waits)) - 1)], 3) if waits else 0.0 # Rango más cercano
+        return {
+            "queue_depth": len(self._queue),
+            "in_flight": self._in_flight,
+            "window_requests": len(self._window),
+            "window_tokens": self._window_tokens,
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+            "paused_for_seconds": round(max(0.0, self._blocked_until - time.monotonic()), 3),
+            "dispatched": self.dispatched,
+            "throttled_429": self.throttled,
+            "server_errors_5xx": self.server_errors,
+            "retries": self.retries,
+            "wait_seconds_p50": percentile(0.50),
+            "wait_seconds_p95": percentile(0.95),
+            "wait_seconds_max": round(waits[-1], 3) if waits else 0.0,
+        }
+
+
+def worker_share(limit: int) -> int:
+    """Parte de una cuota global que le toca a este worker (0 sigue siendo sin límite)."""
+    return max(1, limit // WEB_CONCURRENCY) if limit else 0
+
+
+AZURE_SCHEDULER = AzureRequestScheduler(worker_share(AZURE_RPM_LIMIT), worker_share(AZURE_TPM_LIMIT), AZURE_MAX_CONCURRENCY)
+
+@app.on_event("startup")
+async def start_azure_scheduler():
+    AZURE_SCHEDULER.start()
+
+@app.on_event("shutdown")
+async def stop_azure_scheduler():
+    await AZURE_SCHEDULER.stop()
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Lee retry-after-ms / Retry-After (segundos o fecha HTTP) de la respuesta de Azure."""
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Backoff exponencial con jitter completo."""
+    return random.uniform(0, min(AZURE_BACKOFF_MAX_SECONDS, AZURE_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+async def send_analysis_request(payload, timeout: float = 300.0, priority: int = PRIORITY_ANALYSIS, attempt_timing: Optional[Dict[str, Any]] = None):
+    """
+    Envía una solicitud de chat/completions a través de AZURE_SCHEDULER. Los 429 y 5xx
+    (y errores de red) se reintentan hasta AZURE_MAX_RETRIES veces con backoff.
+    attempt_timing, si se indica, recibe "seconds" (sólo el intento HTTP que respondió bien,
+    sin la espera en la cola del planificador ni los reintentos) y "attempts".
+    """
+    full_endpoint = f"{AZURE_ENDPOINT}openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={API_VERSION}"
+    kind = REQUEST_KINDS.get(priority, "analysis")
+    body_length = json_body_length(payload)
+    METRICS.observe("pid_azure_request_body_bytes", body_length, kind=kind)
+    # Con Content-Length conocido el cuerpo se envía en streaming sin codificación chunked
+    headers = {"Content-Type": "application/json", "Content-Length": str(body_length), "api-key": AZURE_API_KEY}
+    estimated_tokens = estimate_payload_tokens(payload)
+
+    for attempt in range(AZURE_MAX_RETRIES + 1):
+        last_attempt = attempt == AZURE_MAX_RETRIES
+        await AZURE_SCHEDULER.acquire(priority, estimated_tokens)
+        HTTP_STATS["requests"] += 1
+        HTTP_STATS["in_flight"] += 1
+        HTTP_STATS["peak_in_flight"] = max(HTTP_STATS["peak_in_flight"], HTTP_STATS["in_flight"])
+        started = time.monotonic()
+        try:
+            # Cada intento vuelve a generar el cuerpo desde las imágenes de la sesión
+            response = await get_http_client().post(full_endpoint, content=iter_json_body(payload), headers=headers, timeout=timeout)
+        except httpx.TransportError as e:
+            HTTP_STATS["errors"] += 1
+            METRICS.inc("pid_azure_responses_total", kind=kind, status="error")
+            if last_attempt:
+                raise
+            delay = backoff_seconds(attempt)
+            logging.warning(f"Error de red con Azure ({e!r}); reintento {attempt + 1} en {delay:.1f}s.")
+            AZURE_SCHEDULER.retries += 1
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            attempt_seconds = time.monotonic() - started
+            HTTP_STATS["in_flight"] -= 1
+            AZURE_SCHEDULER.release()
+            METRICS.observe("pid_azure_request_seconds", attempt_seconds, kind=kind)
+        METRICS.inc("pid_azure_responses_total", kind=kind, status=str(response.status_code))
+
+        if response.status_code == 429 or response.status_code >= 500:
+            HTTP_STATS["errors"] += 1
+            if response.status_code == 429:
+                AZURE_SCHEDULER.throttled += 1
+                METRICS.inc("pid_azure_throttled_total")
+            else:
+                AZURE_SCHEDULER.server_errors += 1
+                METRICS.inc("pid_azure_server_errors_total")
+            if not last_attempt:
+                AZURE_SCHEDULER.retries += 1
+                retry_after = retry_after_seconds(response)
+                if response.status_code == 429:
+                    # Pausa global: ninguna otra solicitud sale hasta que Azure lo permita
+                    delay = (retry_after if retry_after is not None else backoff_seconds(attempt)) + random.uniform(0, 1)
+                    logging.warning(f"Azure devolvió 429; se pausa el despacho {delay:.1f}s (reintento {attempt + 1}).")
+                    AZURE_SCHEDULER.pause(delay)
+                else:
+                    delay = retry_after if retry_after is not None else backoff_seconds(attempt)
+                    logging.warning(f"Azure devolvió {response.status_code}; reintento {attempt + 1} en {delay:.1f}s.")
+                    await asyncio.sleep(delay)
+                continue
+
+        if response.is_error:
+            HTTP_STATS["errors"] += 1
+        response.raise_for_status()
+        result = response.json()
+        if attempt_timing is not None:
+            attempt_timing.update(seconds=round(attempt_seconds, 3), attempts=attempt + 1)
+        METRICS.inc("pid_tokens_total", estimated_tokens - payload.get("max_tokens", 0), kind=kind, type="estimated_prompt")
+        for field in ("prompt", "completion"):
+            METRICS.inc("pid_tokens_total", (result.get("usage") or {}).get(f"{field}_tokens") or 0, kind=kind, type=field)
+        return result
+# --- FIN: CLIENTE HTTP COMPARTIDO ---
+
+
+# --- (MODIFICADO) ENDPOINT /analyze ---
+NO_REVISION_MARKS_MESSAGE = "No se encontraron marcas de revisión"
+NO_REVISION_MARKS_DETAIL = "No se encontraron marcas de revisión (nubes rojas o sombreado gris) en los planos para analizar."
+
+def parse_batch_result(result: Dict[str, Any]) -> (List[Dict[str, Any]], Optional[str]):
+    """Extrae (riesgos, nota de error) de la respuesta de un lote."""
+    analysis_content_str = result.get("choices", [{}])[0].get("message", {}).get("content")
+    if not analysis_content_str:
+        return [], None
+    try:
+        analysis_json = json.loads(analysis_content_str)
+    except json.JSONDecodeError as json_err:
+        logging.error(f"Error al decodificar JSON de la API: {json_err}. Respuesta: {analysis_content_str[:200]}...")
+        return [], None
+    if "riesgos_identificados" in analysis_json:
+        return analysis_json["riesgos_identificados"], None
+    if "error" in analysis_json:
+        # Esta es la única salida de error esperada
+        if NO_REVISION_MARKS_MESSAGE in analysis_json.get("error", ""):
+            logging.info("Se detectó un lote sin marcas de revisión.")
+        else:
+            logging.warning(f"Un lote devolvió un error genérico: {analysis_json['error']}")
+        return [], analysis_json["error"]
+    return [], None
+
+
+# Subtítulos en los que el prompt pide dividir "recomendacion"; se separa una sola vez al combinar los lotes
+RECOMENDACION_SECTIONS = {
+    "mitigaciones existentes": "mitigaciones_existentes",
+    "recomendación principal": "recomendacion_principal",
+    "alternativa práctica": "alternativa_practica",
+}
+RECOMENDACION_HEADING_PATTERN = re.compile(r"(Mitigaciones Existentes|Recomendación Principal|Alternativa Práctica):", re.IGNORECASE)
+
+def parse_recomendacion(text: Any) -> Dict[str, str]:
+    """
+    Divide una recomendación en sus secciones. Cada sección va desde su subtítulo hasta el
+    siguiente (o el final); si un subtítulo se repite vale el primero; las que faltan quedan en "N/A".
+    Corre al combinar los lotes: un valor que no es texto (null, una lista) no puede hacer fallar el análisis.
+    """
+    if not isinstance(text, str):
+        text = " ".join(str(part) for part in text) if isinstance(text, list) else str(text or "")
+    parts = {}
+    headings = list(RECOMENDACION_HEADING_PATTERN.finditer(text))
+    for i, heading in enumerate(headings):
+        key = RECOMENDACION_SECTIONS[heading.group(1).lower()]
+        if key not in parts:
+            end = headings[i + 1].start() if i + 1 < len(headings) else len(text)
+            parts[key] = text[heading.end():end].strip().replace('\n', ' ')
+    return {key: parts.get(key, "N/A") for key in RECOMENDACION_SECTIONS.values()}
+
+
+def attach_late_sources(risks: List[Dict[str, Any]], image_batch: List[Dict[str, Any]], sent_sources: List[int], cajetin_items: List[Dict[str, Any]]):
+    """
+    Los duplicados de una hoja que aparecieron después de armar el payload de su lote no
+    llegaron al modelo: sus ubicaciones se agregan a la "ubicacion" de los riesgos de esa hoja,
+    reconocida por su DWG No (o, si el lote tiene una sola imagen, sin más). sent_sources es
+    cuántas ubicaciones tenía cada imagen al enviarse; cajetin_items se indexa con pagina - 1.
+    """
+    late = []
+    for image, sent in zip(image_batch, sent_sources):
+        sources = image.get("sources", [])
+        if len(sources) > max(sent, 1): # Sin "sources" al enviarse, la primera es la propia imagen
+            items = [cajetin_items[pagina - 1] for pagina in image_plano_pages(image)]
+            dwg_nos = {str(item["dwg_no"] or "").upper() for item in items if item["fuente"] != "ninguna"} - {""}
+            late.append((dwg_nos, sources[max(sent, 1):]))
+    if not late:
+        return
+    for risk in risks:
+        ubicacion = str(risk.get("ubicacion") or "")
+        matched = [sources for dwg_nos, sources in late if any(dwg_no in ubicacion.upper() for dwg_no in dwg_nos)]
+        if not matched and len(image_batch) == 1:
+            matched = [late[0][1]]
+        extra = [source for sources in matched for source in sources]
+        if extra:
+            risk["ubicacion"] = f"{ubicacion} (la misma hoja aparece también en: {sources_text(extra)})"
+
+
+def local_title_block_item(plano_page: int, title_block: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Etapa 1 (local): DWG No y REV de un plano leídos de la capa de texto del PDF.
+    "fuente" queda en "texto_pdf" si la confianza basta, o en "ninguna" si hace falta el modelo.
+    """
+    item = {"pagina": plano_page, "dwg_no": "No encontrado", "rev": "No encontrado", "fuente": "ninguna", "confianza": 0.0}
+    local = (title_block or {}).get("cajetin")
+    if local and local["confidence"] >= CAJETIN_LOCAL_MIN_CONFIDENCE:
+        item.update(dwg_no=local["dwg_no"], rev=local["rev"], fuente="texto_pdf", confianza=local["confidence"])
+    return item
+
+
+def copy_title_block_fields(source: Dict[str, Any], item: Dict[str, Any]):
+    """Copia DWG/REV de un cajetín a otro plano que es la misma hoja (su "pagina" no cambia)."""
+    item.update(dwg_no=source["dwg_no"], rev=source["rev"], fuente=source["fuente"], confianza=source["confianza"])
+
+
+async def extract_title_blocks(session_id: str, pending: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """
+    Etapa 1 (modelo): envía al modelo los cajetines que no se resolvieron localmente.
+    pending es una lista de (item, imagen del cajetín); los items se actualizan en el sitio.
+    Los errores se registran y los items quedan como "No encontrado".
+    Devuelve el consumo de la llamada (ver usage_record), o None si no hubo llamada.
+    """
+    if not pending:
+        return None
+    usage = None
+    try:
+        extraction_content = [{"type": "text", "text": "Extrae el DWG No y REV de las siguientes imágenes de cajetín."}]
+        extraction_content.extend([image_content(title_block) for _, title_block in pending])
+        
+        payload_extraccion = {
+            "messages": [
+                {"role": "system", "content": PROMPT_EXTRACCION_CAJETIN},
+                {"role": "user", "content": extraction_content}
+            ],
+            "max_tokens": 1024, "temperature": 0.0,
+            "response_format": {"type": "json_object"}
+        }
+        usage = usage_record(payload_extraccion)
+        extraction_result = await send_analysis_request(payload_extraccion, timeout=120.0, priority=PRIORITY_EXTRACTION)
+        usage = usage_record(payload_extraccion, extraction_result)
+            
+        content_str = extraction_result.get("choices", [{}])[0].get("message", {}).get("content")
+        if content_str:
+            extracted_data = json.loads(content_str).get("extracciones", [])
+            # El modelo responde una entrada por imagen, en el orden en que se enviaron
+            for (item, _), extracted in zip(pending, extracted_data):
+                item.update(
+                    dwg_no=extracted.get('dwg_no', 'No encontrado'),
+                    rev=extracted.get('rev', 'No encontrado'),
+                    fuente="modelo",
+                    confianza=None,
+                )
+            logging.info(f"Sesión {session_id}: Extracción de {len(pending)} cajetín(es) con el modelo exitosa.")
+        
+    except Exception as e:
+        logging.error(f"Sesión {session_id}: Error en Etapa 1 (Extracción de cajetín): {e}")
+    return usage
+
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+def usage_record(payload: Dict[str, Any], result: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Tokens de entrada estimados de una llamada junto al "usage" que devolvió Azure (None si falló)."""
+    return {"estimated_prompt_tokens": estimate_payload_tokens(payload, include_completion=False), "usage": (result or {}).get("usage")}
+
+
+def add_usage(totals: Dict[str, Any], record: Optional[Dict[str, Any]]):
+    """Acumula un usage_record en los totales de un análisis."""
+    if not record:
+        return
+    totals["calls"] += 1
+    totals["estimated_prompt_tokens"] += record["estimated_prompt_tokens"]
+    usage = record.get("usage")
+    if usage:
+        totals["reported_calls"] += 1
+        for field in USAGE_FIELDS:
+            totals[field] += usage.get(field) or 0
+
+
+def cajetin_text(items: List[Dict[str, Any]]) -> str:
+    """Bloque de texto con los datos de cajetín que se inyecta en el prompt de la Etapa 2."""
+    texto_items = [f"Plano (Página {item['pagina']}): DWG No: {item['dwg_no']}, REV: {item['rev']}" for item in items]
+    if not any(item["fuente"] != "ninguna" for item in items):
+        return "--- INFORMACIÓN DE CAJETÍN (Fuente de Verdad) ---\nNo se pudo extraer información del cajetín."
+    return "--- INFORMACIÓN DE CAJETÍN (Fuente de Verdad) ---\n" + "\n".join(texto_items) + "\n--- FIN INFORMACIÓN DE CAJETÍN ---"
+
+
+def build_analysis_payload(batch_number: int, image_batch: List[Dict[str, Any]], with_planos: bool, info_extraida_texto: Optional[str] = None) -> Dict[str, Any]:
+    """Payload de la Etapa 2 para un lote. El total de lotes no se conoce al despachar, por eso sólo se numera."""
+    if not with_planos:
+        # --- CASO 1: SÓLO ALCANCE ---
+        user_content = [{"type": "text", "text": "Analiza los siguientes documentos de alcance y devuelve tu análisis exclusivamente en formato JSON."}]
+        # (Opcional: puedes incluir la base de conocimiento si es relevante para el alcance)
+        # if LEGEND_INDEX.tiles: ...
+        user_content.append({"type": "text", "text": f"--- INICIO: DOCUMENTOS DE ALCANCE (LOTE {batch_number + 1}) ---"})
+        user_content.extend([block for image in image_batch for block in page_content(image)])
+        system_prompt = PROMPT_ANALISTA_ALCANCE # <-- USAR NUEVO PROMPT
+    else:
+        # --- CASO 2: HAY PLANOS (y posiblemente alcance) ---
+        user_content = [{"type": "text", "text": "Analiza los siguientes documentos y devuelve tu análisis exclusivamente en formato JSON."}]
+        # Sólo las secciones de leyenda que aparecen en el texto de las páginas del lote
+        user_content.extend(LEGEND_INDEX.content(" ".join(image.get("text", "") for image in image_batch)))
+        
+        user_content.append({"type": "text", "text": info_extraida_texto}) # Inyectar datos de Etapa 1
+
+        user_content.append({"type": "text", "text": f"--- INICIO: DOCUMENTOS DEL LOTE {batch_number + 1} ---"})
+        if any(image.get("tiles") for image in image_batch):
+            user_content.append({"type": "text", "text": "Algunos planos se envían como vista general de baja resolución más detalles de alta resolución de las zonas con cambios; en la ubicación cita el DWG No del plano correspondiente."})
+        user_content.extend([block for image in image_batch for block in page_content(image)])
+        system_prompt = PROMPT_ANALISTA_RIESGOS # <-- USAR PROMPT DE RIESGOS
+
+    return {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        "max_tokens": 4096, "temperature": 0.1, "top_p": 0.8,
+        "response_format": {"type": "json_object"}
+    }
+
+
+class TokenBudgetExceeded(Exception):
+    """El siguiente lote superaría ANALYSIS_TOKEN_BUDGET; analysis_events lo convierte en 413."""
+
+
+async def analysis_events(session_id: str, scope_documents: List[Dict[str, Any]], plano_documents: List[Dict[str, Any]], on_stage: Optional[Callable[..., None]] = None,
+                          roi: Optional[Dict[str, Dict[int, List[List[float]]]]] = None, batching: Optional[Dict[str, Any]] = None,
+                          ids_on_arrival: bool = False):
+    """
+    Ejecuta el análisis completo como generador asíncrono de eventos:
+    1. {"event": "stage1"}: cajetines extraídos (Etapa 1), escalón de codificación por página y
+       marcas de revisión detectadas localmente en cada plano.
+    2. {"event": "batch"}: riesgos de cada lote de la Etapa 2 en cuanto termina.
+    3. {"event": "summary"}: cierre con los tiempos por etapa, el consumo de tokens (estimado
+       frente al "usage" de Azure) y lo ahorrado en páginas duplicadas ("deduplication", ver
+       PageDeduplicator.report). Si hubo análisis, trae además "riesgos_identificados": todos
+       los riesgos en el orden de los lotes, tal como quedan guardados en la sesión.
+    Un "id" emitido no cambia después. Con ids_on_arrival (respuestas en streaming) cada riesgo
+    recibe su ID al llegar su lote, ya en el evento "batch", y ése es el que se guarda. Sin él,
+    los eventos "batch" no traen "id" y los riesgos se numeran al final en el orden de los
+    lotes (el resultado no depende de qué lote terminó antes).
+    El renderizado y las llamadas se solapan: cada lote se despacha en cuanto llena su
+    presupuesto de bytes o de tokens, con la Etapa 1 de sus propios cajetines, sin esperar al resto de páginas.
+    Los planos sin marcas de revisión detectadas no se envían a la Etapa 2; si ninguno tiene
+    marcas, el resumen trae el mensaje de "sin marcas" sin llamar a Azure.
+    Con roi (archivo -> página -> regiones, ver parse_roi_options) los planos se envían como
+    vista general más recortes de alta resolución alrededor de los cambios.
+    batching (ver parse_batching_options) elige la estrategia de lotes; sólo "greedy" despacha
+    antes de terminar el renderizado.
+    on_stage(etapa, **detalles), si se indica, recibe los cambios de etapa ("render",
+    "stage1", "stage2"). Los errores se propagan como HTTPException; con ANALYSIS_TOKEN_BUDGET,
+    el lote que lo superaría no se envía y el análisis termina con 413.
+    """
+    scope_files, planos = scope_documents, plano_documents
+    report_stage = on_stage or (lambda stage, **details: None)
+    started = time.monotonic()
+    elapsed = lambda: round(time.monotonic() - started, 3)
+    batching = batching or parse_batching_options(None, None)
+    timings = {"render_started": 0.0, "batching": batching, "batches": []}
+    report_stage("render")
+
+    # --- INICIO: LÓGICA DE PROCESAMIENTO MODIFICADA ---
+    with_planos = bool(planos)
+    if with_planos:
+        logging.info(f"Sesión {session_id}: Iniciando análisis de PLANOS (con/sin alcance).")
+    else:
+        logging.info(f"Sesión {session_id}: Iniciando análisis de SÓLO ALCANCE.")
+
+    all_images_for_session = []
+    page_encodings = [] # Escalón de codificación usado por cada página
+    render_steps = {} # Segundos de renderizado por paso (páginas no cacheadas)
+    cajetin_items = [] # Datos de cajetín extraídos en la Etapa 1
+    pending_title_blocks = {} # pagina -> (item, cajetín) pendientes del modelo
+    revision_marks = [] # Resultado del detector local por plano
+    plano_pages = 0
+    # Páginas repetidas: una sola imagen con todas sus ubicaciones en "sources"
+    dedup = PageDeduplicator() if PAGE_DEDUP_ENABLED else None
+    queued_images, dispatched_images = set(), set() # id() de las imágenes agregadas a un lote / ya despachadas
+    linked_title_blocks = {} # pagina del original -> cajetines de sus duplicados, que copian su extracción
+    extracted_paginas = set() # Planos cuyo cajetín ya pasó por la Etapa 1 con el modelo
+    # Con planos, ningún lote sale hasta ver el primer plano con marcas (si no hay, no se llama a Azure)
+    dispatch_ready = not with_planos
+    held_batches = []
+    base_tokens = analysis_base_tokens(with_planos)
+    builder = BatchBuilder(LEGEND_INDEX.reserved_bytes(), base_tokens=base_tokens, **batching)
+    # Tokens estimados al armar los lotes frente a los que informa Azure en cada respuesta
+    usage_totals = {"calls": 0, "reported_calls": 0, "estimated_prompt_tokens": 0, **{field: 0 for field in USAGE_FIELDS},
+                    "estimated_batch_tokens": 0, "token_budget": ANALYSIS_TOKEN_BUDGET or None}
+    stage1_tasks = []
+    batch_tasks = []
+    sent_batches = {} # lote -> (imágenes, ubicaciones que tenía cada una al armar el payload)
+
+    async def run_stage1(pending):
+        started = time.monotonic()
+        record = await extract_title_blocks(session_id, pending)
+        if record:
+            METRICS.observe("pid_stage_seconds", time.monotonic() - started, stage="stage1")
+        add_usage(usage_totals, record)
+        for item, _ in pending:
+            extracted_paginas.add(item["pagina"])
+            for linked in linked_title_blocks.pop(item["pagina"], []):
+                copy_title_block_fields(item, linked)
+
+    async def run_batch(batch_number, image_batch, stage1_task):
+        # Sólo espera a la Etapa 1 de los planos de su propio lote
+        await stage1_task
+        batch_paginas = {pagina for image in image_batch for pagina in image_plano_pages(image)}
+        batch_items = [item for item in cajetin_items if item["pagina"] in batch_paginas]
+        payload = build_analysis_payload(batch_number, image_batch, with_planos, cajetin_text(batch_items))
+        sent_batches[batch_number] = (image_batch, [len(image.get("sources", [])) for image in image_batch])
+        timing = timings["batches"][batch_number]
+        timing["stage1_finished_at"] = elapsed()
+        attempt = {}
+        result = await send_analysis_request(payload, attempt_timing=attempt)
+        record = usage_record(payload, result)
+        timing.update(record)
+        add_usage(usage_totals, record)
+        timing["completed_at"] = elapsed()
+        # El modelo de latencia aprende sólo del intento que respondió: la espera en la cola,
+        # los 429 y los reintentos crecen con la carga, no con el tamaño del lote
+        timing["wall_seconds"] = round(timing["completed_at"] - timing["stage1_finished_at"], 3)
+        timing["actual_seconds"] = attempt["seconds"]
+        timing["attempts"] = attempt["attempts"]
+        BATCH_LATENCY_MODEL.observe(timing["bytes"], timing["actual_seconds"])
+        METRICS.observe("pid_stage_seconds", timing["wall_seconds"], stage="stage2_batch")
+        return batch_number, result
+
+    def dispatch(image_batch):
+        batch_number = len(batch_tasks)
+        batch_tokens = base_tokens + sum(image_tokens_of(image) for image in image_batch)
+        if ANALYSIS_TOKEN_BUDGET and usage_totals["estimated_batch_tokens"] + batch_tokens > ANALYSIS_TOKEN_BUDGET:
+            # Se corta antes de enviar: los lotes ya despachados se cancelan al salir
+            raise TokenBudgetExceeded(f"El análisis supera el presupuesto de {ANALYSIS_TOKEN_BUDGET} tokens "
+                                      f"(estimado: {usage_totals['estimated_batch_tokens'] + batch_tokens} al preparar el lote {batch_number + 1}).")
+        usage_totals["estimated_batch_tokens"] += batch_tokens
+        pending = [pending_title_blocks.pop(pagina) for image in image_batch for pagina in image_plano_pages(image) if pagina in pending_title_blocks]
+        dispatched_images.update(id(image) for image in image_batch)
+        stage1_task = asyncio.ensure_future(run_stage1(pending))
+        stage1_tasks.append(stage1_task)
+        batch_bytes = LEGEND_INDEX.reserved_bytes() + sum(image_bytes(image) for image in image_batch)
+        METRICS.observe("pid_batch_bytes", batch_bytes)
+        timings["batches"].append({
+            "batch": batch_number + 1, "pages": len(image_batch), "bytes": batch_bytes, "estimated_tokens": batch_tokens, "cajetines_modelo": len(pending),
+            "predicted_seconds": BATCH_LATENCY_MODEL.predict(batch_bytes), "dispatched_at": elapsed(),
+        })
+        if "first_dispatch" not in timings:
+            timings["first_dispatch"] = timings["batches"][-1]["dispatched_at"]
+        batch_tasks.append(asyncio.ensure_future(run_batch(batch_number, image_batch, stage1_task)))
+        logging.info(f"Sesión {session_id}: lote {batch_number + 1} despachado con {len(image_batch)} página(s).")
+
+    def ready(image_batches):
+        for image_batch in image_batches:
+            if dispatch_ready:
+                dispatch(image_batch)
+            else:
+                held_batches.append(image_batch)
+
+    def queue(image):
+        queued_images.add(id(image))
+        ready(builder.add(image))
+
+    try:
+        documents = [(file, False) for file in scope_files or []]
+        if with_planos:
+            documents += [(file, True) for file in planos]
+        for file, is_plano in documents:
+            try:
+                file_roi = roi.get(file["filename"], {}) if (roi is not None and is_plano) else None
+                async for full_image, title_block, encoding in process_pdf_pages_with_crops(file, with_title_block=is_plano, roi=file_roi, dedup=dedup):
+                    # Las referencias al original no se guardan en la sesión
+                    original = full_image.pop("duplicate_of", None) if full_image else None
+                    match = full_image.pop("duplicate_match", None) if full_image else None
+                    # Un plano igual a una página de alcance ya enviada se envía igual: ese lote salió sin su cajetín
+                    merge = original is not None and not (is_plano and original.get("plano_page") is None and id(original) in dispatched_images)
+                    original_plano_page = original.get("plano_page") if merge else None
+                    if encoding:
+                        page_encodings.append(encoding)
+                        for step, seconds in encoding.get("render_seconds", {}).items():
+                            render_steps[step] = round(render_steps.get(step, 0.0) + seconds, 4)
+                    analyze_page = True
+                    if is_plano:
+                        plano_pages += 1
+                        marks = (full_image or {}).get("revision_marks")
+                        # Sin resultado del detector (desactivado o con error) la página se analiza igual
+                        analyze_page = marks is None or marks["has_marks"]
+                        if full_image:
+                            full_image["plano_page"] = plano_pages
+                            if merge and original_plano_page is None:
+                                original["plano_page"] = plano_pages # Antes de despachar su lote, para que lleve este cajetín
+                            revision_marks.append({"file": full_image["file"], "page": full_image["page"], "pagina": plano_pages, **(marks or {"has_marks": None})})
+                        item = local_title_block_item(plano_pages, title_block)
+                        cajetin_items.append(item)
+                        # El cajetín de un duplicado de otro plano es el del original (índice: pagina - 1)
+                        original_item = cajetin_items[original_plano_page - 1] if original_plano_page else None
+                        if title_block and item["fuente"] == "ninguna" and analyze_page:
+                            if original_item is None:
+                                pending_title_blocks[plano_pages] = (item, title_block)
+                            elif original_item["fuente"] != "ninguna" or original_item["pagina"] in extracted_paginas:
+                                copy_title_block_fields(original_item, item)
+                            else:
+                                linked_title_blocks.setdefault(original_item["pagina"], []).append(item)
+                        if full_image and analyze_page and not dispatch_ready:
+                            dispatch_ready = True
+                            ready(held_batches)
+                            held_batches = []
+                    if full_image and merge:
+                        own_source = image_source({"file": original["file"], "page": original["page"], "plano_page": original_plano_page})
+                        original.setdefault("sources", [own_source]).append(image_source(full_image))
+                        dedup.record(image_source(full_image), {"file": original["file"], "page": original["page"]}, match, image_bytes(full_image), analyze_page)
+                        if analyze_page and id(original) not in queued_images:
+                            queue(original)
+                    elif full_image:
+                        all_images_for_session.append(full_image)
+                        if analyze_page:
+                            queue(full_image)
+            except TokenBudgetExceeded:
+                raise
+            except Exception as e:
+                kind = "plano" if is_plano else "archivo de alcance"
+                logging.warning(f"Omitiendo {kind} {file['filename']} debido a error: {e}")
+
+        if with_planos and not any(image.get("plano_page") for image in all_images_for_session):
+            raise HTTPException(status_code=400, detail="No se proporcionaron archivos de planos válidos para analizar.")
+        no_marks = not dispatch_ready
+        if no_marks:
+            logging.info(f"Sesión {session_id}: el detector local no encontró marcas de revisión en ningún plano; no se llama a Azure.")
+        else:
+            ready(builder.flush())
+        if not batch_tasks and not no_marks:
+            raise HTTPException(status_code=400, detail="No se pudieron procesar los archivos de alcance.")
+        skipped = sum(1 for marks in revision_marks if marks["has_marks"] is False)
+        if skipped:
+            logging.info(f"Sesión {session_id}: {skipped} plano(s) sin marcas de revisión excluidos de la Etapa 2.")
+        if builder.skipped:
+            # Se informan en su escalón de codificación: no llegaron a la Etapa 2
+            oversized = {(page["file"], page["page"]) for page in builder.skipped}
+            for encoding in page_encodings:
+                if (encoding["file"], encoding["page"]) in oversized:
+                    encoding["skipped"] = "supera el límite del lote"
+        if pending_title_blocks and not no_marks:
+            # Cajetines de páginas cuya imagen completa falló: no van en ningún lote, pero se reportan igual
+            stage1_tasks.append(asyncio.ensure_future(run_stage1(list(pending_title_blocks.values()))))
+        timings["render_finished"] = elapsed()
+        timings["render_steps"] = render_steps
+        # Todas las páginas ya están en memoria: los PDF subidos se borran sin esperar a la Etapa 2
+        discard_documents((scope_files or []) + (planos or []))
+
+        # --- ETAPA 1: EXTRACCIÓN DE DATOS DEL CAJETÍN ---
+        if cajetin_items:
+            logging.info(f"Sesión {session_id}: {len(cajetin_items) - sum(1 for item in cajetin_items if item['fuente'] == 'ninguna')} cajetín(es) resueltos desde el texto del PDF.")
+        report_stage("stage1")
+        await asyncio.gather(*stage1_tasks)
+        timings["stage1_finished"] = elapsed()
+
+        # El índice se arma con la Etapa 1 terminada: incluye los DWG que leyó el modelo
+        page_index = build_page_index(all_images_for_session, cajetin_items)
+        await asyncio.to_thread(SESSION_STORE.create, session_id, all_images_for_session, page_index)
+        logging.info(f"Sesión {session_id}: {len(all_images_for_session)} imágenes totales guardadas en cache.")
+
+        yield {"event": "stage1", "session_id": session_id, "cajetin": cajetin_items, "page_encodings": page_encodings, "revision_marks": revision_marks}
+
+        # --- ETAPA 2: ANÁLISIS DE RIESGOS ---
+        logging.info(f"Análisis (Etapa 2): la solicitud se dividió en {len(batch_tasks)} lote(s).")
+        report_stage("stage2", total_batches=len(batch_tasks))
+
+        # --- EJECUCIÓN DE LLAMADAS A LA API (Común para ambos casos) ---
+        # Cada lote se emite en cuanto termina; el resultado final se arma después en el orden
+        # de los lotes. Los IDs se asignan aquí sólo si el cliente los ve llegar (ids_on_arrival).
+        risks_by_batch = {}
+        risk_id_counter = 1
+        batch_notes = []
+
+        for next_completed in asyncio.as_completed(batch_tasks):
+            batch_number, result = await next_completed
+            risks, note = parse_batch_result(result)
+            # El renderizado ya terminó: se conocen todos los duplicados de las hojas del lote
+            attach_late_sources(risks, *sent_batches[batch_number], cajetin_items)
+            for risk in risks:
+                risk["recomendacion_partes"] = parse_recomendacion(risk.get("recomendacion", ""))
+                if ids_on_arrival:
+                    risk["id"] = risk_id_counter
+                    risk_id_counter += 1
+                else:
+                    risk.pop("id", None) # El que pone el modelo se repite entre lotes
+            risks_by_batch[batch_number] = risks
+            if note:
+                batch_notes.append(note)
+            event = {"event": "batch", "batch": batch_number + 1, "total_batches": len(batch_tasks), "riesgos_identificados": risks}
+            if note:
+                event["message"] = note
+            yield event
+
+    except HTTPException:
+        raise
+    except TokenBudgetExceeded as e:
+        logging.warning(f"Sesión {session_id}: {e}")
+        raise HTTPException(status_code=413, detail=str(e))
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=f"Error de la API de Azure: {e.response.text}")
+    except Exception as e:
+        logging.error(f"Error inesperado en análisis: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+    finally:
+        # Si falla un lote o el cliente se desconecta, no se dejan llamadas huérfanas
+        for task in stage1_tasks + batch_tasks:
+            task.cancel()
+        discard_documents((scope_files or []) + (planos or []))
+
+    timings["stage2_finished"] = elapsed()
+    timings["total"] = timings["stage2_finished"]
+    # Segundos de llamadas a Azure que corrieron mientras todavía se renderizaba
+    timings["overlap_seconds"] = round(max(0.0, timings["render_finished"] - timings.get("first_dispatch", timings["render_finished"])), 3)
+    logging.info(f"Sesión {session_id}: tiempos {json.dumps(timings)}")
+    METRICS.observe("pid_stage_seconds", timings["total"], stage="analysis")
+    # Desglose consultable después en /sessions/{session_id}/timings
+    await asyncio.to_thread(SESSION_STORE.set_timings, session_id, {**timings, "usage": usage_totals})
+    # Páginas repetidas que no se renderizaron, enviaron ni guardaron de nuevo
+    deduplication = dedup.report() if dedup else None
+    if deduplication and deduplication["pages_saved"]:
+        logging.info(f"Sesión {session_id}: {deduplication['pages_saved']} página(s) duplicada(s) fusionadas, {deduplication['bytes_saved']/1024/1024:.2f}MB ahorrados.")
+
+    if no_marks:
+        yield {"event": "summary", "session_id": session_id, "message": NO_REVISION_MARKS_DETAIL, "timings": timings, "usage": usage_totals, "deduplication": deduplication}
+        return
+
+    if len(batch_tasks) == 1 and batch_notes and NO_REVISION_MARKS_MESSAGE in batch_notes[0]:
+        # Si es el único lote y no tiene marcas, se devuelve el mensaje en lugar del análisis
+        yield {"event": "summary", "session_id": session_id, "message": batch_notes[0], "timings": timings, "usage": usage_totals, "deduplication": deduplication}
+        return
+    for note in batch_notes:
+        logging.warning(f"Un lote devolvió una nota: {note}")
+
+    batch_risks = [risk for batch_number in sorted(risks_by_batch) for risk in risks_by_batch[batch_number]]
+    if ids_on_arrival:
+        final_risks = batch_risks # Se guardan los IDs que ya recibió el cliente
+    else:
+        # Copias: los eventos "batch" ya emitidos no cambian
+        final_risks = [{**risk, "id": risk_id} for risk_id, risk in enumerate(batch_risks, start=1)]
+    final_response = {"riesgos_identificados": final_risks}
+    page_index["risks"] = link_risks_to_pages(page_index, final_risks)
+    await asyncio.to_thread(SESSION_STORE.set_analysis, session_id, final_response, page_index)
+
+    yield {"event": "summary", "session_id": session_id, "total_riesgos": len(final_risks), "total_batches": len(batch_tasks), "timings": timings, "usage": usage_totals,
+           "deduplication": deduplication, "riesgos_identificados": final_risks}
+
+
+def parse_roi_options(roi: Optional[bool], regions: Optional[str]) -> Optional[Dict[str, Dict[int, List[List[float]]]]]:
+    """
+    Opción de recortes ROI de una solicitud. regions es un JSON opcional con zonas de cambio
+    indicadas por el usuario: [{"file": "plano.pdf", "page": 1, "bbox": [x0, y0, x1, y1]}],
+    en fracciones de la hoja (0-1). Indicar regiones activa la opción. None = desactivada.
+    """
+    if not regions:
+        return {} if (ROI_TILING_ENABLED if roi is None else roi) else None
+    try:
+        parsed = json.loads(regions)
+        by_file = {}
+        for region in parsed:
+            x0, y0, x1, y1 = [float(v) for v in region["bbox"]]
+            if not (0.0 <= x0 < x1 <= 1.0 and 0.0 <= y0 < y1 <= 1.0):
+                raise ValueError(f"bbox fuera de rango: {region['bbox']}")
+            by_file.setdefault(str(region["file"]), {}).setdefault(int(region["page"]), []).append([x0, y0, x1, y1])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Regiones de cambio inválidas: {e}")
+    return by_file
+
+
+def encode_stream_event(event: Dict[str, Any], stream_format: str) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event['event']}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+async def stream_analysis_events(events, stream_format: str):
+    try:
+        async for event in events:
+            yield encode_stream_event(event, stream_format)
+    except HTTPException as e:
+        yield encode_stream_event({"event": "error", "status_code": e.status_code, "detail": e.detail}, stream_format)
+
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+@app.post("/analyze")
+async def analyze_documents(scope_files: List[UploadFile] = File(None), planos: List[UploadFile] = File(None), stream: Optional[str] = None,
+                            roi: Optional[bool] = None, regions: Optional[str] = Form(None),
+                            batching: Optional[str] = None, keep_together: Optional[bool] = None):
+    """
+    Analiza planos y/o documentos de alcance. Con ?stream=ndjson o ?stream=sse la
+    respuesta se emite por eventos (Etapa 1, cada lote y resumen) a medida que avanza.
+    Con ?roi=true (o el campo "regions") los planos se envían como vista general más
+    recortes de alta resolución alrededor de los cambios. ?batching=greedy|ffd|balanced y
+    ?keep_together=true eligen cómo se agrupan las páginas en lotes.
+    En streaming, el "id" de cada riesgo llega con su lote y es el que usan /chat y /download_report.
+    """
+    session_id = str(uuid.uuid4())
+    logging.info(f"Iniciando nueva sesión de análisis: {session_id}")
+
+    if not scope_files and not planos:
+        raise HTTPException(status_code=400, detail="Debe proporcionar al menos un archivo (plano o alcance).")
+    if stream is not None and stream not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Formato de streaming no soportado: '{stream}'. Use 'ndjson' o 'sse'.")
+
+    roi_options = parse_roi_options(roi, regions)
+    batching_options = parse_batching_options(batching, keep_together)
+    scope_documents, plano_documents = await read_uploads(scope_files, planos)
+    events = analysis_events(session_id, scope_documents, plano_documents, roi=roi_options, batching=batching_options, ids_on_arrival=bool(stream))
+
+    if stream:
+        return StreamingResponse(
+            stream_analysis_events(events, stream),
+            media_type=STREAM_MEDIA_TYPES[stream],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # Si el cliente se desconecta antes de empezar, el generador no llega a borrar las subidas
+            background=BackgroundTask(discard_documents, scope_documents + plano_documents),
+        )
+
+    final_risks = []
+    page_encodings = []
+    cajetin_items = []
+    revision_marks = []
+    timings = None
+    usage = None
+    deduplication = None
+    async for event in events:
+        if event["event"] == "stage1":
+            page_encodings = event["page_encodings"]
+            cajetin_items = event["cajetin"]
+            revision_marks = event["revision_marks"]
+        elif event["event"] == "summary":
+            if "message" in event:
+                return {"message": event["message"]}
+            final_risks = event["riesgos_identificados"]
+            timings = event["timings"]
+            usage = event["usage"]
+            deduplication = event["deduplication"]
+
+    final_response = {"riesgos_identificados": final_risks}
+    return {"raw_analysis": json.dumps(final_response), "session_id": session_id, "page_encodings": page_encodings, "cajetin": cajetin_items, "revision_marks": revision_marks,
+            "timings": timings, "usage": usage, "deduplication": deduplication}
+
+
+# --- INICIO: API DE TRABAJOS ASÍNCRONOS (/jobs) ---
+# Para análisis largos: /jobs devuelve un job_id al instante y el análisis corre en segundo
+# plano. El session_id del trabajo es el mismo que usan /chat y /download_report.
+# JOBS tiene los trabajos que ejecuta este worker; su estado se publica en SESSION_STORE, así
+# que con SESSION_BACKEND=sqlite cualquier worker responde GET /jobs/{id} y acepta su cancelación.
+JOB_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", "2"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "20"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "7200"))
+JOB_CANCEL_POLL_SECONDS = float(os.getenv("JOB_CANCEL_POLL_SECONDS", "2.0"))
+
+JOBS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+JOB_TASKS: Dict[str, asyncio.Task] = {}
+JOB_SEMAPHORE: Optional[asyncio.Semaphore] = None
+JOB_FINAL_STATES = ("completed", "failed", "cancelled")
+JOB_WRITER = ThreadPoolExecutor(max_workers=1) # Un solo hilo: las escrituras del estado llegan en orden
+JOB_CANCEL_WATCHER: Optional[asyncio.Task] = None
+
+def get_job_semaphore() -> asyncio.Semaphore:
+    global JOB_SEMAPHORE
+    if JOB_SEMAPHORE is None:
+        JOB_SEMAPHORE = asyncio.Semaphore(JOB_MAX_CONCURRENCY)
+    return JOB_SEMAPHORE
+
+
+async def purge_finished_jobs():
+    deadline = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [job_id for job_id, job in JOBS.items() if job["status"] in JOB_FINAL_STATES and job["finished_at"] < deadline]:
+        del JOBS[job_id]
+    await asyncio.to_thread(SESSION_STORE.purge_jobs, deadline)
+
+
+def save_job_record(job_id: str, record: str, status: str, finished_at: Optional[float]):
+    try:
+        SESSION_STORE.save_job(job_id, record, status, finished_at)
+    except sqlite3.Error as e:
+        logging.warning(f"Trabajo {job_id}: no se pudo publicar su estado: {e}")
+
+
+def persist_job(job: Dict[str, Any]):
+    """Publica el estado del trabajo para los demás workers. El JSON se arma aquí, en el bucle, y JOB_WRITER lo escribe sin bloquearlo."""
+    record = json.dumps(job, default=str)
+    asyncio.get_running_loop().run_in_executor(JOB_WRITER, save_job_record, job["job_id"], record, job["status"], job["finished_at"])
+
+
+def public_job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in job.items() if key != "result"}
+
+
+async def run_analysis_job(job: Dict[str, Any], scope_documents: List[Dict[str, Any]], plano_documents: List[Dict[str, Any]],
+                           roi: Optional[Dict[str, Dict[int, List[List[float]]]]] = None, batching: Optional[Dict[str, Any]] = None):
+    def on_stage(stage, **details):
+        job["stage"] = stage
+        job["stage_history"].append({"stage": stage, "at": time.time()})
+        if "total_batches" in details:
+            job["batches_total"] = details["total_batches"]
+        persist_job(job)
+
+    final_risks = []
+    page_encodings = []
+    revision_marks = []
+    try:
+        async with get_job_semaphore():
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            persist_job(job)
+            events = analysis_events(job["session_id"], scope_documents, plano_documents, on_stage=on_stage, roi=roi, batching=batching)
+            async for event in events:
+                if event["event"] == "stage1":
+                    page_encodings = event["page_encodings"]
+                    revision_marks = event["revision_marks"]
+                    job["cajetin"] = event["cajetin"]
+                elif event["event"] == "batch":
+                    job["batches_completed"] += 1
+                    job["batches"].append({
+                        "batch": event["batch"],
+                        "riesgos": len(event["riesgos_identificados"]),
+                        "message": event.get("message"),
+                        "completed_at": time.time(),
+                    })
+                    persist_job(job)
+                elif event["event"] == "summary":
+                    job["timings"] = event["timings"]
+                    job["usage"] = event["usage"]
+                    job["deduplication"] = event["deduplication"]
+                    if "message" in event:
+                        job["result"] = {"message": event["message"], "session_id": job["session_id"]}
+                    else:
+                        final_risks = event["riesgos_identificados"]
+        if job["result"] is None:
+            final_response = {"riesgos_identificados": final_risks}
+            job["result"] = {"raw_analysis": json.dumps(final_response), "session_id": job["session_id"], "page_encodings": page_encodings, "cajetin": job["cajetin"], "revision_marks": revision_marks,
+                             "timings": job["timings"], "usage": job["usage"], "deduplication": job["deduplication"]}
+        job["status"] = "completed"
+    except asyncio.CancelledError:
+        job["status"] = "cancelled"
+        raise
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = {"status_code": e.status_code, "detail": e.detail}
+    except Exception as e:
+        logging.error(f"Trabajo {job['job_id']}: error inesperado: {e}", exc_info=True)
+        job["status"] = "failed"
+        job["error"] = {"status_code": 500, "detail": f"Error interno: {str(e)}"}
+    finally:
+        job["stage"] = None
+        job["finished_at"] = time.time()
+        JOB_TASKS.pop(job["job_id"], None)
+        persist_job(job)
+
+
+def finish_job_task(job: Dict[str, Any], documents: List[Dict[str, Any]]):
+    discard_documents(documents)
+    if job["status"] not in JOB_FINAL_STATES:
+        # Cancelado antes de empezar: run_analysis_job no llegó a ejecutarse
+        job["status"] = "cancelled"
+        job["finished_at"] = time.time()
+        JOB_TASKS.pop(job["job_id"], None)
+        persist_job(job)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_analysis_job(scope_files: List[UploadFile] = File(None), planos: List[UploadFile] = File(None),
+                              roi: Optional[bool] = None, regions: Optional[str] = Form(None),
+                              batching: Optional[str] = None, keep_together: Optional[bool] = None):
+    if not scope_files and not planos:
+        raise HTTPException(status_code=400, detail="Debe proporcionar al menos un archivo (plano o alcance).")
+    roi_options = parse_roi_options(roi, regions)
+    batching_options = parse_batching_options(batching, keep_together)
+    await purge_finished_jobs()
+    if len(JOB_TASKS) >= JOB_MAX_CONCURRENCY + JOB_MAX_QUEUED:
+        raise HTTPException(status_code=429, detail="Demasiados trabajos en curso. Intente de nuevo más tarde.")
+
+    scope_documents, plano_documents = await read_uploads(scope_files, planos)
+
+    job_id = str(uuid.uuid4())
+    session_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "session_id": session_id,
+        "status": "queued",
+        "stage": None,
+        "stage_history": [],
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "batches_total": None,
+        "batches_completed": 0,
+        "batches": [],
+        "cajetin": None,
+        "timings": None,
+        "usage": None,
+        "deduplication": None,
+        "error": None,
+        "result": None,
+    }
+    JOBS[job_id] = job
+    persist_job(job)
+    JOB_TASKS[job_id] = asyncio.get_running_loop().create_task(run_analysis_job(job, scope_documents, plano_documents, roi_options, batching_options))
+    # También cubre un trabajo cancelado antes de empezar
+    JOB_TASKS[job_id].add_done_callback(lambda _: finish_job_task(job, scope_documents + plano_documents))
+    logging.info(f"Trabajo {job_id} encolado (sesión {session_id}).")
+    return {"job_id": job_id, "session_id": session_id, "status": job["status"]}
+
+
+async def get_job_or_404(job_id: str) -> Dict[str, Any]:
+    job = JOBS.get(job_id)
+    if job is None:
+        # Lo ejecuta (o lo ejecutó) otro worker
+        job = await asyncio.to_thread(SESSION_STORE.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado.")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    return public_job_view(await get_job_or_404(job_id))
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_analysis_job_result(job_id: str):
+    job = await get_job_or_404(job_id)
+    if job["status"] == "failed":
+        raise HTTPException(status_code=job["error"]["status_code"], detail=job["error"]["detail"])
+    if job["status"] == "cancelled":
+        raise HTTPException(status_code=410, detail="El trabajo fue cancelado.")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"El trabajo aún no ha terminado (estado: {job['status']}).")
+    return job["result"]
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_analysis_job(job_id: str):
+    job = await get_job_or_404(job_id)
+    task = JOB_TASKS.get(job_id)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    elif job["status"] not in JOB_FINAL_STATES:
+        # Lo ejecuta otro worker: lo cancela al ver la marca (watch_job_cancellations)
+        if await asyncio.to_thread(SESSION_STORE.request_job_cancel, job_id):
+            job = {**job, "cancel_requested": True}
+    return public_job_view(job)
+
+
+async def watch_job_cancellations():
+    """Cancela los trabajos de este worker que otro worker marcó desde DELETE /jobs/{id}."""
+    while True:
+        await asyncio.sleep(JOB_CANCEL_POLL_SECONDS)
+        if not JOB_TASKS:
+            continue
+        try:
+            job_ids = await asyncio.to_thread(SESSION_STORE.cancel_requested_jobs, list(JOB_TASKS))
+        except sqlite3.Error as e:
+            logging.warning(f"No se pudieron consultar las cancelaciones de trabajos: {e}")
+            continue
+        for job_id in job_ids:
+            task = JOB_TASKS.get(job_id)
+            if task is not None:
+                logging.info(f"Trabajo {job_id}: cancelado desde otro worker.")
+                task.cancel()
+
+
+@app.on_event("startup")
+async def start_job_cancel_watcher():
+    global JOB_CANCEL_WATCHER
+    JOB_CANCEL_WATCHER = asyncio.get_running_loop().create_task(watch_job_cancellations())
+
+
+@app.on_event("shutdown")
+async def cancel_running_jobs():
+    if JOB_CANCEL_WATCHER is not None:
+        JOB_CANCEL_WATCHER.cancel()
+    for task in list(JOB_TASKS.values()):
+        task.cancel()
+# --- FIN: API DE TRABAJOS ASÍNCRONOS ---
+
+
+# --- (NUEVA) FUNCIÓN DE BATCHING (Reutilizada) ---
+BATCH_STRATEGIES = ("greedy", "ffd", "balanced")
+
+class BatchBuilder:
+    """
+    Motor de batching con estrategias intercambiables. Las imágenes se añaden a medida que
+    se renderizan; cada una cuesta sus bytes codificados (image_bytes) y sus tokens de imagen
+    (image_tokens_of), y ningún lote supera ni el límite de bytes ni el de tokens.
+    - "greedy": respeta el orden y entrega cada lote en cuanto se llena (despacho en streaming).
+    - "ffd": first-fit-decreasing, minimiza el número de lotes.
+    - "balanced": reparte la carga por igual entre BATCH_TARGET_PARALLELISM lotes como
+      mínimo, para que el lote más lento (todos corren en paralelo) termine antes.
+    "ffd" y "balanced" necesitan todas las páginas: sus lotes salen en flush().
+    Con keep_together, las hojas de un mismo PDF van en el mismo lote mientras quepan.
+    """
+
+    def __init__(self, base_size_bytes: int, strategy: str = "greedy", keep_together: bool = False, target_parallelism: int = BATCH_TARGET_PARALLELISM,
+                 base_tokens: int = 0, token_limit: int = BATCH_TOKEN_LIMIT):
+        if strategy not in BATCH_STRATEGIES:
+            raise ValueError(f"Estrategia de batching desconocida: '{strategy}'")
+        self.base = (base_size_bytes, base_tokens)
+        self.limit_bytes = SAFE_PAYLOAD_LIMIT_MB * 1024 * 1024
+        self.token_limit = token_limit or float("inf")
+        self.strategy = strategy
+        self.keep_together = keep_together
+        self.target_parallelism = max(1, target_parallelism)
+        self.sequence = 0
+        self.current_batch_images = []
+        self.current_batch_cost = self.base
+        self.pending_unit = [] # Hojas del PDF en curso (keep_together)
+        self.units = [] # Unidades acumuladas hasta flush() ("ffd" / "balanced")
+        self.skipped = [] # Páginas que no caben ni solas en un lote: {"file", "page", "bytes", "tokens"}
+
+    @staticmethod
+    def _cost(unit: List[Tuple[int, Dict[str, Any]]]) -> Tuple[int, int]:
+        return sum(image_bytes(image) for _, image in unit), sum(image_tokens_of(image) for _, image in unit)
+
+    def _fits(self, load: Tuple[int, int], cost: Tuple[int, int]) -> bool:
+        return load[0] + cost[0] <= self.limit_bytes and load[1] + cost[1] <= self.token_limit
+
+    def _load(self, load: Tuple[int, int]) -> float:
+        """Carga de un lote como la fracción más alta de sus dos límites."""
+        return max(load[0] / self.limit_bytes, load[1] / self.token_limit)
+
+    def _close(self) -> List[List[Dict[str, Any]]]:
+        closed = [self.current_batch_images] if self.current_batch_images else []
+        self.current_batch_images = []
+        self.current_batch_cost = self.base
+        return closed
+
+    def _split_oversized(self, unit: List[Tuple[int, Dict[str, Any]]]) -> List[List[Tuple[int, Dict[str, Any]]]]:
+        """Una unidad que no cabe en un lote se separa en hojas sueltas; las que no caben ni solas se omiten."""
+        if self._fits(self.base, self._cost(unit)):
+            return [unit]
+        if len(unit) > 1:
+            logging.warning(f"Las {len(unit)} hojas de {unit[0][1].get('file')} no caben en un lote; se reparten por separado.")
+        parts = []
+        for item in unit:
+            if self._fits(self.base, self._cost([item])):
+                parts.append([item])
+                continue
+            # Ni sola cabe aun con la escalera de codificación al mínimo: Azure la rechazaría, se omite
+            image = item[1]
+            logging.warning(f"Una imagen ({image_bytes(image)/1024/1024:.2f}MB, {image_tokens_of(image)} tokens) supera el límite del lote, se omite.")
+            self.skipped.append({"file": image.get("file"), "page": image.get("page"), "bytes": image_bytes(image), "tokens": image_tokens_of(image)})
+        return parts
+
+    def _place_greedy(self, unit: List[Tuple[int, Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+        closed = []
+        for part in self._split_oversized(unit):
+            cost = self._cost(part)
+            if not self._fits(self.current_batch_cost, cost) and self.current_batch_images:
+                closed += self._close()
+            self.current_batch_images.extend(image for _, image in part)
+            self.current_batch_cost = (self.current_batch_cost[0] + cost[0], self.current_batch_cost[1] + cost[1])
+        return closed
+
+    def _finish_unit(self) -> List[List[Dict[str, Any]]]:
+        unit, self.pending_unit = self.pending_unit, []
+        if not unit:
+            return []
+        if self.strategy == "greedy":
+            return self._place_greedy(unit)
+        self.units.extend(self._split_oversized(unit))
+        return []
+
+    def add(self, image: Optional[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Añade una imagen y devuelve los lotes que quedaron cerrados (normalmente ninguno o uno)."""
+        if not image: return [] # Omitir imágenes fallidas
+        closed = []
+        if self.pending_unit and (not self.keep_together or self.pending_unit[-1][1].get("file") != image.get("file")):
+            closed = self._finish_unit()
+        self.pending_unit.append((self.sequence, image))
+        self.sequence += 1
+        if not self.keep_together:
+            closed += self._finish_unit()
+        return closed
+
+    def flush(self) -> List[List[Dict[str, Any]]]:
+        """Cierra el lote en curso (greedy) o empaqueta todas las unidades acumuladas (ffd / balanced)."""
+        closed = self._finish_unit()
+        if self.strategy == "greedy":
+            return closed + self._close()
+        units, self.units = self.units, []
+        costed = sorted(((self._cost(unit), unit) for unit in units), key=lambda item: -self._load(item[0]))
+        bins = self._pack(costed)
+        # Dentro de cada lote las hojas conservan el orden original
+        return [[image for _, image in sorted(items, key=lambda item: item[0])] for _, items in bins if items]
+
+    def _pack(self, costed: List[Tuple[Tuple[int, int], List[Tuple[int, Dict[str, Any]]]]]) -> List[List[Any]]:
+        def put(target, cost, unit):
+            target[0] = (target[0][0] + cost[0], target[0][1] + cost[1])
+            target[1].extend(unit)
+
+        bins = [] # [(bytes, tokens), [(secuencia, imagen)]]
+        for cost, unit in costed: # first-fit-decreasing
+            target = next((b for b in bins if self._fits(b[0], cost)), None)
+            if target is None:
+                target = [self.base, []]
+                bins.append(target)
+            put(target, cost, unit)
+        if self.strategy == "ffd":
+            return bins
+        # balanced: al menos tantos lotes como el paralelismo objetivo; cada unidad va al lote más liviano donde quepa
+        bins = [[self.base, []] for _ in range(max(len(bins), min(self.target_parallelism, len(costed))))]
+        for cost, unit in costed:
+            candidates = [b for b in bins if self._fits(b[0], cost)]
+            if not candidates:
+                candidates = [[self.base, []]]
+                bins.append(candidates[0])
+            put(min(candidates, key=lambda b: self._load(b[0])), cost, unit)
+        return bins
+
+
+def analysis_base_tokens(with_planos: bool) -> int:
+    """Tokens fijos de cada lote de la Etapa 2: prompt de sistema, leyendas y respuesta máxima."""
+    prompt = PROMPT_ANALISTA_RIESGOS if with_planos else PROMPT_ANALISTA_ALCANCE
+    return len(prompt) // 4 + (LEGEND_INDEX.reserved_tokens() if with_planos else 0) + 4096
+
+
+class BatchLatencyModel:
+    """
+    Predice la latencia de un lote como base + segundos_por_MB * MB. Parte de los valores
+    configurados y se ajusta por mínimos cuadrados con olvido exponencial a cada lote completado.
+    """
+
+    def __init__(self, base_seconds: float, seconds_per_mb: float, decay: float = 0.95):
+        self.base_seconds = base_seconds
+        self.seconds_per_mb = seconds_per_mb
+        self.decay = decay
+        self.observations = 0
+        self._n = self._sx = self._sy = self._sxx = self._sxy = 0.0
+
+    def predict(self, size_bytes: int) -> float:
+        return round(self.base_seconds + self.seconds_per_mb * size_bytes / 1024 / 1024, 2)
+
+    def observe(self, size_bytes: int, seconds: float):
+        x = size_bytes / 1024 / 1024
+        self._n = self._n * self.decay + 1
+        self._sx = self._sx * self.decay + x
+        self._sy = self._sy * self.decay + seconds
+        self._sxx = self._sxx * self.decay + x * x
+        self._sxy = self._sxy * self.decay + x * seconds
+        self.observations += 1
+        mean_x, mean_y = self._sx / self._n, self._sy / self._n
+        variance = self._sxx / self._n - mean_x * mean_x
+        if self.observations >= 3 and variance > 1e-6:
+            self.seconds_per_mb = max(0.0, (self._sxy / self._n - mean_x * mean_y) / variance)
+        # La base se recalcula siempre para que la recta pase por la media observada
+        self.base_seconds = max(0.0, mean_y - self.seconds_per_mb * mean_x)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"base_seconds": round(self.base_seconds, 3), "seconds_per_mb": round(self.seconds_per_mb, 3), "observations": self.observations}
+
+
+BATCH_LATENCY_MODEL = BatchLatencyModel(BATCH_LATENCY_BASE_SECONDS, BATCH_LATENCY_SECONDS_PER_MB)
+
+
+def parse_batching_options(batching: Optional[str], keep_together: Optional[bool]) -> Dict[str, Any]:
+    """Estrategia de batching de una solicitud; lo no indicado toma el valor configurado."""
+    strategy = batching or BATCH_STRATEGY
+    if strategy not in BATCH_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Estrategia de batching no soportada: '{strategy}'. Use {', '.join(BATCH_STRATEGIES)}.")
+    return {"strategy": strategy, "keep_together": BATCH_KEEP_TOGETHER if keep_together is None else keep_together}
+
+
+# --- INICIO: ÍNDICE DE PÁGINAS POR SESIÓN ---
+# Se construye al analizar, desde la capa de texto de cada página: tags de equipos e
+# instrumentos, DWG No y términos del glosario -> páginas. /chat lo usa para enviar sólo
+# las páginas relevantes a la pregunta en lugar de todas las imágenes de la sesión.
+TAG_PATTERN = re.compile(r"\b([A-Z]{1,5})[-\s]?(\d{2,5}[A-Z]?)\b")
+RISK_REFERENCE_PATTERN = re.compile(r"\briesgo\s*(?:n[°º.o]*\s*)?#?\s*(\d+)", re.IGNORECASE)
+
+def find_tags(text: str) -> set:
+    """Tags normalizados (P-505B, PSV-101) presentes en el texto; admite 'P505B' o 'PSV\\n101'."""
+    return {f"{letters}-{number}" for letters, number in TAG_PATTERN.findall(text.upper())}
+
+
+def find_glossary_terms(text: str) -> set:
+    tokens, normalized = legend_tokens(text)
+    found = set()
+    for term in GLOSARIO_DE_TERMINOS:
+        upper = term.upper()
+        if len(upper) <= 2: continue # Abreviaturas demasiado ambiguas (H, L, NO...)
+        if (upper in tokens) if LEGEND_TOKEN_PATTERN.fullmatch(upper) else (upper in normalized):
+            found.add(term)
+    return found
+
+
+def build_page_index(images: List[Dict[str, Any]], cajetin_items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Índice de la sesión. Las posiciones de página son las de las imágenes guardadas en la
+    sesión: {"pages": [...], "tags": {tag: [pos]}, "dwg": {dwg_no: [pos]}, "terms": {término: [pos]}, "risks": {}}.
+    """
+    dwg_by_plano_page = {item["pagina"]: item["dwg_no"] for item in cajetin_items if item["fuente"] != "ninguna"}
+    index = {"pages": [], "tags": {}, "dwg": {}, "terms": {}, "risks": {}}
+    for position, image in enumerate(images):
+        text = image.get("text", "")
+        dwg_nos = list(dict.fromkeys(dwg_by_plano_page[pagina] for pagina in image_plano_pages(image) if pagina in dwg_by_plano_page))
+        entry = {"file": image.get("file"), "page": image.get("page"), "dwg_no": dwg_nos[0] if dwg_nos else None}
+        if image.get("sources"):
+            # La misma hoja en varios archivos: se guarda una vez, con todas sus ubicaciones
+            entry["sources"] = image["sources"]
+        index["pages"].append(entry)
+        for dwg_no in dwg_nos:
+            index["dwg"].setdefault(dwg_no.upper(), []).append(position)
+        for tag in sorted(find_tags(text)):
+            index["tags"].setdefault(tag, []).append(position)
+        for term in sorted(find_glossary_terms(text)):
+            index["terms"].setdefault(term, []).append(position)
+    return index
+
+
+def _dwg_pages(index: Dict[str, Any], text: str) -> set:
+    upper = text.upper()
+    return {position for dwg_no, positions in index["dwg"].items() if dwg_no in upper for position in positions}
+
+
+def link_risks_to_pages(index: Dict[str, Any], risks: List[Dict[str, Any]]) -> Dict[str, List[int]]:
+    """Páginas de origen de cada riesgo: el DWG No de su ubicación y los tags que menciona."""
+    links = {}
+    for risk in risks:
+        risk_text = " ".join(str(value) for value in risk.values())
+        pages = _dwg_pages(index, str(risk.get("ubicacion", "")))
+        for tag in find_tags(risk_text):
+            pages.update(index["tags"].get(tag, []))
+        links[str(risk.get("id"))] = sorted(pages)
+    return links
+
+
+def select_chat_pages(index: Optional[Dict[str, Any]], question: str, total_pages: int) -> Tuple[List[int], str]:
+    """
+    Páginas para una pregunta de /chat y el modo de selección: "indexed" si la pregunta
+    nombra tags, DWG, términos o riesgos; "fallback" (todas) si no hay nada que la acote.
+    """
+    if not index:
+        return list(range(total_pages)), "fallback"
+    pages = _dwg_pages(index, question)
+    for tag in find_tags(question):
+        pages.update(index["tags"].get(tag, []))
+    for term in find_glossary_terms(question):
+        pages.update(index["terms"].get(term, []))
+    for risk_id in RISK_REFERENCE_PATTERN.findall(question):
+        pages.update(index["risks"].get(risk_id, []))
+    pages = sorted(page for page in pages if page < total_pages)
+    if not pages:
+        return list(range(total_pages)), "fallback"
+    return pages, "indexed"
+# --- FIN: ÍNDICE DE PÁGINAS POR SESIÓN ---
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: Any
+
+class ChatRequest(BaseModel):
+    messages: List[ChatMessage]
+    session_id: str
+    all_pages: bool = False # True envía todas las páginas de la sesión, sin usar el índice
+
+@app.post("/chat")
+async def handle_chat(chat_request: ChatRequest):
+    if not AZURE_API_KEY:
+        raise HTTPException(status_code=500, detail="La clave de API de Azure no está configurada.")
+
+    session_id = chat_request.session_id
+    session_data = await asyncio.to_thread(SESSION_STORE.get, session_id)
     if not session_data:
-        raise HTTPException(status_code=404, detail="Sesión no válida o no encontrada.")
+        raise HTTPException(status_code=404, detail="Sesión no encontrada o expirada. Por favor, inicie un nuevo análisis.")
     
-    analysis_data = session_data.get("analysis")
-    if not analysis_data or "riesgos_identificados" not in analysis_data:
-        raise HTTPException(status_code=400, detail="No se encontró un análisis de riesgos en esta sesión para descargar.")
+    page_count = session_data["page_count"]
+    page_index = session_data.get("index")
+
+    chat_history_from_client = [msg.dict() for msg in chat_request.messages]
+    
+    user_multimodal_content = []
+    last_user_question = chat_history_from_client[-1]['content']
+    user_multimodal_content.append({"type": "text", "text": last_user_question})
+
+    if chat_request.all_pages:
+        selected_pages, selection_mode = list(range(page_count)), "all"
+    else:
+        selected_pages, selection_mode = select_chat_pages(page_index, str(last_user_question), page_count)
+    # Sólo se leen las imágenes de las páginas elegidas
+    selected_images = await asyncio.to_thread(SESSION_STORE.get_images, session_id, selected_pages)
+    if selected_images is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada o expirada. Por favor, inicie un nuevo análisis.")
+
+    # La leyenda se elige con la pregunta y los tags/términos de las páginas seleccionadas
+    legend_text = str(last_user_question)
+    if page_index:
+        selected = set(selected_pages)
+        legend_text += " " + " ".join(key for field in ("tags", "terms") for key, positions in page_index[field].items() if selected.intersection(positions))
+    user_multimodal_content.extend(LEGEND_INDEX.content(legend_text))
+    for image in selected_images:
+        user_multimodal_content.extend(page_content(image))
     
-    riesgos = analysis_data["riesgos_identificados"]
+    # Decidimos qué prompt de sistema usar en el chat.
+    system_prompt = PROMPT_CHAT_RIESGOS
     
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
+    messages_for_api = [
+        {"role": "system", "content": system_prompt},
+        *chat_history_from_client[:-1], 
+        {"role": "user", "content": user_multimodal_content}
+    ]
     
-    # Encabezados del CSV (estilo "What If")
-    writer.writerow(['ID', 'Riesgo (What If)', 'Consecuencia', 'Mitigaciones Existentes', 'Recomendación Principal', 'Alternativa Práctica'])
+    payload = { "messages": messages_for_api, "max_tokens": 2048, "temperature": 0.5, "top_p": 0.9 }
+    context = {
+        "mode": selection_mode,
+        "selected_pages": len(selected_pages),
+        "total_pages": page_count,
+        "pages": [page_index["pages"][i] if page_index else {"position": i} for i in selected_pages],
+        "payload_bytes": json_body_length(payload),
+    }
+    logging.info(f"Sesión {session_id}: chat con {context['selected_pages']}/{context['total_pages']} página(s) ({selection_mode}), payload {context['payload_bytes'] / 1024 / 1024:.2f} MB.")
     
-    for riesgo in riesgos:
-        riesgo_id = riesgo.get('id', 'N/A')
-        titulo = riesgo.get('riesgo_titulo', 'N/A').replace('\n', ' ')
-        descripcion = riesgo.get('descripcion', 'N/A').replace('\n', ' ')
-        ubicacion = riesgo.get('ubicacion', 'N/A').replace('\n', ' ')
-        causa = riesgo.get('causa_potencial', 'N/A').replace('\n', ' ')
-        
-        # Procesar la recomendación para dividirla
-        recomendacion_full = riesgo.get('recomendacion', 'N/A')
-        
-        # Función para extraer texto después de un subtítulo
-        def extract_text(key, text):
-            match = re.search(f"{key}:(.*?)(?=(Mitigaciones Existentes:|Recomendación Principal:|Alternativa Práctica:|$))", text, re.IGNORECASE | re.DOTALL)
-            return match.group(1).strip().replace('\n', ' ') if match else 'N/A'
-
-        mitigaciones = extract_text("Mitigaciones Existentes", recomendacion_full)
-        rec_principal = extract_text("Recomendación Principal", recomendacion_full)
-        alt_practica = extract_text("Alternativa Práctica", recomendacion_full)
-
-        # Crear las columnas 'What If' y 'Consecuencia'
-        what_if = f"{titulo} - {descripcion} (Ubicación: {ubicacion})"
-        consecuencia = causa
+    try:
+        started = time.monotonic()
+        data = await send_analysis_request(payload, timeout=120.0, priority=PRIORITY_CHAT)
+        seconds = time.monotonic() - started
+        METRICS.observe("pid_stage_seconds", seconds, stage="chat")
+        await asyncio.to_thread(SESSION_STORE.append_timing, session_id, {
+            "seconds": round(seconds, 3), "payload_bytes": context["payload_bytes"], "selected_pages": context["selected_pages"],
+            "mode": selection_mode, "usage": usage_record(payload, data),
+        })
         
-        writer.writerow([riesgo_id, what_if, consecuencia, mitigaciones, rec_principal, alt_practica])
+        ai_response = data.get("choices", [{}])[0].get("message", {}).get("content")
+        if not ai_response:
+            raise HTTPException(status_code=500, detail="Respuesta vacía de la API de Azure.")
         
-    csv_data = output.getvalue().encode('utf-8-sig') 
+        return {"response": ai_response, "context": context}
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=f"Error de la API de Azure: {e.response.text}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
+
+
+# --- ENDPOINT DE DESCARGA ---
+class DownloadRequest(BaseModel):
+    session_id: str
+    format: str = "csv" # "csv", "ndjson" o "json"
+
+
+# Columnas del reporte "What If": (encabezado CSV, clave en NDJSON/JSON)
+REPORT_COLUMNS = [
+    ("ID", "id"),
+    ("Riesgo (What If)", "what_if"),
+    ("Consecuencia", "consecuencia"),
+    ("Mitigaciones Existentes", "mitigaciones_existentes"),
+    ("Recomendación Principal", "recomendacion_principal"),
+    ("Alternativa Práctica", "alternativa_practica"),
+]
+REPORT_FORMATS = {
+    "csv": ("text/csv", "analisis_de_riesgos_what-if.csv"),
+    "ndjson": ("application/x-ndjson", "analisis_de_riesgos_what-if.ndjson"),
+    "json": ("application/json", "analisis_de_riesgos_what-if.json"),
+}
+
+def report_row(riesgo: Dict[str, Any]) -> Dict[str, Any]:
+    """Fila del reporte para un riesgo; usa las secciones de la recomendación ya separadas al combinar los lotes."""
+    titulo = riesgo.get('riesgo_titulo', 'N/A').replace('\n', ' ')
+    descripcion = riesgo.get('descripcion', 'N/A').replace('\n', ' ')
+    ubicacion = riesgo.get('ubicacion', 'N/A').replace('\n', ' ')
+    # Los análisis guardados antes de separar la recomendación se procesan aquí
+    partes = riesgo.get("recomendacion_partes") or parse_recomendacion(riesgo.get('recomendacion', 'N/A'))
+    return {
+        "id": riesgo.get('id', 'N/A'),
+        "what_if": f"{titulo} - {descripcion} (Ubicación: {ubicacion})",
+        "consecuencia": riesgo.get('causa_potencial', 'N/A').replace('\n', ' '),
+        **partes,
+    }
+
+
+def render_report(riesgos: List[Dict[str, Any]], report_format: str):
+    """Genera el reporte fila a fila (bytes) en el formato pedido."""
+    if report_format == "csv":
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
+        writer.writerow([header for header, _ in REPORT_COLUMNS])
+        yield output.getvalue().encode('utf-8-sig')
+        for riesgo in riesgos:
+            output.seek(0)
+            output.truncate()
+            row = report_row(riesgo)
+            writer.writerow([row[key] for _, key in REPORT_COLUMNS])
+            yield output.getvalue().encode('utf-8')
+    elif report_format == "ndjson":
+        for riesgo in riesgos:
+            yield (json.dumps(report_row(riesgo), ensure_ascii=False) + "\n").encode('utf-8')
+    else:
+        yield b'{"riesgos": ['
+        for i, riesgo in enumerate(riesgos):
+            yield (("," if i else "") + json.dumps(report_row(riesgo), ensure_ascii=False)).encode('utf-8')
+        yield b']}'
+
+
+class ReportCache:
+    """
+    Reportes ya generados por (sesión, formato), válidos mientras no cambie la versión del
+    análisis de la sesión (ver SessionStore.set_analysis). Acotada en bytes con desalojo LRU.
+    Se escribe desde el hilo que itera la respuesta en streaming.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[str, List[bytes], int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, report_format: str, version: str) -> Optional[List[bytes]]:
+        with self._lock:
+            entry = self.entries.get((session_id, report_format))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((session_id, report_format))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, session_id: str, report_format: str, version: str, chunks: List[bytes]):
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self.entries.pop((session_id, report_format), None)
+            if previous is not None:
+                self.total_bytes -= previous[2]
+            self.entries[(session_id, report_format)] = (version, chunks, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted
+
+    def stream(self, session_id: str, report_format: str, version: Optional[str], riesgos: List[Dict[str, Any]]):
+        """Genera el reporte y, si se envía completo, lo guarda para las siguientes descargas."""
+        chunks = []
+        for chunk in render_report(riesgos, report_format):
+            chunks.append(chunk)
+            yield chunk
+        if version is not None:
+            self.put(session_id, report_format, version, chunks)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
+
+
+REPORT_CACHE = ReportCache(int(REPORT_CACHE_MAX_MB * 1024 * 1024))
+
+@app.post("/download_report")
+async def download_report(request: DownloadRequest):
+    """
+    Exporta el análisis de la sesión como reporte "What If" en CSV (por defecto), NDJSON o
+    JSON. La respuesta se envía en streaming y queda en caché hasta que cambie el análisis.
+    """
+    session_id = request.session_id
+    report_format = request.format.lower()
+    if report_format not in REPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato de reporte no soportado: '{request.format}'. Use {', '.join(REPORT_FORMATS)}.")
+    session_data = await asyncio.to_thread(SESSION_STORE.get_analysis, session_id)
+
+    if not session_data:
+        raise HTTPException(status_code=404, detail="Sesión no válida o no encontrada.")
     
-    return Response(
-        content=csv_data,
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=analisis_de_riesgos_what-if.csv"}
-    )
+    analysis_data = session_data.get("analysis")
+    if not analysis_data or "riesgos_identificados" not in analysis_data:
+        raise HTTPException(status_code=400, detail="No se encontró un análisis de riesgos en esta sesión para descargar.")
+    
+    media_type, filename = REPORT_FORMATS[report_format]
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    version = session_data.get("analysis_version")
+    cached = REPORT_CACHE.get(session_id, report_format, version) if version else None
+    if cached is not None:
+        headers["X-Report-Cache"] = "hit"
+        return StreamingResponse(iter(cached), media_type=media_type, headers=headers)
+    headers["X-Report-Cache"] = "miss"
+    return StreamingResponse(REPORT_CACHE.stream(session_id, report_format, version, analysis_data["riesgos_identificados"]), media_type=media_type, headers=headers)
 # --- FIN: ENDPOINT DE DESCARGA ---
 
-# --- INICIO: ENDPOINT /rate_analysis (MODIFICADO) ---
-@app.post("/rate_analysis")
-async def rate_analysis(request: RatingRequest):
-    # ... (Tu código de rate_analysis no cambia) ...
-    try:
-        session_id = request.session_id
-        rating = request.rating
-        comment = request.comment or ""
-        tiempo_ahorrado = request.tiempo_ahorrado or "No especificado"
+# --- INICIO: ESCRITOR DE CALIFICACIONES ---
+RATINGS_HEADER = "session_id;rating;comment;tiempo_ahorrado\n".encode('utf-8')
+RATINGS_FIELDNAMES = RATINGS_HEADER.decode('utf-8').strip().split(';')
+
+class BlobRatingsBackend:
+    """
+    Calificaciones en un append blob de Azure Storage. Un único cliente por proceso; una vez
+    que se sabe que el blob existe (y tiene cabecera) no se vuelve a consultar. Cada bloque se
+    anexa con appendpos_condition: la cabecera sólo puede ser el primero, y un bloque cuyo
+    intento falló sin respuesta (p. ej. timeout) se busca en el blob antes de repetirlo, para
+    no duplicar filas. Los métodos son bloqueantes: se llaman con asyncio.to_thread.
+    """
+    name = "blob"
+    MAX_BLOCK_BYTES = 4 * 1024 * 1024 # Límite de append_block
+    APPEND_CONFLICT_RETRIES = 5 # Otra instancia anexó entre la lectura del tamaño y el append
+
+    def __init__(self, account_url: Optional[str], container: str, blob: str):
+        self.account_url = account_url
+        self.container = container
+        self.blob = blob
+        self._blob_client = None
+        self._exists = False
+        self._in_doubt: Optional[Tuple[int, bytes]] = None # (posición, MD5) de un bloque que pudo quedar escrito
+
+    def _client(self):
+        if self._blob_client is None:
+            if not self.account_url:
+                raise RuntimeError("La URL de la cuenta de almacenamiento no está configurada.")
+            blob_service_client = BlobServiceClient(account_url=self.account_url, credential=credential)
+            self._blob_client = blob_service_client.get_blob_client(container=self.container, blob=self.blob)
+        return self._blob_client
+
+    @staticmethod
+    def _position_taken(error: HttpResponseError) -> bool:
+        return getattr(error, "error_code", None) == "AppendPositionConditionNotMet"
+
+    def _ensure_exists(self):
+        """
+        Crea el blob si falta y escribe la cabecera como primer bloque (appendpos_condition=0).
+        Si la escritura falla, la próxima llamada lo vuelve a intentar: ninguna fila se anexa
+        a un blob vacío, así que la cabecera siempre queda primera.
+        """
+        if self._exists:
+            return
+        blob_client = self._client()
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            logging.info(f"Creando nuevo append blob: {self.blob} en contenedor: {self.container}")
+            try:
+                # Sólo si sigue sin existir: otra instancia puede haberlo creado entretanto
+                blob_client.create_append_blob(match_condition=MatchConditions.IfMissing)
+            except (ResourceExistsError, ResourceModifiedError):
+                pass
+            properties = blob_client.get_blob_properties()
+        if properties.size == 0:
+            try:
+                blob_client.append_block(RATINGS_HEADER, appendpos_condition=0)
+            except HttpResponseError as e:
+                # Otra instancia ya escribió la cabecera
+                if not self._position_taken(e):
+                    raise
+        self._exists = True
+
+    def _landed(self, blob_client, position: int, chunk: bytes) -> bool:
+        """True si el bloque ya está en el blob en position (de un intento anterior sin respuesta)."""
+        if blob_client.get_blob_properties().size < position + len(chunk):
+            return False
+        written = blob_client.download_blob(offset=position, length=len(chunk)).readall()
+        return hashlib.md5(written).digest() == hashlib.md5(chunk).digest()
+
+    def _append_once(self, blob_client, chunk: bytes):
+        digest = hashlib.md5(chunk).digest()
+        if self._in_doubt is not None:
+            position, doubtful_digest = self._in_doubt
+            self._in_doubt = None
+            if doubtful_digest == digest and self._landed(blob_client, position, chunk):
+                return
+        for _ in range(self.APPEND_CONFLICT_RETRIES):
+            position = blob_client.get_blob_properties().size
+            try:
+                blob_client.append_block(chunk, appendpos_condition=position)
+                return
+            except HttpResponseError as e:
+                if self._position_taken(e):
+                    continue
+                self._in_doubt = (position, digest)
+                raise
+            except Exception:
+                # Timeout o error de red: el bloque pudo escribirse, se comprueba en el próximo intento
+                self._in_doubt = (position, digest)
+                raise
+        raise RuntimeError(f"No se pudo anexar al blob tras {self.APPEND_CONFLICT_RETRIES} conflictos de posición.")
+
+    def append(self, data: bytes):
+        self._ensure_exists()
+        blob_client = self._client()
+        for offset in range(0, len(data), self.MAX_BLOCK_BYTES):
+            self._append_once(blob_client, data[offset:offset + self.MAX_BLOCK_BYTES])
+
+    def read_range(self, offset: int, etag: Optional[str]) -> Optional[Tuple[bytes, Optional[str], int]]:
+        """
+        Bytes añadidos desde offset: (datos, etag, tamaño total). Si el etag no cambió no se
+        descarga nada. None si el blob todavía no existe.
+        """
+        blob_client = self._client()
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        self._exists = True
+        if properties.etag == etag or properties.size <= offset:
+            return b"", properties.etag, properties.size
+        data = blob_client.download_blob(offset=offset, length=properties.size - offset).readall()
+        return data, properties.etag, offset + len(data)
 
-        if not (1 <= rating <= 5):
-            raise HTTPException(status_code=400, detail="La calificación debe estar entre 1 y 5.")
-        
-        if not STORAGE_ACCOUNT_URL:
-            logging.error("STORAGE_ACCOUNT_URL no está configurada.")
-            raise HTTPException(status_code=500, detail="La URL de la cuenta de almacenamiento no está configurada.")
 
-        logging.info(f"Recibida calificación para sesión {session_id}: {rating} estrellas, Tiempo: {tiempo_ahorrado}, Comentario: {comment[:20]}...")
+class LocalRatingsBackend:
+    """Calificaciones en un archivo local de sólo-anexado, con el mismo formato que el blob."""
+    name = "local"
 
-        blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=credential)
-        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=BLOB_NAME)
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
 
+    def append(self, data: bytes):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as f:
+                if f.tell() == 0:
+                    f.write(RATINGS_HEADER)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_range(self, offset: int, etag: Optional[str]) -> Optional[Tuple[bytes, Optional[str], int]]:
+        try:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                current = f"{stat.st_size}-{stat.st_mtime_ns}"
+                if current == etag or stat.st_size <= offset:
+                    return b"", current, stat.st_size
+                f.seek(offset)
+                data = f.read(stat.st_size - offset)
+                return data, current, offset + len(data)
+        except FileNotFoundError:
+            return None
+
+
+def make_ratings_backend(kind: str):
+    if kind == "local":
+        return LocalRatingsBackend(RATINGS_LOCAL_PATH)
+    if kind != "blob":
+        logging.warning(f"RATINGS_BACKEND desconocido: '{kind}'; se usa 'blob'.")
+    return BlobRatingsBackend(STORAGE_ACCOUNT_URL, CONTAINER_NAME, BLOB_NAME)
+
+
+class RatingSink:
+    """
+    Cola acotada de calificaciones con un escritor de fondo. Tras la primera fila espera
+    flush_interval para agrupar las que lleguen y las escribe en un único append (hasta
+    max_rows por escritura). Si el almacenamiento falla, las filas se reintentan con
+    backoff. Al apagar se escribe lo pendiente.
+    """
+
+    def __init__(self, backend, max_queue: int, flush_interval: float, max_rows: int):
+        self.backend = backend
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.max_rows = max(1, max_rows)
+        self._queue: Optional[asyncio.Queue] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._pending: List[Tuple[float, bytes]] = [] # (encolada_en, línea CSV) tomadas de la cola, aún sin escribir
+        self._latencies: "deque[float]" = deque(maxlen=1000)
+        self.started_at = time.monotonic()
+        self.received = 0
+        self.rejected = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_append_seconds = 0.0
+
+    @staticmethod
+    def encode_row(row: List[Any]) -> bytes:
         output = io.StringIO()
         writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
-        writer.writerow([session_id, rating, comment.replace('\n', ' '), tiempo_ahorrado])
-        new_line_data = output.getvalue().encode('utf-8')
-        output.close()
-        
-        header = "session_id;rating;comment;tiempo_ahorrado\n".encode('utf-8')
+        writer.writerow(row)
+        return output.getvalue().encode('utf-8')
 
-        if not blob_client.exists():
-            logging.info(f"Creando nuevo append blob: {BLOB_NAME} en contenedor: {CONTAINER_NAME}")
-            blob_client.create_append_blob() 
-            blob_client.append_block(header)
+    def start(self):
+        if self._queue is None or (self._stop.is_set() and self._flusher is not None and self._flusher.done()):
+            # Primer arranque, o nuevo arranque tras close()
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._stop = asyncio.Event()
+        if (self._flusher is None or self._flusher.done()) and not self._stop.is_set():
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
 
-        blob_client.append_block(new_line_data)
+    def submit(self, row: List[Any]) -> bool:
+        """Encola una fila; False si la cola está llena o el escritor se está cerrando."""
+        self.start()
+        if self._stop.is_set():
+            self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), self.encode_row(row)))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
 
-        return {"status": "success", "message": "Rating received"}
-    
-    except Exception as e:
-        logging.error(f"Error al guardar la calificación en el blob: {e}")
-        raise HTTPException(status_code=500, detail="Error interno al guardar la calificación.")
+    async def close(self):
+        """Deja de aceptar filas y espera a que se escriba lo pendiente."""
+        if self._flusher is None:
+            return
+        self._stop.set()
+        try:
+            self._queue.put_nowait(None) # Despierta al escritor si espera en la cola
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(self._flusher, timeout=RATINGS_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logging.error(f"Calificaciones: {len(self._pending) + self._queue.qsize()} fila(s) sin escribir al apagar.")
+
+    async def _wait_stop(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _take(self):
+        while len(self._pending) < self.max_rows and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                self._pending.append(item)
+
+    async def _flush(self) -> bool:
+        rows = self._pending[:self.max_rows]
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(self.backend.append, b"".join(line for _, line in rows))
+        except Exception as e:
+            self.failed_flushes += 1
+            logging.error(f"Calificaciones: no se pudieron escribir {len(rows)} fila(s) ({self.backend.name}): {e}")
+            return False
+        now = time.monotonic()
+        del self._pending[:len(rows)]
+        self.last_append_seconds = round(now - started, 3)
+        self._latencies.extend(now - enqueued_at for enqueued_at, _ in rows)
+        self.written += len(rows)
+        self.flushes += 1
+        return True
+
+    async def _run(self):
+        failures = 0
+        while True:
+            self._take()
+            if not self._pending:
+                if self._stop.is_set():
+                    return
+                item = await self._queue.get()
+                if item is not None:
+                    self._pending.append(item)
+                    # Las filas que lleguen mientras tanto van en el mismo append
+                    await self._wait_stop(self.flush_interval)
+                continue
+            if await self._flush():
+                failures = 0
+                continue
+            failures += 1
+            if self._stop.is_set():
+                logging.error(f"Calificaciones: se descartan {len(self._pending) + self._queue.qsize()} fila(s) sin escribir al apagar.")
+                return
+            await self._wait_stop(min(60.0, self.flush_interval * 2 ** failures))
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            return round(latencies[max(0, math.ceil(p * len(latencies)) - 1)], 3) if latencies else 0.0 # Rango más cercano
+        uptime = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "backend": self.backend.name,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_max": self.max_queue,
+            "pending_rows": len(self._pending),
+            "received": self.received,
+            "rejected": self.rejected,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "rows_per_flush": round(self.written / self.flushes, 2) if self.flushes else 0.0,
+            "rows_per_second": round(self.written / uptime, 4),
+            "last_append_seconds": self.last_append_seconds,
+            "flush_latency_seconds_p50": percentile(0.50),
+            "flush_latency_seconds_p95": percentile(0.95),
+            "flush_latency_seconds_max": round(latencies[-1], 3) if latencies else 0.0,
+        }
+
+
+RATING_SINK = RatingSink(make_ratings_backend(RATINGS_BACKEND), RATINGS_QUEUE_MAX, RATINGS_FLUSH_INTERVAL_SECONDS, RATINGS_FLUSH_MAX_ROWS)
+
+@app.on_event("startup")
+async def start_rating_sink():
+    RATING_SINK.start()
+
+@app.on_event("shutdown")
+async def flush_rating_sink():
+    await RATING_SINK.close()
+# --- FIN: ESCRITOR DE CALIFICACIONES ---
+
+# --- INICIO: ENDPOINT /rate_analysis (MODIFICADO) ---
+@app.post("/rate_analysis")
+async def rate_analysis(request: RatingRequest):
+    # La fila se encola y la escribe RATING_SINK en segundo plano; la respuesta no espera al almacenamiento
+    session_id = request.session_id
+    rating = request.rating
+    comment = request.comment or ""
+    tiempo_ahorrado = request.tiempo_ahorrado or "No especificado"
+
+    if not (1 <= rating <= 5):
+        raise HTTPException(status_code=400, detail="La calificación debe estar entre 1 y 5.")
+
+    if RATING_SINK.backend.name == "blob" and not STORAGE_ACCOUNT_URL:
+        logging.error("STORAGE_ACCOUNT_URL no está configurada.")
+        raise HTTPException(status_code=500, detail="La URL de la cuenta de almacenamiento no está configurada.")
+
+    logging.info(f"Recibida calificación para sesión {session_id}: {rating} estrellas, Tiempo: {tiempo_ahorrado}, Comentario: {comment[:20]}...")
+
+    if not RATING_SINK.submit([session_id, rating, comment.replace('\n', ' '), tiempo_ahorrado]):
+        logging.error("Calificaciones: cola llena, se rechaza la calificación.")
+        raise HTTPException(status_code=503, detail="Demasiadas calificaciones pendientes. Intente de nuevo más tarde.")
+
+    return {"status": "success", "message": "Rating received"}
 # --- FIN: ENDPOINT /rate_analysis ---
 
+# --- INICIO: LECTOR INCREMENTAL DE CALIFICACIONES ---
+class RatingsReader:
+    """
+    Lector incremental del registro de calificaciones. Recuerda el último offset y el ETag,
+    y sólo descarga los bytes añadidos desde la lectura anterior. Mantiene las filas
+    ya parseadas y los agregados (cantidad, promedio, histograma de calificaciones y
+    distribución de tiempo_ahorrado) para que /get_ratings/summary no recorra las filas.
+    """
+
+    def __init__(self, backend, min_refresh_seconds: float):
+        self.backend = backend
+        self.min_refresh_seconds = min_refresh_seconds
+        self._lock: Optional[asyncio.Lock] = None
+        self._last_refresh = 0.0
+        self.bytes_read = 0
+        self.refreshes = 0
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.etag = None
+        self.fieldnames: Optional[List[str]] = None
+        self.rows: List[Dict[str, Any]] = []
+        self.exists = False
+        self.rating_sum = 0
+        self.histogram = {str(stars): 0 for stars in range(1, 6)}
+        self.tiempo_ahorrado: Dict[str, int] = {}
+
+    async def refresh(self, force: bool = False):
+        """Incorpora las filas nuevas; como mucho una consulta cada min_refresh_seconds."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.min_refresh_seconds:
+                return
+            result = await asyncio.to_thread(self.backend.read_range, self.offset, self.etag)
+            if result is not None and result[2] < self.offset:
+                # El registro se recreó (más corto que lo ya leído): se vuelve a leer desde el inicio
+                logging.warning("Calificaciones: el registro se acortó; se vuelve a leer completo.")
+                self._reset()
+                result = await asyncio.to_thread(self.backend.read_range, 0, None)
+            self._last_refresh = time.monotonic()
+            self.refreshes += 1
+            if result is None:
+                if self.exists:
+                    self._reset()
+                return
+            self.exists = True
+            data, etag, _ = result
+            # Sólo hasta el último salto de línea: una fila incompleta se lee en la siguiente consulta
+            complete = data[:data.rfind(b"\n") + 1]
+            self.etag = etag if len(complete) == len(data) else None
+            self.offset += len(complete)
+            self.bytes_read += len(complete)
+            if complete:
+                self._ingest(complete.decode('utf-8'))
+
+    def _ingest(self, text: str):
+        lines = io.StringIO(text)
+        if self.fieldnames is None:
+            first = next(csv.reader(lines, delimiter=';'), None)
+            if first and "rating" in first:
+                self.fieldnames = first
+            else:
+                # Registro sin cabecera: las columnas son las conocidas y la primera línea es una fila
+                self.fieldnames = RATINGS_FIELDNAMES
+                lines.seek(0)
+        for row in csv.DictReader(lines, fieldnames=self.fieldnames, delimiter=';'):
+            if row.get('rating') == 'rating':
+                continue # Cabecera repetida
+            try:
+                row['rating'] = int(row['rating'])
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"Omitiendo fila mal formada en CSV: {row}")
+                continue
+            self.rows.append(row)
+            self.rating_sum += row['rating']
+            key = str(row['rating'])
+            self.histogram[key] = self.histogram.get(key, 0) + 1
+            tiempo = row.get('tiempo_ahorrado') or "No especificado"
+            self.tiempo_ahorrado[tiempo] = self.tiempo_ahorrado.get(tiempo, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        count = len(self.rows)
+        return {
+            "count": count,
+            "mean_rating": round(self.rating_sum / count, 3) if count else None,
+            "rating_histogram": self.histogram,
+            "tiempo_ahorrado": self.tiempo_ahorrado,
+            "bytes_read": self.bytes_read,
+            "offset": self.offset,
+            "refreshes": self.refreshes,
+            "seconds_since_refresh": round(time.monotonic() - self._last_refresh, 3) if self.refreshes else None,
+        }
+
+
+RATINGS_READER = RatingsReader(RATING_SINK.backend, RATINGS_REFRESH_MIN_SECONDS)
+# --- FIN: LECTOR INCREMENTAL DE CALIFICACIONES ---
+
 # --- INICIO: ENDPOINT /get_ratings (MODIFICADO) ---
 @app.get("/get_ratings")
-async def get_ratings():
-    # ... (Tu código de get_ratings no cambia) ...
-    if not STORAGE_ACCOUNT_URL:
+async def get_ratings(response: Response, offset: int = 0, limit: Optional[int] = None, session_id: Optional[str] = None,
+                      rating: Optional[int] = None, min_rating: Optional[int] = None, max_rating: Optional[int] = None,
+                      tiempo_ahorrado: Optional[str] = None):
+    """
+    Calificaciones registradas, leídas de forma incremental. Admite filtros (session_id,
+    rating, min_rating, max_rating, tiempo_ahorrado) y paginación (offset, limit, hasta
+    RATINGS_PAGE_MAX); el total filtrado va en la cabecera X-Total-Count.
+    """
+    if RATING_SINK.backend.name == "blob" and not STORAGE_ACCOUNT_URL:
         logging.error("STORAGE_ACCOUNT_URL no está configurada.")
         raise HTTPException(status_code=500, detail="La URL de la cuenta de almacenamiento no está configurada.")
+    if offset < 0 or (limit is not None and not (1 <= limit <= RATINGS_PAGE_MAX)):
+        raise HTTPException(status_code=400, detail=f"Paginación inválida: offset >= 0 y limit entre 1 y {RATINGS_PAGE_MAX}.")
 
-    ratings = []
     try:
-        blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=credential)
-        blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=BLOB_NAME)
+        await RATINGS_READER.refresh()
+    except Exception as e:
+        logging.error(f"Error al leer el blob de calificaciones: {e}")
+        raise HTTPException(status_code=500, detail="Error interno al leer las calificaciones.")
+    if not RATINGS_READER.exists:
+        logging.warning(f"Se solicitó /get_ratings, pero el blob {BLOB_NAME} no existe.")
 
-        if not blob_client.exists():
-            logging.warning(f"Se solicitó /get_ratings, pero el blob {BLOB_NAME} no existe.")
-            return [] 
+    filters = [
+        (session_id, lambda row: row.get('session_id') == session_id),
+        (rating, lambda row: row['rating'] == rating),
+        (min_rating, lambda row: row['rating'] >= min_rating),
+        (max_rating, lambda row: row['rating'] <= max_rating),
+        (tiempo_ahorrado, lambda row: row.get('tiempo_ahorrado') == tiempo_ahorrado),
+    ]
+    active = [match for value, match in filters if value is not None]
+    ratings = [row for row in RATINGS_READER.rows if all(match(row) for match in active)] if active else RATINGS_READER.rows
+    response.headers["X-Total-Count"] = str(len(ratings))
+    return ratings[offset:] if limit is None else ratings[offset:offset + limit]
 
-        downloader = blob_client.download_blob()
-        blob_data_bytes = downloader.readall()
-        
-        blob_data_str = blob_data_bytes.decode('utf-8')
-        csv_file = io.StringIO(blob_data_str)
-        
-        reader = csv.DictReader(csv_file, delimiter=';')
-        for row in reader:
-            try:
-                row['rating'] = int(row['rating'])
-                ratings.append(row)
-            except (ValueError, KeyError):
-                logging.warning(f"Omitiendo fila mal formada en CSV: {row}")
-        
-        return ratings
-    
+
+@app.get("/get_ratings/summary")
+async def get_ratings_summary():
+    """Agregados de las calificaciones sin recorrer las filas."""
+    if RATING_SINK.backend.name == "blob" and not STORAGE_ACCOUNT_URL:
+        logging.error("STORAGE_ACCOUNT_URL no está configurada.")
+        raise HTTPException(status_code=500, detail="La URL de la cuenta de almacenamiento no está configurada.")
+    try:
+        await RATINGS_READER.refresh()
     except Exception as e:
         logging.error(f"Error al leer el blob de calificaciones: {e}")
         raise HTTPException(status_code=500, detail="Error interno al leer las calificaciones.")
+    return RATINGS_READER.summary()
 # --- FIN: ENDPOINT /get_ratings ---
 
 
+@app.get("/stats")
+async def get_stats():
+    sessions = await asyncio.to_thread(SESSION_STORE.stats) # Con SESSION_BACKEND=sqlite consulta el archivo
+    return {"render_cache": RENDER_CACHE.stats(), "sessions": sessions, "http_pool": http_pool_stats(), "azure_scheduler": AZURE_SCHEDULER.stats(), "legend_index": LEGEND_INDEX.stats(), "batch_latency_model": BATCH_LATENCY_MODEL.stats(), "ratings": RATING_SINK.stats(), "report_cache": REPORT_CACHE.stats()}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    sessions = await asyncio.to_thread(SESSION_STORE.stats)
+    render_cache, scheduler, ratings = RENDER_CACHE.stats(), AZURE_SCHEDULER.stats(), RATING_SINK.stats()
+    gauges = [
+        ("pid_sessions", "Sesiones guardadas por ubicación.", {"tier": "memory"}, sessions["hot_sessions"]),
+        ("pid_sessions", "Sesiones guardadas por ubicación.", {"tier": "disk"}, sessions["cold_sessions"]),
+        ("pid_session_bytes", "Bytes de imágenes de sesión por ubicación.", {"tier": "memory"}, sessions["memory_bytes"]),
+        ("pid_session_bytes", "Bytes de imágenes de sesión por ubicación.", {"tier": "disk"}, sessions["disk_bytes"]),
+        ("pid_render_cache_bytes", "Bytes ocupados por la caché de renderizado.", {}, render_cache["bytes"]),
+        ("pid_azure_queue_depth", "Solicitudes a Azure esperando turno en el planificador.", {}, scheduler["queue_depth"]),
+        ("pid_azure_in_flight", "Solicitudes a Azure en curso.", {}, scheduler["in_flight"]),
+        ("pid_event_loop_lag_last_seconds", "Último retraso medido del bucle de eventos.", {}, EVENT_LOOP_LAG["last_seconds"]),
+        ("pid_event_loop_lag_max_seconds", "Mayor retraso del bucle de eventos desde el arranque.", {}, EVENT_LOOP_LAG["max_seconds"]),
+        ("pid_ratings_queue_depth", "Calificaciones en cola sin escribir.", {}, ratings["queue_depth"] + ratings["pending_rows"]),
+    ]
+    return Response(METRICS.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/sessions/{session_id}/timings")
+async def get_session_timings(session_id: str):
+    """Tiempos del análisis (etapas, pasos de renderizado, lotes y tokens) y de cada consulta de chat."""
+    timings = await asyncio.to_thread(SESSION_STORE.get_timings, session_id)
+    if timings is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada o expirada.")
+    return {"session_id": session_id, **timings}
+
+
 @app.get("/")
 def read_root():
     return {"message": "API de Análisis de Riesgos está en línea."}
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Las pruebas importan function_app.py desde la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Sin caché de renderizado en disco ni escrituras al blob de calificaciones durante las pruebas
+os.environ.setdefault("RENDER_CACHE_MAX_MB", "0")
+os.environ.setdefault("RATINGS_BACKEND", "local")
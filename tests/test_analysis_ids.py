@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import fitz
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import function_app
+
+
+def plano_pdf(pages: int) -> bytes:
+    # Cada hoja con su nube roja (marca de revisión) y su cajetín en la capa de texto
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=1224, height=792)
+        page.insert_text((50, 100), f"P-50{i}B bomba linea PSV-10{i}", fontsize=12)
+        page.draw_oval(fitz.Rect(300 + 40 * i, 250, 500 + 40 * i, 350), color=(1, 0, 0), width=3)
+        page.insert_text((1000, 713), f"DWG No: 100-9{i}", fontsize=10)
+        page.insert_text((1000, 752), f"REV: {i + 1}", fontsize=10)
+    return doc.tobytes()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    calls = []
+
+    async def azure(request):
+        payload = json.loads(await request.aread())
+        if "extractor OCR" in payload["messages"][0]["content"]:
+            content = {"extracciones": []}
+        else:
+            # Cada lote responde antes que el anterior: llegan en orden inverso
+            number = len(calls)
+            calls.append(number)
+            await asyncio.sleep(0.3 * (3 - number))
+            content = {"riesgos_identificados": [{"id": 1, "riesgo_titulo": f"lote {number}", "ubicacion": f"DWG No: 100-9{number}", "recomendacion": ""}]}
+        return httpx.Response(200, json={"choices": [{"message": {"content": json.dumps(content)}}], "usage": {"prompt_tokens": 10, "completion_tokens": 10}})
+
+    monkeypatch.setattr(function_app, "AZURE_API_KEY", "x")
+    monkeypatch.setattr(function_app, "HTTP_CLIENT", httpx.AsyncClient(transport=httpx.MockTransport(azure)))
+    with TestClient(function_app.app) as client:
+        yield client
+
+
+def analyze(client, stream=None):
+    # "balanced" reparte las 3 hojas en BATCH_TARGET_PARALLELISM lotes como mínimo: un lote por hoja
+    params = {"batching": "balanced", **({"stream": stream} if stream else {})}
+    return client.post("/analyze", params=params, files=[("planos", ("a.pdf", plano_pdf(3), "application/pdf"))])
+
+
+def stored_ids(session_id):
+    analysis = function_app.SESSION_STORE.get_analysis(session_id)["analysis"]
+    return {risk["riesgo_titulo"]: risk["id"] for risk in analysis["riesgos_identificados"]}
+
+
+def test_streamed_ids_are_the_stored_ids(client):
+    events = [json.loads(line) for line in analyze(client, "ndjson").text.splitlines()]
+    batches = [event for event in events if event["event"] == "batch"]
+    assert len(batches) == 3
+    assert [event["batch"] for event in batches] != sorted(event["batch"] for event in batches) # Llegaron desordenados
+
+    streamed = {risk["riesgo_titulo"]: risk["id"] for event in batches for risk in event["riesgos_identificados"]}
+    assert sorted(streamed.values()) == [1, 2, 3]
+    summary = events[-1]
+    assert {risk["riesgo_titulo"]: risk["id"] for risk in summary["riesgos_identificados"]} == streamed
+    assert stored_ids(summary["session_id"]) == streamed
+
+
+def test_single_response_numbers_in_batch_order(client):
+    response = analyze(client).json()
+    risks = json.loads(response["raw_analysis"])["riesgos_identificados"]
+    assert [(risk["id"], risk["riesgo_titulo"]) for risk in risks] == [(1, "lote 0"), (2, "lote 1"), (3, "lote 2")]
+    assert stored_ids(response["session_id"]) == {"lote 0": 1, "lote 1": 2, "lote 2": 3}
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+import function_app
+from function_app import AzureRequestScheduler, retry_after_seconds, send_analysis_request
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500", "retry-after": "9"}, 1.5), # retry-after-ms tiene prioridad
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after-ms": "nada", "retry-after": "2"}, 2.0),
+    ({}, None),
+    ({"retry-after": "tomorrow"}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert retry_after_seconds(httpx.Response(429, headers=headers)) == expected
+
+
+def test_retry_after_http_date():
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 28 <= retry_after_seconds(httpx.Response(429, headers={"retry-after": when})) <= 30
+
+
+@pytest.fixture
+def azure(monkeypatch):
+    """Azure simulado: la primera llamada recibe 429 con retry-after-ms; las demás, 200."""
+    calls = []
+
+    async def handler(request):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"retry-after-ms": "300"}, json={"error": {"code": "429"}})
+        return httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}], "usage": {"prompt_tokens": 1, "completion_tokens": 1}})
+
+    monkeypatch.setattr(function_app, "AZURE_API_KEY", "x")
+    monkeypatch.setattr(function_app, "HTTP_CLIENT", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(function_app, "AZURE_SCHEDULER", AzureRequestScheduler(rpm_limit=0, tpm_limit=0, max_concurrency=4))
+    monkeypatch.setattr(function_app.random, "uniform", lambda low, high: 0.0) # Sin jitter
+    return calls
+
+
+def payload(text):
+    return {"messages": [{"role": "user", "content": text}], "max_tokens": 10}
+
+
+def test_429_pauses_every_request_for_retry_after(azure):
+    async def run():
+        first = asyncio.create_task(send_analysis_request(payload("uno")))
+        await asyncio.sleep(0.05) # El 429 ya llegó: la segunda solicitud encuentra el despacho pausado
+        second = asyncio.create_task(send_analysis_request(payload("dos")))
+        return await asyncio.gather(first, second)
+
+    results = asyncio.run(run())
+    assert [result["choices"][0]["message"]["content"] for result in results] == ["ok", "ok"]
+    assert len(azure) == 3
+    # Ni el reintento ni la otra solicitud salieron antes del Retry-After
+    assert all(at - azure[0] >= 0.3 for at in azure[1:])
+    stats = function_app.AZURE_SCHEDULER.stats()
+    assert (stats["throttled_429"], stats["retries"], stats["dispatched"]) == (1, 1, 3)
+
+
+def test_pause_delays_acquire():
+    async def run():
+        scheduler = AzureRequestScheduler(rpm_limit=0, tpm_limit=0, max_concurrency=1)
+        scheduler.start()
+        scheduler.pause(0.2)
+        started = time.monotonic()
+        await scheduler.acquire(function_app.PRIORITY_ANALYSIS, 100)
+        waited = time.monotonic() - started
+        scheduler.release()
+        await scheduler.stop()
+        return waited
+
+    assert asyncio.run(run()) >= 0.2
@@ -0,0 +1,87 @@
+import pytest
+
+import function_app
+from function_app import BATCH_STRATEGIES, BatchBuilder, image_tokens
+
+
+def page(n, size, file="a.pdf"):
+    # "size" fija las dimensiones: image_tokens_of no necesita decodificar la imagen
+    return {"data": b"x" * size, "mime_type": "image/png", "file": file, "page": n, "size": (512, 512)}
+
+
+PAGE_TOKENS = image_tokens(512, 512)
+
+
+@pytest.fixture
+def limit_bytes(monkeypatch):
+    monkeypatch.setattr(function_app, "SAFE_PAYLOAD_LIMIT_MB", 1000 / 1024 / 1024)
+    return 1000
+
+
+def build(pages, **options):
+    builder = BatchBuilder(0, **options)
+    batches = []
+    for image in pages:
+        batches += builder.add(image)
+    return builder, batches + builder.flush()
+
+
+def pages_of(batches):
+    return [[image["page"] for image in batch] for batch in batches]
+
+
+def test_greedy_keeps_order_and_closes_full_batches(limit_bytes):
+    builder = BatchBuilder(0, strategy="greedy")
+    assert builder.add(page(1, 400)) == []
+    assert builder.add(page(2, 400)) == []
+    assert pages_of(builder.add(page(3, 400))) == [[1, 2]] # Sale en cuanto se llena
+    assert pages_of(builder.add(page(4, 400))) == []
+    assert pages_of(builder.flush()) == [[3, 4]]
+
+
+def test_ffd_uses_fewer_batches_than_greedy(limit_bytes):
+    sizes = [600, 500, 400, 300, 200]
+    _, greedy = build([page(n, size) for n, size in enumerate(sizes, start=1)], strategy="greedy")
+    _, ffd = build([page(n, size) for n, size in enumerate(sizes, start=1)], strategy="ffd")
+    assert len(greedy) == 3
+    assert sorted(pages_of(ffd)) == [[1, 3], [2, 4, 5]] # Dentro de cada lote, orden original
+
+
+def test_balanced_spreads_load_over_target_parallelism(limit_bytes):
+    pages = [page(n, 300) for n in range(1, 7)]
+    _, ffd = build(pages, strategy="ffd")
+    _, balanced = build(pages, strategy="balanced", target_parallelism=3)
+    assert len(ffd) == 2
+    assert [len(batch) for batch in balanced] == [2, 2, 2]
+
+
+@pytest.mark.parametrize("strategy", BATCH_STRATEGIES)
+def test_token_limit_splits_batches(limit_bytes, strategy):
+    _, batches = build([page(n, 10) for n in range(1, 5)], strategy=strategy, token_limit=2 * PAGE_TOKENS)
+    assert all(len(batch) <= 2 for batch in batches)
+    assert sorted(image["page"] for batch in batches for image in batch) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("strategy", BATCH_STRATEGIES)
+def test_oversized_page_is_skipped_not_sent(limit_bytes, strategy):
+    builder, batches = build([page(1, 300), page(2, 1500), page(3, 300)], strategy=strategy)
+    assert sorted(image["page"] for batch in batches for image in batch) == [1, 3]
+    assert builder.skipped == [{"file": "a.pdf", "page": 2, "bytes": 1500, "tokens": PAGE_TOKENS}]
+
+
+@pytest.mark.parametrize("strategy", BATCH_STRATEGIES)
+def test_keep_together_groups_sheets_of_one_pdf(limit_bytes, strategy):
+    pages = [page(1, 200, "a.pdf"), page(2, 200, "b.pdf"), page(3, 200, "b.pdf"), page(4, 200, "b.pdf"), page(5, 300, "c.pdf")]
+    _, batches = build(pages, strategy=strategy, keep_together=True, target_parallelism=2)
+    files = [{image["file"] for image in batch} for batch in batches]
+    assert sum("b.pdf" in batch_files for batch_files in files) == 1
+
+
+def test_failed_pages_are_ignored(limit_bytes):
+    _, batches = build([page(1, 100), None, page(2, 100)])
+    assert pages_of(batches) == [[1, 2]]
+
+
+def test_unknown_strategy_raises():
+    with pytest.raises(ValueError):
+        BatchBuilder(0, strategy="random")
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import function_app
+from function_app import SqliteSessionStore
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    # Dos workers: cada uno con su conexión a la misma base y sus propios JOBS / JOB_TASKS
+    path = str(tmp_path / "sessions.sqlite3")
+    monkeypatch.setattr(function_app, "JOB_CANCEL_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(function_app, "JOB_SEMAPHORE", None)
+    for name in ("SESSION_STORE", "JOBS", "JOB_TASKS"):
+        monkeypatch.setattr(function_app, name, getattr(function_app, name))
+    return SqliteSessionStore(path, ttl_seconds=3600, disk_budget_bytes=10_000), SqliteSessionStore(path, ttl_seconds=3600, disk_budget_bytes=10_000)
+
+
+@contextmanager
+def as_worker(store, jobs, tasks):
+    function_app.SESSION_STORE, function_app.JOBS, function_app.JOB_TASKS = store, jobs, tasks
+    yield
+
+
+async def hanging_analysis(*args, **kwargs):
+    kwargs["on_stage"]("render")
+    await asyncio.Event().wait()
+    yield
+
+
+def new_job(job_id):
+    return {"job_id": job_id, "session_id": "s", "status": "queued", "stage": None, "stage_history": [], "created_at": time.time(), "started_at": None,
+            "finished_at": None, "batches_total": None, "batches_completed": 0, "batches": [], "cajetin": None, "timings": None, "usage": None,
+            "deduplication": None, "error": None, "result": None}
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.02)
+
+
+def test_job_is_cancelled_from_another_worker(stores, monkeypatch):
+    store_a, store_b = stores
+    monkeypatch.setattr(function_app, "analysis_events", hanging_analysis)
+
+    async def run():
+        jobs_a, tasks_a = {}, {}
+        with as_worker(store_a, jobs_a, tasks_a):
+            job = jobs_a["j"] = new_job("j")
+            tasks_a["j"] = task = asyncio.get_running_loop().create_task(function_app.run_analysis_job(job, [], []))
+            watcher = asyncio.get_running_loop().create_task(function_app.watch_job_cancellations())
+            await wait_for(lambda: (store_b.get_job("j") or {}).get("stage") == "render")
+
+        # DELETE /jobs/j llega al worker B, que no ejecuta el trabajo: sólo deja la marca
+        with as_worker(store_b, {}, {}):
+            view = await function_app.cancel_analysis_job("j")
+        assert view["status"] == "running" and view["cancel_requested"]
+
+        with as_worker(store_a, jobs_a, tasks_a):
+            await wait_for(task.done)
+            watcher.cancel()
+            assert job["status"] == "cancelled" and "j" not in tasks_a
+            await wait_for(lambda: store_b.get_job("j")["status"] == "cancelled")
+
+    asyncio.run(run())
+
+
+def test_finished_job_is_not_marked(stores):
+    store_a, store_b = stores
+    store_a.save_job("j", '{"job_id": "j", "status": "completed"}', "completed", time.time())
+
+    async def run():
+        with as_worker(store_b, {}, {}):
+            return await function_app.cancel_analysis_job("j")
+
+    assert asyncio.run(run())["status"] == "completed"
+    assert store_b.cancel_requested_jobs(["j"]) == []
@@ -0,0 +1,67 @@
+import numpy as np
+
+from function_app import PageDeduplicator, page_fingerprint
+
+MARKS = {"has_marks": True, "boxes": [{"kind": "cloud", "bbox": [0.1, 0.1, 0.2, 0.2]}]}
+
+
+def sheet(seed=0, noise=0):
+    """Miniatura sintética: un degradado con un rectángulo; noise altera unos pocos píxeles."""
+    samples = np.tile(np.linspace(0, 255, 64, dtype=np.uint8), (48, 1))[..., None].repeat(3, axis=2).copy()
+    samples[10:20, 10 + seed:30 + seed] = 0
+    if noise:
+        samples[40, :noise] = 255 - samples[40, :noise]
+    return samples
+
+
+def source(n):
+    return {"file": "a.pdf", "page": n}
+
+
+def test_exact_duplicate_matches_by_pixels():
+    dedup = PageDeduplicator(max_distance=6)
+    fingerprint = page_fingerprint(sheet(), "P-101A LINEA 2")
+    entry = dedup.register(source(1), fingerprint, MARKS, tiled=False)
+    match = dedup.find(page_fingerprint(sheet(), "otro texto"), MARKS, tiled=False)
+    assert match == (entry, "exact", 0)
+
+
+def test_different_revision_marks_or_mode_do_not_match():
+    dedup = PageDeduplicator(max_distance=6)
+    fingerprint = page_fingerprint(sheet(), "P-101A")
+    dedup.register(source(1), fingerprint, MARKS, tiled=False)
+    assert dedup.find(fingerprint, {"has_marks": False, "boxes": []}, tiled=False) is None
+    assert dedup.find(fingerprint, None, tiled=False) is None
+    assert dedup.find(fingerprint, MARKS, tiled=True) is None
+
+
+def test_perceptual_duplicate_needs_same_text_and_close_hash():
+    dedup = PageDeduplicator(max_distance=6)
+    entry = dedup.register(source(1), page_fingerprint(sheet(), "P-101A LINEA 2"), MARKS, tiled=False)
+    rescanned = page_fingerprint(sheet(noise=3), "P-101A   LINEA 2") # Espacios distintos: mismo texto
+    found, kind, distance = dedup.find(rescanned, MARKS, tiled=False)
+    assert (found, kind) == (entry, "perceptual") and distance <= 6
+    assert dedup.find(page_fingerprint(sheet(noise=3), "P-101B LINEA 2"), MARKS, tiled=False) is None
+    assert dedup.find(page_fingerprint(sheet(seed=20), "P-101A LINEA 2"), MARKS, tiled=False) is None
+
+
+def test_pages_without_text_only_match_exactly():
+    dedup = PageDeduplicator(max_distance=64)
+    dedup.register(source(1), page_fingerprint(sheet(), ""), MARKS, tiled=False)
+    assert dedup.find(page_fingerprint(sheet(noise=3), ""), MARKS, tiled=False) is None
+
+
+def test_negative_distance_disables_perceptual_matching():
+    dedup = PageDeduplicator(max_distance=-1)
+    dedup.register(source(1), page_fingerprint(sheet(), "P-101A"), MARKS, tiled=False)
+    assert dedup.find(page_fingerprint(sheet(noise=3), "P-101A"), MARKS, tiled=False) is None
+
+
+def test_report_counts_saved_bytes():
+    dedup = PageDeduplicator()
+    dedup.record(source(3), source(1), {"match": "exact", "distance": 0}, saved_bytes=100, sent=True)
+    dedup.record(source(4), source(1), {"match": "perceptual", "distance": 2}, saved_bytes=50, sent=False)
+    report = dedup.report()
+    assert report["pages_saved"] == 2
+    assert (report["bytes_saved"], report["payload_bytes_saved"]) == (150, 100)
+    assert report["duplicates"][0] == {"file": "a.pdf", "page": 3, "duplicate_of": source(1), "match": "exact", "distance": 0}
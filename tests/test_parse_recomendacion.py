@@ -0,0 +1,42 @@
+import re
+
+import pytest
+
+from function_app import parse_recomendacion
+
+
+def export_parse(recomendacion_full):
+    """Separación que hacía el export de la versión base (89e223d) al escribir cada fila del CSV."""
+    def extract_text(key, text):
+        match = re.search(f"{key}:(.*?)(?=(Mitigaciones Existentes:|Recomendación Principal:|Alternativa Práctica:|$))", text, re.IGNORECASE | re.DOTALL)
+        return match.group(1).strip().replace('\n', ' ') if match else 'N/A'
+
+    return {
+        "mitigaciones_existentes": extract_text("Mitigaciones Existentes", recomendacion_full),
+        "recomendacion_principal": extract_text("Recomendación Principal", recomendacion_full),
+        "alternativa_practica": extract_text("Alternativa Práctica", recomendacion_full),
+    }
+
+
+@pytest.mark.parametrize("text", [
+    "Mitigaciones Existentes: PSV-101 Recomendación Principal: instalar LAHH Alternativa Práctica: procedimiento",
+    "Recomendación Principal: a\nsegunda línea\nAlternativa Práctica: b",
+    "Alternativa Práctica: b Recomendación Principal: a",
+    "mitigaciones existentes: minúsculas RECOMENDACIÓN PRINCIPAL: mayúsculas",
+    "Mitigaciones Existentes: Recomendación Principal: vacía antes",
+    "Recomendación Principal: primera Recomendación Principal: repetida",
+    "Sin subtítulos: texto libre",
+    "",
+    "N/A",
+])
+def test_matches_baseline_export_parse(text):
+    assert parse_recomendacion(text) == export_parse(text)
+
+
+@pytest.mark.parametrize("value, expected_principal", [
+    (None, "N/A"),
+    (["Recomendación Principal: a", "Alternativa Práctica: b"], "a"),
+    (42, "N/A"),
+])
+def test_non_string_values_do_not_raise(value, expected_principal):
+    assert parse_recomendacion(value)["recomendacion_principal"] == expected_principal
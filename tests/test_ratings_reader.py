@@ -0,0 +1,71 @@
+import asyncio
+
+from function_app import RATINGS_HEADER, LocalRatingsBackend, RatingsReader
+
+
+def write_log(path, contents: bytes = None, append: bytes = None):
+    if contents is not None:
+        path.write_bytes(contents)
+    if append is not None:
+        with open(path, "ab") as f:
+            f.write(append)
+
+
+def refreshed(reader):
+    asyncio.run(reader.refresh(force=True))
+    return reader
+
+
+def new_reader(path):
+    return RatingsReader(LocalRatingsBackend(str(path)), min_refresh_seconds=0)
+
+
+def test_log_with_header(tmp_path):
+    path = tmp_path / "ratings.csv"
+    write_log(path, RATINGS_HEADER + b"s1;5;bien;1 hora\ns2;3;;\n")
+    reader = refreshed(new_reader(path))
+    assert [(row["session_id"], row["rating"]) for row in reader.rows] == [("s1", 5), ("s2", 3)]
+    assert reader.summary()["mean_rating"] == 4.0
+    assert reader.tiempo_ahorrado == {"1 hora": 1, "No especificado": 1}
+
+
+def test_headerless_log_keeps_first_row(tmp_path):
+    path = tmp_path / "ratings.csv"
+    write_log(path, b"s1;4;sin cabecera;\ns2;2;;\n")
+    reader = refreshed(new_reader(path))
+    assert [row["rating"] for row in reader.rows] == [4, 2]
+    assert reader.rows[0]["comment"] == "sin cabecera"
+
+
+def test_truncated_row_is_read_once_complete(tmp_path):
+    path = tmp_path / "ratings.csv"
+    write_log(path, RATINGS_HEADER + b"s1;5;;\ns2;4;a medio")
+    reader = refreshed(new_reader(path))
+    assert [row["session_id"] for row in reader.rows] == ["s1"]
+    assert reader.offset == len(RATINGS_HEADER) + len(b"s1;5;;\n")
+    write_log(path, append=b" escribir;\n")
+    refreshed(reader)
+    assert [row["session_id"] for row in reader.rows] == ["s1", "s2"]
+    assert reader.rows[1]["comment"] == "a medio escribir"
+
+
+def test_repeated_header_and_malformed_rows_are_skipped(tmp_path):
+    path = tmp_path / "ratings.csv"
+    write_log(path, RATINGS_HEADER + b"s1;5;;\n" + RATINGS_HEADER + b"s2;cinco;;\ns3;1;;\n")
+    reader = refreshed(new_reader(path))
+    assert [row["session_id"] for row in reader.rows] == ["s1", "s3"]
+    assert reader.histogram["5"] == 1 and reader.histogram["1"] == 1
+
+
+def test_shorter_log_is_read_again_from_the_start(tmp_path):
+    path = tmp_path / "ratings.csv"
+    write_log(path, RATINGS_HEADER + b"s1;5;;\ns2;4;;\n")
+    reader = refreshed(new_reader(path))
+    write_log(path, RATINGS_HEADER + b"s3;1;;\n")
+    refreshed(reader)
+    assert [row["session_id"] for row in reader.rows] == ["s3"]
+
+
+def test_missing_log_has_no_rows(tmp_path):
+    reader = refreshed(new_reader(tmp_path / "no_existe.csv"))
+    assert reader.rows == [] and not reader.exists
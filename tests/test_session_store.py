@@ -0,0 +1,35 @@
+import pytest
+
+from function_app import SessionStore, page_content
+
+
+def image(content: bytes, **extra):
+    return {"data": content, "mime_type": "image/png", "file": "a.pdf", "page": 1, **extra}
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Presupuesto de memoria para una sola sesión: la segunda derrama la primera a disco
+    return SessionStore(ttl_seconds=3600, memory_budget_bytes=150, spill_dir=str(tmp_path), disk_budget_bytes=10_000)
+
+
+def test_spill_and_reload_keep_every_image_key(store):
+    sources = [{"file": "a.pdf", "page": 1, "plano_page": 1}, {"file": "b.pdf", "page": 3, "plano_page": 2}]
+    tile = {"data": b"t" * 5, "mime_type": "image/png", "bbox": [0, 0, 0.5, 0.5]}
+    original = image(b"a" * 100, plano_page=1, sources=sources, encoding={"rung": "png-150", "bytes": 100}, tiles=[tile])
+    store.create("a", [original], index={"pages": []})
+    store.create("b", [image(b"b" * 100)])
+    assert "a" in store.cold and store.spills == 1
+
+    reloaded, = store.get_images("a", [0])
+    assert store.reloads == 1
+    assert reloaded == original
+    assert page_content(reloaded)[0]["text"].startswith("La siguiente hoja aparece 2 veces")
+
+
+def test_analysis_survives_a_spill_without_reloading(store):
+    store.create("a", [image(b"a" * 100)])
+    store.set_analysis("a", {"riesgos": []})
+    store.create("b", [image(b"b" * 100)])
+    assert store.get_analysis("a")["analysis"] == {"riesgos": []}
+    assert store.reloads == 0
@@ -0,0 +1,92 @@
+import json
+import time
+
+import pytest
+
+from function_app import SqliteSessionStore
+
+
+def image(content: bytes, **extra):
+    return {"data": content, "mime_type": "image/png", "file": "a.pdf", "page": 1, **extra}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl_seconds=3600, disk_budget_bytes=10_000)
+
+
+def blob_total(store):
+    connection = store._connect()
+    return store._blob_bytes(connection), connection.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+
+def age(store, session_id, seconds):
+    store._connect().execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (time.time() - seconds, session_id))
+
+
+def test_get_reads_no_blobs_and_get_images_returns_requested_pages(store):
+    store.create("s", [image(b"a" * 10), None, image(b"b" * 10, tiles=[{"data": b"t" * 5, "mime_type": "image/png", "bbox": [0, 0, 1, 1]}])],
+                 index={"pages": []})
+    session = store.get("s")
+    assert session == {"page_count": 2, "index": {"pages": []}, "analysis": None, "analysis_version": None}
+    images = store.get_images("s", [1, 0])
+    assert [i["data"] for i in images] == [b"b" * 10, b"a" * 10]
+    assert images[0]["tiles"][0]["data"] == b"t" * 5
+    assert store.get_images("otra", [0]) is None
+
+
+def test_expired_sessions_are_hidden_and_purged(store):
+    store.create("viejo", [image(b"v" * 100)])
+    store.create("nuevo", [image(b"n" * 100)])
+    age(store, "viejo", 3601)
+    assert store.get("viejo") is None and store.get_analysis("viejo") is None
+    assert store.get("nuevo") is not None
+    store.purge_expired()
+    assert store.expirations == 1
+    assert blob_total(store) == (100, 100)
+
+
+def test_reads_refresh_the_ttl_at_most_once_per_interval(store):
+    store.create("s", [image(b"x")])
+    read_last_access = lambda: store._connect().execute("SELECT last_access FROM sessions").fetchone()[0]
+    created = read_last_access()
+    store.get("s")
+    assert read_last_access() == created # Reciente: la lectura no escribe
+    age(store, "s", store.touch_interval_seconds + 1)
+    aged = read_last_access()
+    store.get("s")
+    assert read_last_access() > aged
+
+
+def test_budget_evicts_least_recently_used_and_keeps_running_total(store):
+    store.create("a", [image(b"a" * 4000)])
+    store.create("b", [image(b"b" * 4000)])
+    age(store, "a", 60)
+    store.create("c", [image(b"c" * 4000)]) # 12000 > 10000: sale "a", la menos usada
+    assert store.get("a") is None and store.get("b") is not None and store.get("c") is not None
+    assert store.evictions == 1
+    assert blob_total(store) == (8000, 8000)
+
+
+def test_shared_pages_are_stored_once(store):
+    store.create("a", [image(b"p" * 3000), image(b"q" * 3000)])
+    store.create("b", [image(b"p" * 3000)])
+    assert blob_total(store) == (6000, 6000)
+    assert store.stats()["deduplicated_bytes"] == 3000
+    # Reemplazar una sesión conserva los blobs que la nueva versión sigue usando
+    store.create("a", [image(b"p" * 3000)])
+    assert blob_total(store) == (3000, 3000)
+    assert store.get_images("a", [0])[0]["data"] == b"p" * 3000
+
+
+def test_jobs_are_shared_and_cancellable(store):
+    job = {"job_id": "j", "status": "running", "finished_at": None}
+    store.save_job("j", json.dumps(job), "running", None)
+    assert store.get_job("j") == {**job, "cancel_requested": False}
+    assert store.request_job_cancel("j")
+    assert store.cancel_requested_jobs(["j", "otro"]) == ["j"]
+    store.save_job("j", json.dumps({**job, "status": "cancelled"}), "cancelled", 1.0)
+    assert store.get_job("j")["cancel_requested"] # La marca sobrevive a las actualizaciones del dueño
+    assert not store.request_job_cancel("j")
+    store.purge_jobs(finished_before=2.0)
+    assert store.get_job("j") is None
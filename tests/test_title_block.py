@@ -0,0 +1,45 @@
+import pytest
+
+from function_app import extract_title_block_fields
+
+
+def words_of(*lines):
+    # Tuplas como page.get_text("words"): (x0, y0, x1, y1, texto, bloque, línea, palabra)
+    words = []
+    for line_no, (text, x0, y0) in enumerate(lines):
+        x = x0
+        for word_no, word in enumerate(text.split()):
+            words.append((x, y0, x + 6 * len(word), y0 + 10, word, 0, line_no, word_no))
+            x += 6 * len(word) + 4
+    return words
+
+
+@pytest.mark.parametrize("label", ["No", "No.", "N°", "Nº"])
+@pytest.mark.parametrize("separator", [" ", ": "])
+@pytest.mark.parametrize("prefix, value", [("DWG", "P-1001-A"), ("PLANO", "123-45")])
+def test_dwg_label_variants(label, separator, prefix, value):
+    fields = extract_title_block_fields(words_of((f"{prefix} {label}{separator}{value}", 400, 700), ("REV: 2", 400, 720)))
+    assert fields["dwg_no"] == value
+    assert fields["rev"] == "2"
+    assert fields["confidence"] == 0.95
+
+
+def test_values_in_the_cell_below():
+    fields = extract_title_block_fields(words_of(
+        ("DWG N°", 400, 700), ("REV", 520, 700),
+        ("P-2002", 400, 715), ("B", 520, 715),
+    ))
+    assert fields == {"dwg_no": "P-2002", "rev": "B", "confidence": 0.8}
+
+
+def test_revision_table_lowers_confidence():
+    fields = extract_title_block_fields(words_of(
+        ("DWG No: P-3003", 400, 700),
+        ("REV: 0", 400, 600), ("REV: 1", 400, 620),
+    ))
+    assert fields["dwg_no"] == "P-3003"
+    assert fields["confidence"] == 0.65
+
+
+def test_no_labels():
+    assert extract_title_block_fields(words_of(("NOTAS GENERALES", 50, 50))) == {"dwg_no": None, "rev": None, "confidence": 0.0}